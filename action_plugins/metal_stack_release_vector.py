@@ -3,12 +3,24 @@
 
 import tarfile
 import tempfile
+import copy
+import fcntl
+import importlib.util
 import json
+import hashlib
+import io
+import mmap
 import os
+import random
+import shutil
 import subprocess
+import sys
+import threading
+import time
 
-from io import BytesIO
-from yaml import safe_load
+from collections import ChainMap
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from urllib.parse import urlparse
 from traceback import format_exc
 
@@ -20,11 +32,16 @@ from ansible.playbook.role import Role
 from ansible.playbook.role.include import RoleInclude
 from ansible import constants as C
 from ansible.module_utils.common import process
+from ansible.module_utils.common.arg_spec import ArgumentSpecValidator
 
 HAS_OPENCONTAINERS = True
 try:
     # type: ignore[import]
-    from opencontainers.distribution.reggie import NewClient, WithReference, WithDigest, WithDefaultName, WithUsernamePassword
+    from opencontainers.distribution.reggie import NewClient, WithName, WithReference, WithDigest, WithDefaultName, WithUsernamePassword
+    from opencontainers.distribution.reggie.client import parseAuthHeader
+    from opencontainers.distribution.reggie.request import validateRequest
+    import requests
+    import urllib3
     import opencontainers.image.v1 as opencontainersv1  # type: ignore[import]
 except ImportError as ex:
     HAS_OPENCONTAINERS = False
@@ -38,8 +55,34 @@ except ImportError:
     display = Display()
 
 
+def _load_plugin_utils(name):
+    # the helpers shared by the controller-side plugins of this role are loaded
+    # from their path, such that the role directory is not added to sys.path
+    module_name = "metal_stack_ansible_common_" + name
+    module = sys.modules.get(module_name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plugin_utils", name + ".py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module = sys.modules.setdefault(module_name, module)
+    return module
+
+
+release_vector_cache = _load_plugin_utils("release_vector_cache")
+release_vector_documents = _load_plugin_utils("release_vector_documents")
+
+DiskCache = release_vector_cache.DiskCache
+HttpCache = release_vector_cache.HttpCache
+VariableMapping = release_vector_documents.VariableMapping
+dotted_path = release_vector_documents.dotted_path
+load_yaml = release_vector_documents.load_yaml
+replace_key_values = release_vector_documents.replace_key_values
+
+
 class ActionModule(ActionBase):
-    CACHE_FILE = "metal-stack-release-vector-cache.json"
+    CACHE_DIR = "metal-stack-release-vector-cache"
+    CACHE_LOCK_TIMEOUT = 600
 
     def run(self, tmp=None, task_vars=None):
         if task_vars is None:
@@ -48,10 +91,7 @@ class ActionModule(ActionBase):
         super(ActionModule, self).run(tmp, task_vars)
         del tmp  # tmp no longer has any effect
 
-        self._task.args.setdefault('vectors', task_vars.get(
-            'metal_stack_release_vectors', None))
-
-        validation_result, task_args = self._validate_module_args()
+        validation_result, task_args = self._normalize_args(self._templar, self._task.args, task_vars)
         result = dict()
 
         if validation_result.error_messages:
@@ -59,27 +99,87 @@ class ActionModule(ActionBase):
             result["msg"] = str(validation_result.error_messages)
             return result
 
-        # as we can pick up the module inputs from task_vars,
-        # we have to run this through the templar to allow using
-        # variables in the module inputs
-        task_args = self._templar.template(task_args)
-
         self._supports_check_mode = True
 
-        if task_args.get('cache') and os.path.isfile(self._cache_file_path()):
-            result["changed"] = False
-            with open(self._cache_file_path(), 'r') as vector:
-                result["ansible_facts"] = json.load(vector)
-            display.vvv("- Returning cache from %s" % self._cache_file_path)
+        timings = Timings()
+
+        # loader arguments that are shared across all vectors and roles of this run
+        shared_loader_args = dict(
+            timings=timings,
+            oci_blob_cache=None,
+            oci_client_pool=OciClientPool(
+                max_connections=max(task_args.get('parallelism'), 10)),
+            http_cache=HttpCache(
+                path=task_args.get('oci_blob_cache_dir') or HttpCache.default_path(),
+                max_size=task_args.get('oci_blob_cache_max_size_mb') * 1024 * 1024) if task_args.get('http_cache') else None,
+            git_mirror_cache=GitMirrorCache(
+                GitMirrorCache.default_path()) if task_args.get('git_mirror_cache') else None,
+            role_defaults_cache=RoleDefaultsCache(
+                RoleDefaultsCache.default_path()) if task_args.get('role_defaults_cache') else None,
+        )
+
+        if task_args.get('oci_blob_cache'):
+            shared_loader_args["oci_blob_cache"] = OciBlobCache(
+                path=task_args.get('oci_blob_cache_dir') or OciBlobCache.default_path(),
+                max_size=task_args.get('oci_blob_cache_max_size_mb') * 1024 * 1024)
+
+        # verifications are remembered for this run, they are only persisted in the cache on request
+        shared_loader_args["oci_cosign_verifier"] = CosignVerifier(
+            max_workers=max(task_args.get('parallelism'), 4), timings=timings,
+            blob_cache=shared_loader_args["oci_blob_cache"] if task_args.get('oci_cosign_verification_cache') else None)
+
+        if task_args.get('oci_registry_mirrors'):
+            try:
+                shared_loader_args["oci_registry_mirrors"] = RegistryMirrors(
+                    task_args.get('oci_registry_mirrors'), client_pool=shared_loader_args["oci_client_pool"],
+                    hedge=task_args.get('oci_registry_hedging'), max_workers=max(task_args.get('parallelism'), 4))
+            except ValueError as e:
+                result["failed"] = True
+                result["msg"] = "invalid registry mirrors"
+                result["error"] = to_native(e)
+                return result
+
+        try:
+            if task_args.get('oci_layout'):
+                shared_loader_args["oci_layout"] = OciLayout.open(task_args.get('oci_layout'))
+            if task_args.get('oci_layout_export'):
+                shared_loader_args["oci_layout_export"] = OciLayoutWriter(task_args.get('oci_layout_export'))
+        except Exception as e:
+            result["failed"] = True
+            result["msg"] = "error opening oci layout"
+            result["error"] = to_native(e)
+            result["traceback"] = format_exc()
             return result
 
         result["changed"] = False
-        ansible_facts = {}
 
-        for vector in task_args.get('vectors'):
+        with ExitStack() as stack:
+            if shared_loader_args.get("oci_registry_mirrors"):
+                stack.callback(shared_loader_args["oci_registry_mirrors"].shutdown)
+
+            # an export needs to download every artifact, so it can not be served from the cache
+            cache_key = self._cache_key(self._templar, task_args, task_vars) if task_args.get('cache') else None
+
+            if cache_key and not task_args.get('oci_layout_export'):
+                with timings.span("cache", "read"):
+                    results = self._read_cache(
+                        cache_key, task_args, task_vars, shared_loader_args)
+
+                # only one worker resolves the same vectors at a time, workers that had
+                # to wait for it pick up its result from the cache
+                if results is None and stack.enter_context(self._single_flight(cache_key)):
+                    with timings.span("cache", "read"):
+                        results = self._read_cache(
+                            cache_key, task_args, task_vars, shared_loader_args)
+
+                if results is not None:
+                    result["ansible_facts"] = self._merge(results, task_vars)
+                    result["timings"] = self._report_timings(timings, task_args)
+                    return result
+
             try:
-                data = RemoteResolver(
-                    module=self, task_vars=task_vars, task_args=vector).resolve()
+                results, sources = self._resolve(
+                    task_args, task_vars, shared_loader_args, timings)
             except Exception as e:
                 result["failed"] = True
                 result["msg"] = "error resolving yaml"
@@ -87,33 +187,296 @@ class ActionModule(ActionBase):
                 result["traceback"] = format_exc()
                 return result
 
+            if cache_key:
+                with timings.span("cache", "write"):
+                    self._write_cache(cache_key, results, sources)
+
+        result["ansible_facts"] = self._merge(results, task_vars)
+        result["timings"] = self._report_timings(timings, task_args)
+
+        return result
+
+    def _resolve(self, task_args, task_vars, shared_loader_args, timings):
+        # with parallelism only the downloads are fanned out to the worker pool,
+        # everything else is processed in the order of definition such that the
+        # first-defined-wins semantics are retained
+        executor = None
+        if task_args.get('parallelism') > 1:
+            executor = ThreadPoolExecutor(
+                max_workers=task_args.get('parallelism'))
+
+        try:
+            resolvers = []
+            graph = dict()
+            for vector in task_args.get('vectors'):
+                resolver = RemoteResolver(
+                    module=self, task_vars=task_vars, task_args=vector, executor=executor,
+                    shared_loader_args=shared_loader_args, graph=graph).canonical()
+                # vectors are only fetched when they provide a variable that is not overridden
+                if resolver.demand() is not False:
+                    resolver.prefetch()
+                resolvers.append(resolver)
+
+            results = [resolver.resolve() for resolver in resolvers]
+
+            if shared_loader_args.get("oci_layout_export"):
+                with timings.span("export", task_args.get('oci_layout_export')):
+                    shared_loader_args["oci_layout_export"].close()
+        except Exception:
+            if shared_loader_args.get("oci_layout_export"):
+                shared_loader_args["oci_layout_export"].abort()
+            raise
+        finally:
+            if executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+            shared_loader_args["oci_cosign_verifier"].shutdown()
+
+        return results, [resolver.source() for resolver in resolvers]
+
+    @staticmethod
+    @contextmanager
+    def _single_flight(cache_key):
+        """
+        Holds an exclusive lock on the cache entry of the given key across
+        processes and yields whether another worker held the lock before.
+        """
+        path = ActionModule._cache_file_path(cache_key) + ".lock"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "a") as f:
+            waited = False
+            locked = False
+            deadline = time.monotonic() + ActionModule.CACHE_LOCK_TIMEOUT
+
+            while not locked:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                except BlockingIOError:
+                    if not waited:
+                        display.vvv("- Waiting for another worker resolving the same vectors")
+                    waited = True
+
+                    if time.monotonic() > deadline:
+                        display.warning("timed out waiting for %s, resolving without lock" % path)
+                        break
+
+                    time.sleep(0.05)
+
+            try:
+                yield waited
+            finally:
+                if locked:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    def _report_timings(timings, task_args):
+        report = timings.report()
+
+        for phase, t in report["phases"].items():
+            display.vvv("- Timing of %s: %.3fs in %d spans, %d bytes" %
+                        (phase, t["seconds"], t["count"], t["bytes"]))
+        display.vvv("- Total time: %.3fs" % report["seconds"])
+
+        if task_args.get('trace_file'):
+            try:
+                timings.write_chrome_trace(task_args.get('trace_file'))
+            except OSError as e:
+                display.warning("unable to write trace file: %s" % to_native(e))
+
+        return report
+
+    @classmethod
+    def cached_facts(cls, templar, task_vars):
+        """
+        Returns the cached facts of the release vectors configured through the
+        task vars or None if there is no valid cache entry. This is used by setup_yaml.
+        """
+        validation_result, task_args = cls._normalize_args(templar, dict(), task_vars)
+        if validation_result.error_messages or not task_args.get('vectors') or not task_args.get('cache'):
+            return None
+
+        results = cls._read_cache(cls._cache_key(templar, task_args, task_vars), task_args, task_vars)
+        if results is None:
+            return None
+
+        return cls._merge(results, task_vars)
+
+    @classmethod
+    def _normalize_args(cls, templar, args, task_vars):
+        """
+        Returns the validation result and the validated and templated arguments,
+        which fall back to the task vars. The cache key is derived from these, so
+        run and cached_facts normalize the arguments the same way.
+        """
+        args = cls._task_var_args(dict(args), task_vars)
+        validation_result = ArgumentSpecValidator(cls.argument_spec()).validate(args)
+        if validation_result.error_messages:
+            return validation_result, None
+
+        # as we can pick up the module inputs from task_vars,
+        # we have to run this through the templar to allow using
+        # variables in the module inputs
+        return validation_result, templar.template(validation_result.validated_parameters)
+
+    @staticmethod
+    def _task_var_args(args, task_vars):
+        args.setdefault('vectors', task_vars.get(
+            'metal_stack_release_vectors', None))
+        args.setdefault('parallelism', task_vars.get(
+            'metal_stack_release_vector_parallelism', 1))
+        args.setdefault('cache_ttl', task_vars.get(
+            'metal_stack_release_vector_cache_ttl', None))
+        args.setdefault('oci_registry_mirrors', task_vars.get(
+            'metal_stack_release_vector_registry_mirrors', None))
+        # the cache location is shared with setup_yaml, which reads the same task vars
+        args.setdefault('oci_blob_cache_dir', task_vars.get(
+            'metal_stack_release_vector_oci_blob_cache_dir', None))
+        args.setdefault('oci_blob_cache_max_size_mb', task_vars.get(
+            'metal_stack_release_vector_oci_blob_cache_max_size_mb', OciBlobCache.DEFAULT_MAX_SIZE // (1024 * 1024)))
+        return args
+
+    @staticmethod
+    def _merge(results, task_vars):
+        ansible_facts = {}
+
+        for data in results:
             for k, v in data.items():
                 if task_vars.get(k) is not None:
                     # skip if already defined, this allows users to provide overwrites
                     continue
 
                 if ansible_facts.get(k) is not None:
+                    if ansible_facts.get(k) == v:
+                        # vectors shared by several parents provide the same values
+                        continue
                     display.warning(
                         "variable %s was resolved more than once, using first defined value (%s)" % (k, ansible_facts.get(k)))
                     continue
 
                 ansible_facts[k] = v
 
-        result["ansible_facts"] = ansible_facts
+        return ansible_facts
+
+    @staticmethod
+    def _cache_key(templar, task_args, task_vars):
+        def mappings(vectors):
+            for vector in vectors:
+                path = vector.get('variable_mapping_path')
+                if path:
+                    try:
+                        yield path, dotted_path(task_vars, path)
+                    except (KeyError, TypeError):
+                        # the mapping may be provided by role defaults, which are
+                        # covered by the release vector digests
+                        pass
+                yield from mappings(vector.get('nested') or list())
+
+        # the mappings and replacements are templated like the arguments, such
+        # that the key does not depend on how the values were expressed
+        vectors = task_args.get('vectors')
+        normalized = dict(
+            vectors=vectors,
+            mappings=templar.template(dict(mappings(vectors))),
+            replacements=templar.template(task_vars.get(
+                'metal_stack_release_vector_replacements')),
+        )
 
-        if task_args.get('cache'):
-            with open(self._cache_file_path(), 'w') as vector:
-                vector.write(json.dumps(ansible_facts))
-                display.vvv("- Written cache file to %s" %
-                            self._cache_file_path)
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
-        return result
+    @staticmethod
+    def _cache_file_path(key):
+        return os.path.join(tempfile.gettempdir(), ActionModule.CACHE_DIR, key + ".json")
+
+    @staticmethod
+    def _read_cache(cache_key, task_args, task_vars, shared_loader_args=None):
+        path = ActionModule._cache_file_path(cache_key)
+
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        ttl = task_args.get('cache_ttl')
+        if ttl and time.time() - entry.get("created_at", 0) > ttl:
+            display.vvv("- Cache entry %s is expired" % path)
+            return None
+
+        if not ActionModule._overrides_hold(entry.get("sources", list()), task_vars):
+            display.vvv("- Cache entry %s depends on overrides that are no longer set" % path)
+            return None
+
+        if task_args.get('cache_revalidate') and not ActionModule._revalidate(task_args.get('vectors'), entry.get("sources", list()), shared_loader_args):
+            display.vvv("- Cache entry %s is outdated" % path)
+            return None
+
+        display.vvv("- Returning cache from %s" % path)
+        return entry.get("results")
+
+    @staticmethod
+    def _write_cache(cache_key, results, sources):
+        path = ActionModule._cache_file_path(cache_key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        entry = dict(
+            created_at=time.time(),
+            sources=sources,
+            results=results,
+        )
 
-    def _validate_module_args(self):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        display.vvv("- Written cache file to %s" % path)
+
+    @staticmethod
+    def _overrides_hold(sources, task_vars):
+        # skipped vectors did not contribute the variables that were overridden
+        # when the entry was written, so these need to be overridden still
+        return all(all(task_vars.get(k) is not None for k in source.get("overrides", list())) and
+                   ActionModule._overrides_hold(source.get("nested", list()), task_vars) for source in sources)
+
+    @staticmethod
+    def _revalidate(vectors, sources, shared_loader_args=None):
+        # compares the digests of the cached vectors with the current ones,
+        # vectors that cannot provide a digest are only expired through the ttl
+        # and entries are kept if the registry is not reachable
+        for vector, source in zip(vectors, sources):
+            if source.get("digest"):
+                loader_args = RemoteResolver.loader_args(vector.copy())
+                loader_args.update(shared_loader_args or dict())
+                try:
+                    digest = ContentLoader(
+                        source.get("url"), **loader_args).current_digest()
+                except Exception as e:
+                    display.vvv("- Unable to revalidate %s, keeping the cache entry: %s" %
+                                (source.get("url"), to_native(e)))
+                    digest = None
+                if digest is None:
+                    display.vvv("- No current digest for %s, keeping the cache entry" % source.get("url"))
+                elif digest != source.get("digest"):
+                    return False
+
+            if not ActionModule._revalidate(vector.get("nested") or list(), source.get("nested", list()), shared_loader_args):
+                return False
+
+        return True
+
+    @staticmethod
+    def argument_spec():
         common_vectors_argument_spec = dict(
             variable_mapping_path=dict(type='str', required=False),
             include_role_defaults=dict(type='str', required=False),
             install_roles=dict(type='bool', required=False, default=True),
+            reinstall_unstamped_roles=dict(type='bool', required=False),
             ansible_roles_path=dict(
                 type='str', required=False, default="ansible-roles"),
             role_aliases=dict(type='list', elements='dict', required=False, default=list(), options=dict(
@@ -138,10 +501,10 @@ class ActionModule(ActionBase):
 
         nested_vectors_argument_spec = dict(
             url_path=dict(type='str', required=True),
-            # we do not go into further depths here
-            nested=dict(type='list', elements='dict',
-                        required=False, default=list()),
         )
+        # nested vectors can be nested at any depth
+        nested_vectors_argument_spec["nested"] = dict(type='list', elements='dict', required=False, default=list(),
+                                                      options=nested_vectors_argument_spec)
         nested_vectors_argument_spec.update(common_vectors_argument_spec)
 
         vectors_options = dict(
@@ -151,29 +514,126 @@ class ActionModule(ActionBase):
         )
         vectors_options.update(common_vectors_argument_spec)
 
-        return self.validate_argument_spec(
-            argument_spec=dict(
-                cache=dict(type='bool', required=False, default=True),
-                vectors=dict(type='list', elements='dict',
-                             required=False, default=list(), options=vectors_options),
-            ))
+        return dict(
+            cache=dict(type='bool', required=False, default=True),
+            cache_ttl=dict(type='int', required=False),
+            cache_revalidate=dict(type='bool', required=False, default=True),
+            parallelism=dict(type='int', required=False, default=1),
+            trace_file=dict(type='str', required=False),
+            oci_layout=dict(type='str', required=False),
+            oci_layout_export=dict(type='str', required=False),
+            oci_registry_mirrors=dict(type='dict', required=False),
+            oci_registry_hedging=dict(type='bool', required=False, default=True),
+            http_cache=dict(type='bool', required=False, default=True),
+            git_mirror_cache=dict(type='bool', required=False, default=False),
+            role_defaults_cache=dict(type='bool', required=False, default=True),
+            oci_blob_cache=dict(type='bool', required=False, default=True),
+            oci_blob_cache_dir=dict(type='str', required=False),
+            oci_blob_cache_max_size_mb=dict(
+                type='int', required=False, default=OciBlobCache.DEFAULT_MAX_SIZE // (1024 * 1024)),
+            oci_cosign_verification_cache=dict(type='bool', required=False, default=False),
+            vectors=dict(type='list', elements='dict',
+                         required=False, default=list(), options=vectors_options),
+        )
 
-    @staticmethod
-    def _cache_file_path():
-        return os.path.join(tempfile.gettempdir(), ActionModule.CACHE_FILE)
+
+class Timings():
+    """
+    Records the wall-clock time and transferred bytes of the phases of a
+    module run per vector or role. Spans may be recorded concurrently.
+    """
+
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._spans = list()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase, item):
+        """
+        Records the enclosed block, the yielded dict takes the number of
+        transferred bytes.
+        """
+        span = dict(phase=phase, item=item, bytes=0,
+                    start=time.perf_counter(), thread=threading.get_ident())
+        try:
+            yield span
+        finally:
+            span["seconds"] = time.perf_counter() - span["start"]
+            with self._lock:
+                self._spans.append(span)
+
+    def report(self):
+        phases = dict()
+        items = dict()
+
+        with self._lock:
+            spans = list(self._spans)
+
+        for span in spans:
+            for t in [phases.setdefault(span["phase"], dict(seconds=0, bytes=0, count=0)),
+                      items.setdefault(span["item"], dict()).setdefault(span["phase"], dict(seconds=0, bytes=0, count=0))]:
+                t["seconds"] += span["seconds"]
+                t["bytes"] += span["bytes"]
+                t["count"] += 1
+
+        return dict(
+            seconds=time.perf_counter() - self._start,
+            phases=phases,
+            items=items,
+        )
+
+    def write_chrome_trace(self, path):
+        with self._lock:
+            spans = list(self._spans)
+
+        events = [dict(
+            name=span["phase"],
+            cat=span["item"],
+            ph="X",
+            ts=int((span["start"] - self._start) * 1e6),
+            dur=int(span["seconds"] * 1e6),
+            pid=os.getpid(),
+            tid=span["thread"],
+            args=dict(item=span["item"], bytes=span["bytes"]),
+        ) for span in spans]
+
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms"), f)
 
 
 class RemoteResolver():
+    ROLE_STAMP_FILE = ".metal-stack-release-vector.json"
+    ROLE_LOCK_TIMEOUT = 600
     _cached_role_defaults = dict()
-
-    def __init__(self, module, task_vars, task_args):
+    # the merged view on the cached role defaults, later included roles take precedence
+    _role_defaults = ChainMap()
+    _execute_module_lock = threading.Lock()
+    _role_path_locks = dict()
+    _role_path_locks_guard = threading.Lock()
+    _graph_lock = threading.Lock()
+
+    def __init__(self, module, task_vars, task_args, executor=None, shared_loader_args=None, graph=None):
         self._module = module
         self._task_vars = task_vars.copy()
-
+        self._executor = executor
+        self._shared_loader_args = shared_loader_args or dict()
+        # the resolvers of a run by vector, such that vectors shared by several parents are resolved once
+        self._graph = graph if graph is not None else dict()
+        self._path = tuple()
+        self._fetched = None
+        self._result = None
+        self._overrides = set()
+        self._lock = threading.Lock()
+
+        self._spec = json.dumps({k: v for k, v in task_args.items() if k not in ("url", "url_path")},
+                                sort_keys=True, default=str)
         task_args = task_args.copy()
 
+        # the url of a nested vector is looked up in its parent once it is needed
         self._url = task_args.pop("url", None)
-        if not self._url:
+        self._url_path = task_args.pop("url_path", None)
+        if not self._url and not self._url_path:
             raise ValueError("url is required")
 
         self._mapping_path = task_args.pop("variable_mapping_path", None)
@@ -188,8 +648,77 @@ class RemoteResolver():
             'metal_stack_release_vector_install_roles', True))
         self._ansible_roles_path = task_args.pop(
             'ansible_roles_path', "ansible-roles")
+        self._reinstall_unstamped_roles = task_args.pop('reinstall_unstamped_roles', None)
+        if self._reinstall_unstamped_roles is None:
+            self._reinstall_unstamped_roles = self._task_vars.get(
+                'metal_stack_release_vector_reinstall_unstamped_roles', False)
+
+        self._own_loader_args = self.loader_args(task_args)
+        self._role_defaults_cache = self._shared_loader_args.get("role_defaults_cache")
+        self._timings = self._shared_loader_args.get("timings") or Timings()
+        self._digest = None
+
+        if task_args:
+            raise ValueError("unknown parameters used for %s: %s" %
+                             (self._url or self._url_path, task_args.keys()))
+
+        if self._url:
+            self._set_url(self._url, self._shared_loader_args)
+            self._path = (self._url,)
+
+        self._children = list()
+        for n in self._nested:
+            if not n.get("url_path"):
+                raise ValueError("nested entries must contain an url_path")
+            n = {k: v for k, v in n.items() if k != "url"}
+            self._children.append(RemoteResolver(
+                module=self._module, task_vars=self._task_vars, task_args=n, executor=self._executor,
+                shared_loader_args=self._shared_loader_args, graph=self._graph))
+
+    def _set_url(self, url, shared_loader_args):
+        self._url = url
+
+        if self._url.startswith(ContentLoader.OCI_LAYOUT_PREFIX):
+            # nested vectors and roles are read from the same layout
+            path, _ = ContentLoader.parse_oci_layout_url(self._url)
+            shared_loader_args = dict(shared_loader_args, oci_layout=OciLayout.open(path))
+
+        self._shared_loader_args = shared_loader_args
+        self._loader_args = dict(self._own_loader_args, **shared_loader_args)
+
+    def canonical(self):
+        """
+        Returns the resolver of the run for the same vector and arguments.
+        """
+        key = (self._url, self._spec, id(self._shared_loader_args.get("oci_layout")))
+        with RemoteResolver._graph_lock:
+            return self._graph.setdefault(key, self)
+
+    def _locate(self, i, content):
+        # looks up the url of a nested vector in the content of its parent
+        child = self._children[i]
+        if child._url is not None:
+            return child
+
+        try:
+            url = dotted_path(content, child._url_path)
+        except KeyError as e:
+            raise KeyError(
+                """url_path "%s" does not exist in %s""" % (child._url_path, self._url)) from e
 
-        self._loader_args = dict(
+        if url in self._path:
+            raise ValueError("release vector %s is nested in itself: %s" %
+                             (url, " -> ".join(self._path + (url,))))
+
+        child._set_url(url, self._shared_loader_args)
+        child._path = self._path + (url,)
+
+        self._children[i] = child = child.canonical()
+        return child
+
+    @staticmethod
+    def loader_args(task_args):
+        return dict(
             oci_registry_username=task_args.pop(
                 "oci_registry_username", None),
             oci_registry_password=task_args.pop(
@@ -204,26 +733,118 @@ class RemoteResolver():
                 "oci_cosign_verify_key", None),
         )
 
-        if task_args:
-            raise ValueError("unknown parameters used for %s: %s" %
-                             (self._url, task_args.keys()))
+    def source(self):
+        # the origin of the resolved content, used for revalidating cache entries,
+        # vectors that were not fetched record the overridden variables they depend on
+        return dict(
+            url=self._url,
+            digest=self._digest,
+            overrides=sorted(self._overrides),
+            nested=[child.source() for child in self._children],
+        )
 
-    def resolve(self):
+    def prefetch(self):
+        # schedules the download of this vector on the executor, nested vectors
+        # are scheduled as soon as their parent was downloaded
+        with self._lock:
+            if self._executor and self._fetched is None:
+                self._fetched = self._executor.submit(self._fetch)
+
+    def demand(self, final=False):
+        """
+        Returns whether this vector needs to be fetched, because it installs roles
+        or can provide a variable that is not overridden in the task vars (itself
+        or through its nested vectors).
+
+        None is returned as long as a mapping may still come from role defaults
+        that are not included yet, final demands include the role defaults and are
+        only determined in the order of resolution. Exported layouts contain all
+        vectors, such that sites with other overrides can resolve them offline.
+        """
+        if self._install_roles or self._shared_loader_args.get("oci_layout_export"):
+            return True
+
+        if self._mapping_path:
+            try:
+                if final:
+                    self._load_role_default_vars()
+                elif self._include_role_defaults:
+                    return None
+                mapping = dotted_path(
+                    ChainMap(*RemoteResolver._role_defaults.maps, self._task_vars), self._mapping_path)
+                overrides = {k for k in mapping if self._task_vars.get(k) is not None}
+            except Exception:
+                # errors are raised once the vector is resolved
+                return True if final else None
+
+            if len(overrides) < len(mapping):
+                return True
+
+        demand = False
+        for child in self._children:
+            d = child.demand(final=final)
+            if d:
+                return True
+            if d is None:
+                demand = None
+
+        return demand
+
+    def _skip(self):
+        # records the overridden variables of a vector that is not fetched
+        if self._mapping_path:
+            self._overrides.update(dotted_path(
+                ChainMap(*RemoteResolver._role_defaults.maps, self._task_vars), self._mapping_path))
+
+        for child in self._children:
+            child._skip()
+
+    def _fetch(self):
         # download release vector
-        content = ContentLoader(self._url, **self._loader_args).load()
+        loader = ContentLoader(self._url, **self._loader_args)
+        content = loader.load()
+        self._digest = loader.digest
 
         # apply replacements
         for r in self._replacements:
             if r.get("key") is None or r.get("old") is None or r.get("new") is None:
                 raise ValueError(
                     "replace must contain and dict with the keys for 'key', 'old' and 'new'")
-            self.replace_key_value(content, r.get(
-                "key"), r.get("old"), r.get("new"))
+        if self._replacements:
+            with self._timings.span("replace", self._url):
+                replace_key_values(content, self._replacements)
+
+        # nested vectors known to be needed are downloaded along with their parent,
+        # the others are decided on when the parent is resolved
+        if self._executor:
+            for i, child in enumerate(self._children):
+                if child.demand() is True:
+                    self._locate(i, content).prefetch()
+
+        return content
+
+    def resolve(self):
+        # vectors shared by several parents are resolved once
+        if self._result is None:
+            self._result = self._resolve()
+        return self._result
+
+    def _resolve(self):
+        # the vector is not fetched at all if it can not contribute any variable
+        if not self.demand(final=True):
+            display.vvv("- Skipping %s, all variables it provides are overridden" % (self._url or self._url_path))
+            self._skip()
+            return dict()
+
+        if self._fetched is None:
+            content = self._fetch()
+        else:
+            content = self._fetched.result()
 
         # setup ansible-roles of release vector
         if self._install_roles:
             try:
-                role_dict = self.dotted_path(
+                role_dict = dotted_path(
                     content, self._ansible_roles_path)
             except KeyError as e:
                 raise AnsibleError("given ansible-roles path %s not found in %s" %
@@ -238,36 +859,35 @@ class RemoteResolver():
         if self._mapping_path:
             # find mapping_path in variable sources (task_vars and role default vars)
             try:
-                mapping = self.dotted_path(
-                    self._task_vars | self._load_role_default_vars(), self._mapping_path)
+                with self._timings.span("role_defaults", self._url):
+                    role_defaults = self._load_role_default_vars()
+                mapping = dotted_path(
+                    ChainMap(*role_defaults.maps, self._task_vars), self._mapping_path)
             except KeyError as e:
                 raise KeyError(
                     "no mapping found in any variables at %s" % self._mapping_path) from e
 
+            with self._timings.span("mapping", self._url):
+                mapping = VariableMapping.compile(mapping)
+                values, missing = mapping.resolve(content)
+
             for k, path in mapping.items():
-                try:
-                    value = self.dotted_path(content, path)
-                except KeyError:
+                if k in missing:
                     display.warning(
                         """path %s provided by mapping does not exist in %s""" % (path, self._url))
                     continue
 
-                result[k] = value
+                result[k] = values[k]
 
-        # resolve nested vectors
-        for n in self._nested:
-            path = n.pop("url_path", None)
-            if not path:
-                raise ValueError("nested entries must contain an url_path")
+        # resolve nested vectors, the needed ones are downloaded concurrently first
+        for i, child in enumerate(self._children):
+            if child.demand() is True:
+                self._locate(i, content).prefetch()
 
-            try:
-                n["url"] = self.dotted_path(content, path)
-            except KeyError as e:
-                raise KeyError(
-                    """url_path "%s" does not exist in %s""" % (path, self._url)) from e
-
-            results = RemoteResolver(
-                module=self._module, task_vars=self._task_vars, task_args=n).resolve()
+        for i, child in enumerate(self._children):
+            if child.demand(final=True):
+                child = self._locate(i, content)
+            results = child.resolve()
 
             for k, v in results.items():
                 if result.get(k) is not None:
@@ -278,146 +898,321 @@ class RemoteResolver():
         return result
 
     def _install_ansible_roles(self, role_dict, **kwargs):
-        for role_name, spec in role_dict.items():
-            role_ref = spec.get("oci")
-            role_repository = spec.get("repository")
-            prefix_filter = None
-
-            # lookup aliases
-            for alias in self._role_aliases:
-                if alias.get("name") == role_name:
-                    new_role_name = alias.get("alias")
-                    prefix_filter = OciLoader.prefix_filter(
-                        role_name, new_role_name)
-                    role_name = new_role_name
-                    break
+        if role_dict and C.DEFAULT_ROLES_PATH:
+            # create the roles path upfront, otherwise concurrent extractions
+            # race for creating it
+            os.makedirs(C.DEFAULT_ROLES_PATH[0], exist_ok=True)
+
+        futures = [(role_name, self._submit(self._timed_install_ansible_role, role_name, spec, **kwargs))
+                   for role_name, spec in role_dict.items()]
+
+        errors = []
+        for role_name, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append("%s: %s" % (role_name, to_native(e)))
+
+        if errors:
+            raise AnsibleError("error installing ansible roles:\n%s" %
+                               "\n".join(errors))
+
+    def _timed_install_ansible_role(self, role_name, spec, **kwargs):
+        with self._timings.span("role_install", role_name):
+            return self._install_ansible_role(role_name, spec, **kwargs)
+
+    def _install_ansible_role(self, role_name, spec, **kwargs):
+        git_mirror_cache = kwargs.pop("git_mirror_cache", None)
+        role_ref = spec.get("oci")
+        role_repository = spec.get("repository")
+        prefix_filter = None
+
+        # lookup aliases
+        for alias in self._role_aliases:
+            if alias.get("name") == role_name:
+                new_role_name = alias.get("alias")
+                prefix_filter = OciLoader.prefix_filter(
+                    role_name, new_role_name)
+                role_name = new_role_name
+                break
 
-            role_version = spec.get("version")
+        role_version = spec.get("version")
 
-            # check for overwritten role version
-            role_version_overwrite = self._task_vars.get(
-                role_name.replace("-", "_").lower() + "_version")
-            if role_version_overwrite:
-                role_version = role_version_overwrite
+        # check for overwritten role version
+        role_version_overwrite = self._task_vars.get(
+            role_name.replace("-", "_").lower() + "_version")
+        if role_version_overwrite:
+            role_version = role_version_overwrite
 
-            if not role_version:
-                raise ValueError("no version specified for role " + role_name)
+        if not role_version:
+            raise ValueError("no version specified for role " + role_name)
 
-            if not C.DEFAULT_ROLES_PATH:
-                raise AnsibleError("no default roles path configured")
-            role_path = os.path.join(C.DEFAULT_ROLES_PATH[0], role_name)
+        if not C.DEFAULT_ROLES_PATH:
+            raise AnsibleError("no default roles path configured")
+        role_path = os.path.join(C.DEFAULT_ROLES_PATH[0], role_name)
 
-            if not role_ref and not role_repository:
-                display.display(
-                    "- %s has no oci ref nor repository defined, skipping" % (role_name), color=C.COLOR_SKIP)
-                continue
+        if not role_ref and not role_repository:
+            display.display(
+                "- %s has no oci ref nor repository defined, skipping" % (role_name), color=C.COLOR_SKIP)
+            return
+
+        source = role_ref if role_ref else role_repository
+        stamp = dict(version=role_version, source=source)
 
+        # roles may end up in the same path (e.g. through aliases or in other forks),
+        # so only one worker may install into a role path at a time, the installed
+        # role is inspected only after the lock was acquired
+        with RemoteResolver._role_path_lock(role_path):
             if os.path.isdir(role_path):
-                display.display("- %s already installed in %s, skipping" %
-                                (role_name, role_path), color=C.COLOR_SKIP)
-                continue
+                installed = self._read_role_stamp(role_path)
+                if installed is None and not self._reinstall_unstamped_roles:
+                    display.warning("%s in %s has no installation stamp and is not updated to %s, roles installed by "
+                                    "earlier versions of this module are reinstalled once with reinstall_unstamped_roles" %
+                                    (role_name, role_path, role_version))
+                    self._export_role(role_name, role_ref, role_version, **kwargs)
+                    return
+
+                if installed is None:
+                    installed = dict()
+
+                if installed.get("version") == role_version and installed.get("source") == source:
+                    # a moved tag is detected through the manifest digest, if the registry
+                    # is not reachable the installed role is kept, a version pinned to the
+                    # installed digest can not move
+                    digest = None
+                    if role_ref and role_version != installed.get("digest"):
+                        digest = OciLoader(url=role_ref + ":" + role_version,
+                                           media_type=OciLoader.ANSIBLE_ROLE_MEDIA_TYPE, **kwargs).current_digest()
+
+                    if digest is None or digest == installed.get("digest"):
+                        display.display("- %s (%s) already installed in %s, skipping" %
+                                        (role_name, role_version, role_path), color=C.COLOR_SKIP)
+                        self._export_role(role_name, role_ref, role_version, **kwargs)
+                        return
 
             display.display("- Installing %s (%s) from %s to %s" % (role_name, role_version,
-                            role_ref if role_ref else role_repository, role_path), color=C.COLOR_CHANGED)
+                            source, role_path), color=C.COLOR_CHANGED)
 
-            if role_ref:
-                OciLoader(url=role_ref + ":" + role_version,
-                          media_type=OciLoader.ANSIBLE_ROLE_MEDIA_TYPE,
-                          tar_dest=os.path.dirname(role_path), dest_filter=prefix_filter, **kwargs).load()
-            else:
-                module_result = self._module._execute_module(module_name='ansible.builtin.git', module_args={
-                    'repo': role_repository,
-                    'dest': role_path,
-                    'depth': 1,
-                    'version': role_version,
-                }, task_vars=self._task_vars, tmp=None)
-
-                if module_result.get('failed'):
-                    msg = module_result.get('module_stderr')
-                    if not msg:
-                        msg = module_result.get('module_stdout')
-                    if not msg:
-                        msg = module_result.get('msg')
-                    raise AnsibleError(msg)
+            # the role is staged next to its destination and renamed into place, such
+            # that an interrupted installation never leaves a partially installed role
+            staging_dir = tempfile.mkdtemp(
+                prefix=".%s-" % role_name, dir=os.path.dirname(role_path))
+            try:
+                staged_path = os.path.join(staging_dir, role_name)
+
+                if role_ref:
+                    loader = OciLoader(url=role_ref + ":" + role_version,
+                                       media_type=OciLoader.ANSIBLE_ROLE_MEDIA_TYPE,
+                                       tar_dest=staging_dir, dest_filter=prefix_filter, **kwargs)
+                    loader.load()
+                    stamp["digest"] = loader.digest
+                elif kwargs.get("oci_layout_export"):
+                    raise AnsibleError("git repositories can not be exported into an oci layout")
+                else:
+                    # versions with git submodules are not exported from the mirror
+                    commit = None
+                    if git_mirror_cache and git_mirror_cache.available():
+                        commit = git_mirror_cache.export(role_repository, role_version, staged_path)
+                    if commit is None:
+                        commit = self._clone_role(role_repository, role_version, staged_path)
+                    stamp["digest"] = commit
+
+                if not os.path.isdir(staged_path):
+                    raise AnsibleError("%s does not contain the role %s" % (source, role_name))
+
+                with open(os.path.join(staged_path, RemoteResolver.ROLE_STAMP_FILE), "w") as f:
+                    json.dump(stamp, f)
+
+                # whatever is in place is moved aside, also when it was put there by
+                # something not honoring the lock (e.g. ansible-galaxy)
+                if os.path.lexists(role_path):
+                    os.rename(role_path, os.path.join(staging_dir, ".previous"))
+                os.rename(staged_path, role_path)
+            finally:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def _clone_role(self, repository, version, dest):
+        # the module execution shares the connection and its remote tmp dir,
+        # so it must not run concurrently
+        with RemoteResolver._execute_module_lock:
+            module_result = self._module._execute_module(module_name='ansible.builtin.git', module_args={
+                'repo': repository,
+                'dest': dest,
+                'depth': 1,
+                'version': version,
+            }, task_vars=self._task_vars, tmp=None)
+
+        if module_result.get('failed'):
+            msg = module_result.get('module_stderr')
+            if not msg:
+                msg = module_result.get('module_stdout')
+            if not msg:
+                msg = module_result.get('msg')
+            raise AnsibleError(msg)
+
+        return module_result.get('after')
 
-    def _load_role_default_vars(self):
-        defaults = dict()
+    @staticmethod
+    def _export_role(role_name, role_ref, role_version, **kwargs):
+        if not kwargs.get("oci_layout_export"):
+            return
 
-        cached_roles = RemoteResolver._cached_role_defaults
+        if not role_ref:
+            raise AnsibleError("%s is installed from a git repository, which can not be exported into an oci layout" % role_name)
 
-        for role_name, cached_defaults in cached_roles.items():
-            defaults = defaults | cached_defaults
+        OciLoader(url=role_ref + ":" + role_version,
+                  media_type=OciLoader.ANSIBLE_ROLE_MEDIA_TYPE, **kwargs).export()
 
+    @staticmethod
+    def _read_role_stamp(role_path):
+        try:
+            with open(os.path.join(role_path, RemoteResolver.ROLE_STAMP_FILE)) as f:
+                stamp = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # a broken stamp leads to a reinstallation
+            return dict()
+
+        return stamp if isinstance(stamp, dict) else dict()
+
+    def _submit(self, fn, *args, **kwargs):
+        if self._executor:
+            return self._executor.submit(fn, *args, **kwargs)
+
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    @staticmethod
+    @contextmanager
+    def _role_path_lock(role_path):
+        """
+        Holds an exclusive lock on a role path across the threads of this process
+        and across other processes, e.g. forks installing the same roles.
+        """
+        with RemoteResolver._role_path_locks_guard:
+            lock = RemoteResolver._role_path_locks.setdefault(role_path, threading.Lock())
+
+        path = os.path.join(os.path.dirname(role_path), ".%s.lock" % os.path.basename(role_path))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with lock, open(path, "a") as f:
+            deadline = time.monotonic() + RemoteResolver.ROLE_LOCK_TIMEOUT
+
+            while True:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        raise AnsibleError("timed out waiting for another worker installing into %s" % role_path)
+                    time.sleep(0.05)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _load_role_default_vars(self):
         role_name = self._include_role_defaults
 
-        if not role_name or role_name in cached_roles:
-            return defaults
+        if not role_name or role_name in RemoteResolver._cached_role_defaults:
+            return RemoteResolver._role_defaults
 
         i = RoleInclude.load(role_name, play=self._module._task.get_play(),
                              current_role_path=self._module._task.get_path(),
                              variable_manager=self._module._task.get_variable_manager(),
                              loader=self._module._task.get_loader(), collection_list=None)
 
-        included_defaults = Role().load(
-            role_include=i, play=self._module._task.get_play()).get_default_vars()
-
-        cached_roles[role_name] = included_defaults
-        defaults = defaults | included_defaults
+        role_path = os.path.realpath(i.get_role_path())
 
-        RemoteResolver._cached_role_defaults = cached_roles
+        included_defaults = None
+        if self._role_defaults_cache:
+            included_defaults = self._role_defaults_cache.get(role_path)
 
-        return defaults
+        if included_defaults is None:
+            role = Role().load(role_include=i, play=self._module._task.get_play())
+            included_defaults = role.get_default_vars()
 
-    @staticmethod
-    def dotted_path(vector, path):
-        value = vector
-        for p in path.split("."):
-            value = value[p]
-        return value
-
-    @staticmethod
-    def replace_key_value(data, key, old, new):
-        if not isinstance(data, dict):
-            return
+            if self._role_defaults_cache:
+                self._role_defaults_cache.put(role_path, included_defaults, [role_path] + [
+                    dep.get_role_path() for dep in role.get_all_dependencies()])
 
-        if key in data:
-            to_replace = data[key]
-            if isinstance(to_replace, str):
-                data[key] = to_replace.replace(old, new)
-                if data[key] != to_replace:
-                    display.vvv("- Replaced value %s with %s" %
-                                (to_replace, data[key]))
+        RemoteResolver._cached_role_defaults[role_name] = included_defaults
+        RemoteResolver._role_defaults.maps.insert(0, included_defaults)
 
-        for _, v in data.items():
-            if isinstance(v, dict):
-                RemoteResolver.replace_key_value(v, key, old, new)
+        return RemoteResolver._role_defaults
 
 
 class ContentLoader():
     OCI_PREFIX = "oci://"
+    OCI_LAYOUT_PREFIX = "oci-layout://"
 
     def __init__(self, url, **kwargs):
-        if url.startswith(self.OCI_PREFIX):
+        self._blob_cache = kwargs.get("oci_blob_cache")
+        self._timings = kwargs.get("timings") or Timings()
+
+        if url.startswith(self.OCI_LAYOUT_PREFIX):
+            path, ref = self.parse_oci_layout_url(url)
+            kwargs["oci_layout"] = OciLayout.open(path)
+            self._loader = OciLoader(ref, **kwargs)
+        elif url.startswith(self.OCI_PREFIX):
             self._loader = OciLoader(url[len(self.OCI_PREFIX):], **kwargs)
         else:
             self._loader = UrlLoader(url, **kwargs)
 
+    @property
+    def digest(self):
+        return self._loader.digest
+
+    @staticmethod
+    def parse_oci_layout_url(url):
+        # oci-layout://<path to directory or tarball>#<reference>
+        path, _, ref = url[len(ContentLoader.OCI_LAYOUT_PREFIX):].partition("#")
+        if not path or not ref:
+            raise ValueError("oci layout url %s needs to be of the form oci-layout://<path>#<reference>" % url)
+        return path, ref
+
     def load(self) -> dict:
         display.display("- Loading remote content from %s" %
                         self._loader._url, color=C.COLOR_OK)
         raw = self._loader.load()
-        return safe_load(raw)
+
+        with self._timings.span("parse", self._loader._url) as span:
+            span["bytes"] = len(raw)
+            return load_yaml(raw, self._blob_cache)
+
+    def current_digest(self):
+        return self._loader.current_digest()
 
 
 class UrlLoader():
-    def __init__(self, url, **_):
+    def __init__(self, url, http_cache=None, timings=None, **_):
         self._url = url
+        self._http_cache = http_cache
+        self._timings = timings or Timings()
+        self.digest = None
 
     def load(self):
-        return open_url(self._url).read()
+        with self._timings.span("download", self._url) as span:
+            if self._http_cache:
+                content = self._http_cache.open_url(self._url)
+            else:
+                content = open_url(self._url).read()
+            span["bytes"] = len(content)
+            return content
+
+    def current_digest(self):
+        return None
 
 
 class OciLoader():
+    CHUNK_SIZE = 1024 * 1024
+    SPOOL_MAX_SIZE = 16 * 1024 * 1024
     RELEASE_VECTOR_MEDIA_TYPE = "application/vnd.metal-stack.release-vector.v1.tar+gzip"
     ANSIBLE_ROLE_MEDIA_TYPE = "application/vnd.metal-stack.ansible-role.v1.tar+gzip"
 
@@ -438,98 +1233,311 @@ class OciLoader():
         self._cosign_issuer = kwargs.pop(
             "oci_cosign_verify_certificate_oidc_issuer", None)
         self._cosign_key = kwargs.pop("oci_cosign_verify_key", None)
+        self._blob_cache = kwargs.pop("oci_blob_cache", None)
+        self._client_pool = kwargs.pop("oci_client_pool", None)
+        self._registry_mirrors = kwargs.pop("oci_registry_mirrors", None)
+        self._cosign_verifier = kwargs.pop(
+            "oci_cosign_verifier", None) or CosignVerifier()
+        kwargs.pop("http_cache", None)
+        kwargs.pop("git_mirror_cache", None)
+        kwargs.pop("role_defaults_cache", None)
+        self._timings = kwargs.pop("timings", None) or Timings()
+        self._oci_layout = kwargs.pop("oci_layout", None)
+        self._oci_layout_export = kwargs.pop("oci_layout_export", None)
+        self._manifest_raw = None
+        self.digest = None
 
         if kwargs:
             raise ValueError("unknown parameters passed to oci loader: %s" %
                              kwargs.keys())
 
     def load(self):
+        blob, verification = self._fetch_layer()
+
+        with blob:
+            with self._timings.span("cosign_wait", self._url):
+                verification.result()
+
+            if self._oci_layout_export:
+                self._oci_layout_export.put_manifest(self._url, self._manifest_raw, self.digest)
+
+            # layers that are not cached are streamed, so their transfer is part of the extraction
+            with self._timings.span("extract", self._url) as span:
+                if self._media_type == OciLoader.ANSIBLE_ROLE_MEDIA_TYPE:
+                    if not self._dest:
+                        raise ValueError("tar destination must be specified")
+                    result = self._extract_tar_gzip(blob, dest=self._dest, filter=self._dest_filter)
+                    if isinstance(blob, VerifiedBlob):
+                        # roles are extracted into a staging directory, which is
+                        # discarded if the digest does not match
+                        blob.drain()
+                    return result
+                else:
+                    content = self._extract_tar_gzip_file(blob, member=self._member)
+                    if isinstance(blob, VerifiedBlob):
+                        # the digest can only be verified after reading the remainder of the layer,
+                        # layers streamed from a registry stop at the release vector instead and
+                        # are only verified when they are stored in the oci cache
+                        blob.drain()
+                    span["bytes"] = len(content)
+                    return content
+
+    def export(self):
+        """
+        Adds the artifact to the oci layout export without extracting it.
+        """
+        blob, verification = self._fetch_layer()
+
+        with blob:
+            verification.result()
+            self._oci_layout_export.put_manifest(self._url, self._manifest_raw, self.digest)
+
+    def _fetch_layer(self):
+        # returns the layer blob and the future of its cosign verification
+        if self._oci_layout:
+            return self._fetch_layer_from_layout()
+
         if not HAS_OPENCONTAINERS:
             raise ImportError(
                 "opencontainers must be installed in order to resolve metal-stack oci release vectors")
 
-        try:
-            bin_path = process.get_bin_path(
-                "cosign", required=True, opt_dirs=None)
+        endpoints = self._endpoints()
+        with self._timings.span("manifest", self._url) as span:
+            # manifests are small, so slow registries are hedged against the next one
+            endpoint, (self._manifest_raw, self.digest, span["bytes"]) = self._call(
+                endpoints, self._fetch_manifest, hedge=True)
+        manifest = json.loads(self._manifest_raw)
 
-            if self._cosign_key:
-                subprocess.run(args=[bin_path, "verify", "--key", "env://PUBKEY", self._url],
-                               env=dict(PUBKEY=self._cosign_key), check=True, capture_output=True)
-                display.display(
-                    "- %s was verified successfully by public key through cosign" % self._url, color=C.COLOR_OK)
-            elif self._cosign_identity or self._cosign_issuer:
-                subprocess.run(args=[bin_path, "verify", "--certificate-oidc-issuer", self._cosign_issuer,
-                                     "--certificate-identity", self._cosign_identity, self._url],
-                               check=True, capture_output=True)
-                display.display(
-                    "- %s was verified successfully by oidc-issuer through cosign" % self._url, color=C.COLOR_OK)
-        except ValueError as e:
-            raise FileNotFoundError("cosign needs to be installed: %s" %
-                                    to_native(e.message)) from e
-        except subprocess.CalledProcessError as e:
-            raise RuntimeError("cosign verification returned with exit code %s: %s" % (
-                e.returncode, to_native(e.stderr))) from e
+        if endpoint[0] != self._registry:
+            display.vvv("- Pulling %s from mirror %s" % (self._url, endpoint[0]))
 
-        blob = self._download_blob()
+        # the blobs are pulled from the registry that served the manifest first
+        endpoints = [endpoint] + [e for e in endpoints if e is not endpoint]
 
-        if self._media_type == OciLoader.ANSIBLE_ROLE_MEDIA_TYPE:
-            if not self._dest:
-                raise ValueError("tar destination must be specified")
-            return self._extract_tar_gzip(blob, dest=self._dest, filter=self._dest_filter)
-        else:
-            return self._extract_tar_gzip_file(blob, member=self._member)
+        # the verification runs in the background while the layer is downloaded,
+        # the layer is only extracted after a successful verification
+        verification = self._cosign_verifier.verify(
+            self._digest_ref(), key=self._cosign_key, identity=self._cosign_identity, issuer=self._cosign_issuer)
 
-    def _download_blob(self):
-        opts = [WithDefaultName(self._namespace)]
-        if self._username and self._password:
-            opts.append(WithUsernamePassword(
-                username=self._username, password=self._password))
+        with self._timings.span("download", self._url) as span:
+            _, blob = self._call(endpoints, lambda client: self._download_layer(client, manifest, span, endpoints))
+
+        if self._oci_layout_export:
+            with self._timings.span("export", self._url):
+                try:
+                    config = manifest.get("config")
+                    if config:
+                        _, content = self._call(endpoints, lambda client: self._fetch_blob(client, config["digest"]))
+                        self._oci_layout_export.put_blob(config["digest"], io.BytesIO(content)).close()
+                    blob = self._oci_layout_export.put_blob(self._find_layer(manifest)["digest"], blob)
+                except Exception:
+                    blob.close()
+                    raise
 
-        client = NewClient(self._registry,
-                           *opts
-                           )
+        return blob, verification
 
+    def _fetch_layer_from_layout(self):
+        with self._timings.span("manifest", self._url) as span:
+            self._manifest_raw, self.digest = self._oci_layout.manifest(self._url)
+            span["bytes"] = len(self._manifest_raw)
+
+        if self._cosign_key or self._cosign_identity or self._cosign_issuer:
+            # the signatures are not part of the layout, so the policy can not be enforced
+            raise RuntimeError("%s can not be verified with cosign when read from an oci layout, "
+                               "the layout is verified when it is exported" % self._url)
+
+        target = self._find_layer(json.loads(self._manifest_raw))
+
+        with self._timings.span("download", self._url) as span:
+            blob = self._oci_layout.open_blob(target["digest"], size=target.get("size"))
+            span["bytes"] = target.get("size", 0)
+
+        verification = Future()
+        verification.set_result(None)
+
+        return blob, verification
+
+    def _find_layer(self, manifest):
+        for layer in manifest["layers"]:
+            if layer["mediaType"] == self._media_type:
+                return layer
+
+        raise RuntimeError("no layer with media type %s found in oci artifact %s" % (
+            self._media_type,  self._url))
+
+    def _fetch_blob(self, client, digest):
         req = client.NewRequest(
             "GET",
-            "/v2/<name>/manifests/<reference>",
-            WithReference(self._version),
-        ).SetHeader("Accept", opencontainersv1.MediaTypeImageManifest)
+            "/v2/<name>/blobs/<digest>",
+            WithDigest(digest),
+        )
 
         try:
-            response = client.Do(req)
-            response.raise_for_status()
+            response = BlobDownload.with_retries(lambda: BlobDownload.checked(client.Do(req)), self._url)
         except Exception as e:
             raise RuntimeError(
-                "the download of the release vector raised an error: %s" % to_native(e)) from e
+                "the download of blob %s of %s raised an error: %s" % (digest, self._url, to_native(e))) from e
 
-        manifest = response.json()
+        return response.content
 
-        target = None
-        for layer in manifest["layers"]:
-            if layer["mediaType"] == self._media_type:
-                target = layer
-                break
+    def _digest_ref(self):
+        # verifying by digest guarantees the verified artifact is the downloaded one
+        # and makes the verification result reusable
+        return "%s@%s" % (self._url.rsplit(":", maxsplit=1)[0], self.digest)
 
-        if not target:
-            raise RuntimeError("no layer with media type %s found in oci artifact %s" % (
-                self._media_type,  self._url))
+    def _client(self):
+        if not HAS_OPENCONTAINERS:
+            raise ImportError(
+                "opencontainers must be installed in order to resolve metal-stack oci release vectors")
+
+        if self._client_pool:
+            return self._client_pool.get(self._registry, self._namespace, self._username, self._password)
+
+        return OciClient(self._registry, self._namespace, self._username, self._password)
+
+    def _endpoints(self):
+        # the registries to pull from in the order they are tried, as tuples of registry and client
+        if self._registry_mirrors:
+            return self._registry_mirrors.endpoints(self._registry, self._namespace, self._username, self._password)
+        return [(self._registry, self._client())]
+
+    def _call(self, endpoints, fn, hedge=False):
+        if self._registry_mirrors:
+            return self._registry_mirrors.call(endpoints, fn, hedge=hedge)
+        return endpoints[0], fn(endpoints[0][1])
+
+    def _fetch_manifest(self, client):
+        # returns the raw manifest, its digest and the number of downloaded bytes
+        if self._blob_cache:
+            # a cheap head request tells whether the tag still points to a cached manifest
+            digest = self._manifest_digest(client)
+            if digest:
+                manifest = self._blob_cache.get_manifest(digest)
+                if manifest is not None:
+                    display.vvv("- Using cached manifest %s for %s" %
+                                (digest, self._url))
+                    return manifest, digest, 0
 
         req = client.NewRequest(
             "GET",
-            "/v2/<name>/blobs/<digest>",
-            WithDigest(target['digest']),
-        )
+            "/v2/<name>/manifests/<reference>",
+            WithReference(self._version),
+        ).SetHeader("Accept", opencontainersv1.MediaTypeImageManifest)
 
-        req.stream = True
+        try:
+            response = BlobDownload.with_retries(lambda: BlobDownload.checked(client.Do(req)), self._url)
+        except Exception as e:
+            raise RuntimeError(
+                "the download of the release vector raised an error: %s" % to_native(e)) from e
+
+        manifest = response.content
+        digest = "sha256:" + hashlib.sha256(manifest).hexdigest()
+
+        # mirrors are not trusted to serve the content of the digest they claim,
+        # the digest is what cosign verifies against the upstream registry
+        header = response.headers.get("Docker-Content-Digest")
+        if header and header.startswith("sha256:") and header != digest:
+            raise RuntimeError("manifest of %s does not match its digest %s" % (self._url, header))
+        digest = header or digest
+
+        if self._blob_cache:
+            self._blob_cache.put_manifest(digest, manifest)
+
+        return manifest, digest, len(manifest)
+
+    def _download_layer(self, client, manifest, span=None, endpoints=None):
+        target = self._find_layer(manifest)
+
+        if self._blob_cache:
+            blob = self._blob_cache.open_blob(target['digest'])
+            if blob is not None:
+                display.vvv("- Using cached blob %s for %s" %
+                            (target['digest'], self._url))
+                return blob
+
+        # retries and interrupted transfers are continued at the next registry in line,
+        # such that a mirror breaking off in the middle of a layer does not fail the download
+        endpoints = endpoints or list()
+        registries = [e for e in endpoints if e[1] is client] or [(self._registry, client)]
+        registries += [e for e in endpoints if e[1] is not client]
+        attempts = [0]
+
+        def open_response(headers):
+            registry, registry_client = registries[attempts[0] % len(registries)]
+            if attempts[0] and len(registries) > 1:
+                display.vvv("- Continuing download of %s from %s" % (self._url, registry))
+            attempts[0] += 1
+
+            req = registry_client.NewRequest(
+                "GET",
+                "/v2/<name>/blobs/<digest>",
+                WithDigest(target['digest']),
+            )
+            for k, v in headers.items():
+                req.SetHeader(k, v)
+            req.stream = True
+            return registry_client.Do(req)
 
         try:
-            blob = client.Do(req)
-            blob.raise_for_status()
+            # the layer is streamed and never held in memory as a whole
+            blob = BlobDownload(open_response, target['digest'], size=target.get('size'), name=self._url)
         except Exception as e:
             raise RuntimeError(
                 "the download of the release vector layer raised an error: %s" % to_native(e)) from e
 
-        return blob.content
+        if span is not None:
+            span["bytes"] = target.get("size", 0)
+
+        if self._blob_cache:
+            with blob:
+                return self._blob_cache.put_blob(target['digest'], blob)
+
+        if self._media_type == OciLoader.ANSIBLE_ROLE_MEDIA_TYPE:
+            # role tarballs are spooled to disk when they get large, such that
+            # the connection is not held open during the extraction
+            spool = tempfile.SpooledTemporaryFile(
+                max_size=OciLoader.SPOOL_MAX_SIZE)
+            with blob:
+                shutil.copyfileobj(blob, spool, OciLoader.CHUNK_SIZE)
+            spool.seek(0)
+            return spool
+
+        # the release vector is read directly from the response
+        return blob
+
+    def current_digest(self):
+        if self._oci_layout:
+            return self._oci_layout.digest(self._url)
+
+        endpoints = self._endpoints()
+        try:
+            _, digest = self._call(endpoints, self._head_manifest, hedge=True)
+        except Exception as e:
+            display.vvv("- Unable to revalidate manifest digest of %s: %s" %
+                        (self._url, to_native(e)))
+            return None
+
+        return digest
+
+    def _manifest_digest(self, client):
+        try:
+            return self._head_manifest(client)
+        except Exception as e:
+            display.vvv("- Unable to revalidate manifest digest of %s: %s" %
+                        (self._url, to_native(e)))
+            return None
+
+    def _head_manifest(self, client):
+        req = client.NewRequest(
+            "HEAD",
+            "/v2/<name>/manifests/<reference>",
+            WithReference(self._version),
+        ).SetHeader("Accept", opencontainersv1.MediaTypeImageManifest)
+
+        response = client.Do(req)
+        response.raise_for_status()
+
+        return response.headers.get("Docker-Content-Digest")
 
     @staticmethod
     def _parse_oci_ref(full_ref, scheme='https'):
@@ -541,21 +1549,26 @@ class OciLoader():
         return "%s://%s" % (scheme, url.netloc), url.path.removeprefix('/'), tag
 
     @staticmethod
-    def _extract_tar_gzip_file(bytes, member):
-        with tarfile.open(fileobj=BytesIO(bytes), mode='r:gz') as tar:
-            with tar.extractfile(tar.getmember(member)) as f:
-                try:
-                    return f.read().decode('utf-8')
-                except Exception as e:
-                    raise RuntimeError(
-                        "error extracting tar member from oci layer: %s" % to_native(e)) from e
+    def _extract_tar_gzip_file(fileobj, member):
+        # the tar is read as a stream, so reading stops as soon as the member was found
+        with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
+            for info in tar:
+                if info.name != member:
+                    continue
+                with tar.extractfile(info) as f:
+                    try:
+                        return f.read().decode('utf-8')
+                    except Exception as e:
+                        raise RuntimeError(
+                            "error extracting tar member from oci layer: %s" % to_native(e)) from e
+
+        raise KeyError("filename %r not found in oci layer" % member)
 
     @staticmethod
-    def _extract_tar_gzip(bytes, dest, filter=None):
-        with tarfile.open(fileobj=BytesIO(bytes), mode='r:gz') as tar:
+    def _extract_tar_gzip(fileobj, dest, filter=None):
+        with tarfile.open(fileobj=fileobj, mode='r|gz') as tar:
             try:
-                tar.extractall(
-                    path=dest, members=tar.getmembers(), filter=filter)
+                tar.extractall(path=dest, filter=filter)
             except Exception as e:
                 raise RuntimeError(
                     "error extracting tar from oci layer: %s" % to_native(e)) from e
@@ -568,3 +1581,1147 @@ class OciLoader():
             member.name = os.path.join(base, *parts[1:])
             return member
         return filter
+
+
+class CosignVerifier():
+    """
+    Runs cosign verifications in the background and remembers their results by
+    the verified digest and the verification policy, such that every artifact
+    is verified only once. Given a blob cache, successful verifications are
+    persisted as markers keyed by the hash of the digest and the policy, such
+    that changing the public key, identity or issuer verifies again.
+    """
+
+    def __init__(self, max_workers=4, blob_cache=None, timings=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._blob_cache = blob_cache
+        self._timings = timings or Timings()
+        self._verifications = dict()
+        self._lock = threading.Lock()
+
+    def verify(self, ref, key=None, identity=None, issuer=None):
+        """
+        Returns a future, which raises in case the verification failed.
+        """
+        if not key and not identity and not issuer:
+            future = Future()
+            future.set_result(None)
+            return future
+
+        policy = (ref, key, identity, issuer)
+        cache_key = "sha256:" + hashlib.sha256(json.dumps(policy).encode('utf-8')).hexdigest()
+
+        with self._lock:
+            future = self._verifications.get(policy)
+            if future is not None:
+                return future
+
+            if self._blob_cache and self._blob_cache.is_verified(cache_key):
+                display.vvv("- %s was already verified through cosign" % ref)
+                future = Future()
+                future.set_result(None)
+            else:
+                future = self._executor.submit(
+                    self._timed_verify, ref, key, identity, issuer, cache_key)
+
+            self._verifications[policy] = future
+            return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def _timed_verify(self, ref, key, identity, issuer, cache_key):
+        with self._timings.span("cosign", ref):
+            return self._verify(ref, key, identity, issuer, cache_key)
+
+    def _verify(self, ref, key, identity, issuer, cache_key):
+        try:
+            bin_path = process.get_bin_path(
+                "cosign", required=True, opt_dirs=None)
+
+            if key:
+                subprocess.run(args=[bin_path, "verify", "--key", "env://PUBKEY", ref],
+                               env=dict(PUBKEY=key), check=True, capture_output=True)
+                display.display(
+                    "- %s was verified successfully by public key through cosign" % ref, color=C.COLOR_OK)
+            else:
+                subprocess.run(args=[bin_path, "verify", "--certificate-oidc-issuer", issuer,
+                                     "--certificate-identity", identity, ref],
+                               check=True, capture_output=True)
+                display.display(
+                    "- %s was verified successfully by oidc-issuer through cosign" % ref, color=C.COLOR_OK)
+        except ValueError as e:
+            raise FileNotFoundError("cosign needs to be installed: %s" %
+                                    to_native(e)) from e
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError("cosign verification returned with exit code %s: %s" % (
+                e.returncode, to_native(e.stderr))) from e
+
+        if self._blob_cache:
+            self._blob_cache.put_verification(cache_key)
+
+
+class GitMirrorCache():
+    """
+    Keeps a bare clone of the branches and tags of every git repository that
+    roles are installed from. Clones are fetched incrementally and role versions
+    are exported from them, such that a repository is only cloned once per
+    controller. Versions with git submodules are not exported, as git archive
+    does not include them.
+    """
+
+    # other refs like the pull requests of GitHub are not fetched
+    REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+    LOCK_TIMEOUT = 600
+
+    def __init__(self, path):
+        self._path = path
+        self._locks = dict()
+        self._locks_guard = threading.Lock()
+        self._bin_path = None
+
+    @staticmethod
+    def default_path():
+        return os.path.join(OciBlobCache.default_path(), "git")
+
+    def available(self):
+        if self._bin_path is None:
+            try:
+                self._bin_path = process.get_bin_path("git", required=True, opt_dirs=None)
+            except ValueError:
+                self._bin_path = ""
+
+        return bool(self._bin_path)
+
+    def export(self, repository, version, dest):
+        """
+        Exports the given version of the repository into dest and returns the
+        commit hash of the exported version. None is returned without exporting
+        anything if the version contains git submodules.
+        """
+        mirror = os.path.join(self._path, hashlib.sha256(
+            repository.encode('utf-8')).hexdigest() + ".git")
+
+        with self._lock(mirror) as locked:
+            if not locked:
+                # the role is cloned without the mirror instead
+                display.warning("timed out waiting for another worker using git mirror %s" % mirror)
+                return None
+
+            if not os.path.isdir(mirror):
+                self._clone(repository, mirror)
+            elif not self._is_commit(mirror, version):
+                # commits are immutable, everything else may have moved
+                display.vvv("- Fetching %s into git mirror %s" % (repository, mirror))
+                self._git("--git-dir", mirror, "fetch", "--prune", "--quiet", "origin")
+            else:
+                display.vvv("- Using git mirror %s for %s" % (mirror, repository))
+
+            commit = self._git("--git-dir", mirror, "rev-parse", "--verify",
+                               "%s^{commit}" % version).decode('utf-8').strip()
+
+            if self._has_submodules(mirror, commit):
+                display.vvv("- %s contains git submodules at %s, not exporting it from git mirror" % (repository, version))
+                return None
+
+            os.makedirs(dest, exist_ok=True)
+            archive = subprocess.Popen([self._bin_path, "--git-dir", mirror, "archive", "--format=tar", commit],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                with tarfile.open(fileobj=archive.stdout, mode='r|') as tar:
+                    tar.extractall(path=dest, filter='data')
+            finally:
+                archive.stdout.close()
+                stderr = archive.stderr.read()
+                archive.stderr.close()
+                if archive.wait() != 0:
+                    raise RuntimeError("git archive of %s returned with exit code %s: %s" % (
+                        repository, archive.returncode, to_native(stderr)))
+
+        return commit
+
+    def _clone(self, repository, mirror):
+        display.vvv("- Cloning %s into git mirror %s" % (repository, mirror))
+
+        os.makedirs(self._path, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=self._path)
+        try:
+            clone = os.path.join(tmp, "mirror.git")
+            self._git("clone", "--bare", "--quiet", "--", repository, clone)
+            # bare clones do not configure a refspec, so fetches would not update any ref
+            for i, refspec in enumerate(GitMirrorCache.REFSPECS):
+                self._git("--git-dir", clone, "config", "--replace-all" if i == 0 else "--add",
+                          "remote.origin.fetch", refspec)
+            try:
+                os.rename(clone, mirror)
+            except OSError:
+                # a worker not honoring the lock may have cloned the mirror in the meantime
+                if not os.path.isdir(mirror):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _has_submodules(self, mirror, commit):
+        try:
+            self._git("--git-dir", mirror, "cat-file", "-e", "%s:.gitmodules" % commit)
+        except RuntimeError:
+            return False
+
+        return True
+
+    def _is_commit(self, mirror, version):
+        if len(version) != 40 or not all(c in "0123456789abcdef" for c in version):
+            return False
+
+        try:
+            self._git("--git-dir", mirror, "cat-file", "-e", "%s^{commit}" % version)
+        except RuntimeError:
+            return False
+
+        return True
+
+    def _git(self, *args):
+        try:
+            return subprocess.run(args=[self._bin_path] + list(args), check=True,
+                                  capture_output=True, env=dict(os.environ, GIT_TERMINAL_PROMPT="0")).stdout
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError("git returned with exit code %s: %s" % (
+                e.returncode, to_native(e.stderr))) from e
+
+    @contextmanager
+    def _lock(self, mirror):
+        """
+        Holds an exclusive lock on a mirror across the threads of this process and
+        across other processes and yields whether the lock was acquired in time.
+        """
+        with self._locks_guard:
+            lock = self._locks.setdefault(mirror, threading.Lock())
+
+        os.makedirs(self._path, exist_ok=True)
+
+        with lock, open(mirror + ".lock", "a") as f:
+            locked = False
+            deadline = time.monotonic() + GitMirrorCache.LOCK_TIMEOUT
+
+            while not locked and time.monotonic() <= deadline:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                except BlockingIOError:
+                    time.sleep(0.05)
+
+            try:
+                yield locked
+            finally:
+                if locked:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class RoleDefaultsCache():
+    """
+    Stores the default vars of included roles by their role path. An entry is
+    valid as long as the defaults and meta directories of the role and its
+    dependencies were not modified, such that roles do not need to be loaded
+    again in every run.
+    """
+    WATCHED_DIRS = ("defaults", "meta")
+
+    def __init__(self, path):
+        self._path = path
+
+    @staticmethod
+    def default_path():
+        return os.path.join(OciBlobCache.default_path(), "role-defaults")
+
+    def get(self, role_path):
+        try:
+            with open(self._file_path(role_path), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get("role_path") != role_path or entry.get("files") != self._stat(entry.get("role_paths", [])):
+            return None
+
+        display.vvv("- Using cached role defaults of %s" % role_path)
+        return entry.get("defaults")
+
+    def put(self, role_path, defaults, role_paths):
+        role_paths = [os.path.realpath(p) for p in role_paths]
+
+        try:
+            content = json.dumps(dict(
+                role_path=role_path,
+                role_paths=role_paths,
+                files=self._stat(role_paths),
+                defaults=defaults,
+            )).encode('utf-8')
+        except (TypeError, ValueError) as e:
+            display.vvv("- Not caching role defaults of %s: %s" % (role_path, to_native(e)))
+            return
+
+        path = self._file_path(role_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def _file_path(self, role_path):
+        return os.path.join(self._path, hashlib.sha256(role_path.encode('utf-8')).hexdigest() + ".json")
+
+    @staticmethod
+    def _stat(role_paths):
+        # directories are included, such that added and removed files are noticed, too
+        files = dict()
+
+        for role_path in role_paths:
+            for d in RoleDefaultsCache.WATCHED_DIRS:
+                for root, _, names in os.walk(os.path.join(role_path, d)):
+                    for p in [root] + [os.path.join(root, n) for n in names]:
+                        try:
+                            st = os.stat(p)
+                        except OSError:
+                            continue
+                        files[p] = [st.st_mtime_ns, st.st_size]
+
+        return files
+
+
+class BlobDownload(io.RawIOBase):
+    """
+    Streams a blob from a registry and verifies its content against the digest
+    while it is read. Interrupted transfers are resumed with range requests and
+    transient registry errors are retried with a jittered exponential backoff.
+    """
+    RETRIES = 5
+    BACKOFF = 0.5
+    BACKOFF_MAX = 10
+    TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, open_response, digest, size=None, name=None):
+        """
+        open_response is called with the request headers and returns a streamed response.
+        """
+        self._open_response = open_response
+        self._digest = digest
+        self._size = size
+        self._name = name or digest
+        self._offset = 0
+
+        algorithm, _, self._encoded = digest.partition(":")
+        self._hash = hashlib.new(algorithm) if algorithm in hashlib.algorithms_available else None
+
+        self._response = self.with_retries(self._connect, self._name)
+
+    @staticmethod
+    def with_retries(fn, name):
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except Exception as e:
+                attempt += 1
+                if attempt > BlobDownload.RETRIES or not BlobDownload._is_transient(e):
+                    raise
+
+                delay = random.uniform(0, min(BlobDownload.BACKOFF_MAX, BlobDownload.BACKOFF * 2 ** attempt))
+                display.vvv("- Retrying request for %s in %.1fs after transient error: %s" %
+                            (name, delay, to_native(e)))
+                time.sleep(delay)
+
+    @staticmethod
+    def checked(response):
+        if response.status_code in BlobDownload.TRANSIENT_STATUS_CODES:
+            response.close()
+            raise TransientError("registry responded with status code %d" % response.status_code)
+        response.raise_for_status()
+        return response
+
+    @staticmethod
+    def _is_transient(e):
+        return isinstance(e, (TransientError, requests.ConnectionError, requests.Timeout,
+                              urllib3.exceptions.HTTPError))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        failures = 0
+        while True:
+            try:
+                data = self._response.raw.read(len(b))
+                if not data and self._size is not None and self._offset < self._size:
+                    raise TransientError("connection closed after %d of %d bytes" % (self._offset, self._size))
+                break
+            except Exception as e:
+                failures += 1
+                if failures > BlobDownload.RETRIES or not self._is_transient(e):
+                    raise
+
+                display.vvv("- Resuming download of %s at byte %d: %s" % (self._name, self._offset, to_native(e)))
+                self._response.close()
+                time.sleep(random.uniform(0, min(BlobDownload.BACKOFF_MAX, BlobDownload.BACKOFF * 2 ** failures)))
+                self._response = self.with_retries(self._connect, self._name)
+
+        if not data:
+            self._verify()
+            return 0
+
+        n = len(data)
+        b[:n] = data
+        self._offset += n
+        if self._hash:
+            self._hash.update(data)
+        return n
+
+    def drain(self):
+        while self.read(OciLoader.CHUNK_SIZE):
+            pass
+
+    def close(self):
+        if not self.closed:
+            self._response.close()
+        super().close()
+
+    def _connect(self):
+        headers = dict()
+        if self._offset:
+            headers["Range"] = "bytes=%d-" % self._offset
+
+        response = self.checked(self._open_response(headers))
+
+        # the blob content is hashed, so transfer encodings need to be decoded
+        response.raw.decode_content = True
+
+        if self._offset and (response.status_code != 206 or response.headers.get("Content-Encoding")):
+            # the registry does not support ranges, so the transferred part is skipped
+            remaining = self._offset
+            while remaining:
+                chunk = response.raw.read(min(remaining, OciLoader.CHUNK_SIZE))
+                if not chunk:
+                    raise TransientError("connection closed while skipping to byte %d" % self._offset)
+                remaining -= len(chunk)
+
+        return response
+
+    def _verify(self):
+        if self._size is not None and self._offset != self._size:
+            raise RuntimeError("size of blob %s does not match, expected %d bytes, got %d" %
+                               (self._digest, self._size, self._offset))
+
+        if self._hash and self._hash.hexdigest() != self._encoded:
+            raise RuntimeError(
+                "content of blob does not match its digest %s" % self._digest)
+
+
+class TransientError(Exception):
+    pass
+
+
+class OciLayout():
+    """
+    Reads artifacts from an OCI image layout directory or tarball. Manifests
+    are looked up by their "org.opencontainers.image.ref.name" annotation and
+    blobs are read through memory-mapped files.
+
+    Opened layouts are shared for the lifetime of the process.
+    """
+    REF_NAME_ANNOTATION = "org.opencontainers.image.ref.name"
+
+    _layouts = dict()
+    _layouts_lock = threading.Lock()
+
+    def __init__(self, path):
+        self._path = path
+        self._tar_map = None
+        self._tar_members = None
+
+        if not os.path.isdir(path):
+            # the members of a tarball are served from a single mapping of the whole file
+            with open(path, "rb") as f:
+                self._tar_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with tarfile.open(fileobj=MappedFile(self._tar_map, owned=False), mode="r:") as tar:
+                self._tar_members = {os.path.normpath(m.name): (m.offset_data, m.size)
+                                     for m in tar.getmembers() if m.isfile()}
+
+        with self._open("index.json") as f:
+            index = json.loads(f.read())
+
+        self._refs = dict()
+        for descriptor in index.get("manifests", list()):
+            ref = descriptor.get("annotations", dict()).get(OciLayout.REF_NAME_ANNOTATION)
+            if ref:
+                self._refs[ref] = descriptor["digest"]
+
+    @classmethod
+    def open(cls, path):
+        path = os.path.realpath(path)
+
+        with cls._layouts_lock:
+            layout = cls._layouts.get(path)
+            if layout is None:
+                layout = cls(path)
+                cls._layouts[path] = layout
+            return layout
+
+    def digest(self, ref):
+        return self._refs.get(ref)
+
+    def manifest(self, ref):
+        """
+        Returns the raw manifest and its digest.
+        """
+        digest = self.digest(ref)
+        if digest is None:
+            raise RuntimeError("%s was not found in oci layout %s" % (ref, self._path))
+
+        with self.open_blob(digest) as f:
+            return f.read(), digest
+
+    def open_blob(self, digest, size=None):
+        """
+        Opens a blob, which is verified against its digest and size once it was
+        read completely.
+        """
+        algorithm, _, hex = digest.partition(":")
+        if not algorithm.isalnum() or not hex.isalnum():
+            raise ValueError("invalid digest: %s" % digest)
+        return VerifiedBlob(self._open(os.path.join("blobs", algorithm, hex)), digest, size=size)
+
+    def _open(self, name):
+        if self._tar_members is None:
+            try:
+                with open(os.path.join(self._path, name), "rb") as f:
+                    if os.fstat(f.fileno()).st_size == 0:
+                        return io.BytesIO()
+                    return MappedFile(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except FileNotFoundError as e:
+                raise RuntimeError("%s was not found in oci layout %s" % (name, self._path)) from e
+
+        member = self._tar_members.get(os.path.normpath(name))
+        if member is None:
+            raise RuntimeError("%s was not found in oci layout %s" % (name, self._path))
+
+        offset, size = member
+        return MappedFile(self._tar_map, offset, size, owned=False)
+
+
+class VerifiedBlob(io.RawIOBase):
+    """
+    Verifies the content of a blob read from a file object against its digest
+    and size, an error is raised when reaching its end if it does not match.
+    on_mismatch is called before raising the error.
+    """
+
+    def __init__(self, fileobj, digest, size=None, on_mismatch=None):
+        self._fileobj = fileobj
+        self._digest = digest
+        self._size = size
+        self._on_mismatch = on_mismatch
+        self._offset = 0
+
+        algorithm, _, self._encoded = digest.partition(":")
+        if algorithm not in hashlib.algorithms_available:
+            fileobj.close()
+            raise ValueError("unsupported digest algorithm: %s" % digest)
+        self._hash = hashlib.new(algorithm)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._fileobj.readinto(b)
+        if not n:
+            self._verify()
+            return 0
+
+        self._offset += n
+        self._hash.update(memoryview(b)[:n])
+        return n
+
+    def drain(self):
+        while self.read(OciLoader.CHUNK_SIZE):
+            pass
+
+    def close(self):
+        if not self.closed:
+            self._fileobj.close()
+        super().close()
+
+    def _verify(self):
+        error = None
+        if self._size is not None and self._offset != self._size:
+            error = "size of blob %s does not match, expected %d bytes, got %d" % (
+                self._digest, self._size, self._offset)
+        elif self._hash.hexdigest() != self._encoded:
+            error = "content of blob does not match its digest %s" % self._digest
+
+        if error:
+            if self._on_mismatch:
+                self._on_mismatch()
+            raise RuntimeError(error)
+
+
+class MappedFile(io.RawIOBase):
+    """
+    A read-only file object on a region of a memory map.
+    """
+
+    def __init__(self, map, offset=0, size=None, owned=True):
+        self._map = map
+        self._view = memoryview(map)[offset:None if size is None else offset + size]
+        self._owned = owned
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, min(offset, len(self._view)))
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            if self._owned:
+                self._map.close()
+        super().close()
+
+
+class OciLayoutWriter():
+    """
+    Exports artifacts into an OCI image layout directory or, if the path ends
+    with ".tar", into a tarball. Artifacts are referenced by their full OCI
+    reference in the "org.opencontainers.image.ref.name" annotation.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._tarball = path.endswith(".tar")
+        self._manifests = dict()
+        self._lock = threading.Lock()
+
+        if self._tarball:
+            self._dir = tempfile.mkdtemp(prefix=".oci-layout-", dir=os.path.dirname(os.path.abspath(path)))
+        else:
+            self._dir = path
+            try:
+                with open(os.path.join(path, "index.json")) as f:
+                    for descriptor in json.load(f).get("manifests", list()):
+                        ref = descriptor.get("annotations", dict()).get(OciLayout.REF_NAME_ANNOTATION)
+                        self._manifests[ref or descriptor["digest"]] = descriptor
+            except FileNotFoundError:
+                pass
+
+    def put_blob(self, digest, fileobj):
+        """
+        Streams the blob into the layout, verifies its digest and returns the
+        blob opened for reading. The given file object is closed.
+        """
+        path = self._blob_path(digest)
+
+        with fileobj:
+            if not os.path.exists(path):
+                algorithm = digest.partition(":")[0]
+                h = hashlib.new(algorithm)
+
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        for chunk in iter(lambda: fileobj.read(OciLoader.CHUNK_SIZE), b""):
+                            h.update(chunk)
+                            f.write(chunk)
+
+                    if "%s:%s" % (algorithm, h.hexdigest()) != digest:
+                        raise RuntimeError("digest mismatch of exported blob %s" % digest)
+
+                    os.replace(tmp, path)
+                except Exception:
+                    os.unlink(tmp)
+                    raise
+
+        return open(path, "rb")
+
+    def put_manifest(self, ref, content, digest):
+        self.put_blob(digest, io.BytesIO(content)).close()
+
+        with self._lock:
+            self._manifests[ref] = dict(
+                mediaType=json.loads(content).get("mediaType", "application/vnd.oci.image.manifest.v1+json"),
+                digest=digest,
+                size=len(content),
+                annotations={OciLayout.REF_NAME_ANNOTATION: ref},
+            )
+
+    def close(self):
+        with self._lock:
+            index = dict(
+                schemaVersion=2,
+                mediaType="application/vnd.oci.image.index.v1+json",
+                manifests=list(self._manifests.values()),
+            )
+
+        self._write(os.path.join(self._dir, "oci-layout"), json.dumps(dict(imageLayoutVersion="1.0.0")))
+        self._write(os.path.join(self._dir, "index.json"), json.dumps(index))
+
+        if not self._tarball:
+            return
+
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self._path)), prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f, tarfile.open(fileobj=f, mode="w") as tar:
+                    for name in sorted(os.listdir(self._dir)):
+                        tar.add(os.path.join(self._dir, name), arcname=name)
+                os.replace(tmp, self._path)
+            except Exception:
+                os.unlink(tmp)
+                raise
+        finally:
+            self.abort()
+
+    def abort(self):
+        if self._tarball:
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+    def _blob_path(self, digest):
+        algorithm, _, hex = digest.partition(":")
+        if not algorithm.isalnum() or not hex.isalnum():
+            raise ValueError("invalid digest: %s" % digest)
+        return os.path.join(self._dir, "blobs", algorithm, hex)
+
+    @staticmethod
+    def _write(path, content):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+
+class OciClientPool():
+    """
+    Shares registry clients for all OCI downloads of a run, such that
+    connections are kept alive and auth tokens are reused.
+    """
+
+    def __init__(self, max_connections=10):
+        self._max_connections = max_connections
+        self._clients = dict()
+        self._lock = threading.Lock()
+
+    def get(self, registry, namespace, username=None, password=None):
+        with self._lock:
+            key = (registry, username, password)
+            client = self._clients.get(key)
+            if client is None:
+                client = OciClient(registry, namespace, username, password,
+                                   max_connections=self._max_connections)
+                self._clients[key] = client
+            return client.with_namespace(namespace)
+
+
+class RegistryMirrors():
+    """
+    Pulls artifacts of an upstream registry through its mirrors, like a
+    pull-through cache in front of ghcr.io. The mirrors of a registry are
+    probed once per run and tried in the order of their latency, the upstream
+    registry is tried after all healthy mirrors. Registries that fail are
+    considered unhealthy for a cooldown period.
+
+    Hedged calls do not wait for a slow registry, but issue the same request
+    to the next registry in line and take the first response.
+    """
+    PROBE_TIMEOUT = 2
+    FAILURE_COOLDOWN = 30
+    HEDGE_DELAY_MIN = 0.05
+    HEDGE_DELAY_FACTOR = 3
+    # weight of a new sample in the moving average of the latency
+    LATENCY_SMOOTHING = 0.3
+
+    def __init__(self, mirrors, client_pool=None, hedge=True, max_workers=4):
+        """
+        mirrors maps upstream registry hosts to lists of mirror urls, a mirror may
+        as well be a dict with the url and credentials of the mirror.
+        """
+        if not isinstance(mirrors, dict):
+            raise ValueError("registry mirrors need to be a dict of upstream registries")
+
+        self._mirrors = {upstream: [self._parse_mirror(m) for m in (urls or list())]
+                         for upstream, urls in mirrors.items()}
+        self._client_pool = client_pool
+        self._hedge = hedge
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._latencies = dict()
+        self._failed_until = dict()
+        self._probes = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse_mirror(mirror):
+        if isinstance(mirror, str):
+            mirror = dict(url=mirror)
+
+        if not isinstance(mirror, dict) or not mirror.get("url"):
+            raise ValueError("a registry mirror needs to be a url or a dict with a url: %s" % mirror)
+
+        url = mirror["url"] if "://" in mirror["url"] else "https://" + mirror["url"]
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.netloc:
+            raise ValueError("invalid registry mirror url: %s" % mirror["url"])
+
+        return dict(
+            registry="%s://%s" % (parsed.scheme, parsed.netloc),
+            # mirrors may serve the upstream repositories below a path, like a harbor proxy project
+            prefix=parsed.path.strip("/"),
+            username=mirror.get("username"),
+            password=mirror.get("password"),
+        )
+
+    def endpoints(self, registry, namespace, username=None, password=None):
+        """
+        Returns the registries to pull a repository from in the order they should
+        be tried, as tuples of registry and client.
+        """
+        upstream = (registry, self._client(registry, namespace, username, password))
+
+        mirrors = self._mirrors.get(urlparse(registry).netloc)
+        if not mirrors:
+            return [upstream]
+
+        endpoints = [(m["registry"], self._client(m["registry"], "/".join(filter(None, [m["prefix"], namespace])),
+                                                  m["username"], m["password"])) for m in mirrors]
+        self._probe(endpoints)
+
+        now = time.monotonic()
+        with self._lock:
+            healthy = sorted((e for e in endpoints if self._failed_until.get(e[0], 0) <= now),
+                             key=lambda e: self._latencies.get(e[0], float("inf")))
+            unhealthy = [e for e in endpoints if self._failed_until.get(e[0], 0) > now]
+
+        return healthy + [upstream] + unhealthy
+
+    def call(self, endpoints, fn, hedge=False):
+        """
+        Calls fn with the client of the endpoints in order until it succeeds and
+        returns the successful endpoint along with the result.
+        """
+        if len(endpoints) == 1:
+            return endpoints[0], fn(endpoints[0][1])
+
+        if hedge and self._hedge:
+            return self._hedged_call(endpoints, fn)
+
+        error = None
+        for endpoint in endpoints:
+            try:
+                return endpoint, self._timed_call(endpoint, fn, record_latency=False)
+            except Exception as e:
+                display.vvv("- Request to %s failed, falling back to the next registry: %s" %
+                            (endpoint[0], to_native(e)))
+                error = e
+
+        raise error
+
+    def shutdown(self):
+        # hedged requests that lost the race are not waited for
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _hedged_call(self, endpoints, fn):
+        remaining = list(endpoints)
+        pending = dict()
+        error = None
+
+        def launch():
+            endpoint = remaining.pop(0)
+            pending[self._executor.submit(self._timed_call, endpoint, fn, True)] = endpoint
+            return endpoint
+
+        latest = launch()
+        while pending:
+            done, _ = wait(pending, timeout=self._hedge_delay(latest[0]) if remaining else None,
+                           return_when=FIRST_COMPLETED)
+
+            if not done:
+                display.vvv("- Request to %s is slow, hedging it with %s" % (latest[0], remaining[0][0]))
+                latest = launch()
+                continue
+
+            for future in done:
+                endpoint = pending.pop(future)
+                try:
+                    return endpoint, future.result()
+                except Exception as e:
+                    display.vvv("- Request to %s failed, falling back to the next registry: %s" %
+                                (endpoint[0], to_native(e)))
+                    error = e
+                    if remaining:
+                        latest = launch()
+
+        raise error
+
+    def _timed_call(self, endpoint, fn, record_latency):
+        registry, client = endpoint
+        start = time.monotonic()
+        try:
+            result = fn(client)
+        except Exception as e:
+            if self._is_unhealthy(e):
+                self._record(registry, None)
+            raise
+
+        if record_latency:
+            self._record(registry, time.monotonic() - start)
+
+        return result
+
+    def _hedge_delay(self, registry):
+        with self._lock:
+            latency = self._latencies.get(registry)
+        if latency is None:
+            return self.PROBE_TIMEOUT
+        return max(self.HEDGE_DELAY_MIN, latency * self.HEDGE_DELAY_FACTOR)
+
+    def _probe(self, endpoints):
+        with self._lock:
+            probes = [self._probes.get(registry) or self._probes.setdefault(
+                registry, self._executor.submit(self._ping, registry, client)) for registry, client in endpoints]
+
+        for probe in probes:
+            probe.result()
+
+    def _ping(self, registry, client):
+        start = time.monotonic()
+        try:
+            response = client.ping(timeout=self.PROBE_TIMEOUT)
+            response.close()
+            if response.status_code >= 500:
+                raise RuntimeError("registry responded with status code %d" % response.status_code)
+        except Exception as e:
+            display.vvv("- Registry mirror %s is not healthy: %s" % (registry, to_native(e)))
+            self._record(registry, None)
+            return
+
+        self._record(registry, time.monotonic() - start)
+
+    def _record(self, registry, latency):
+        with self._lock:
+            if latency is None:
+                self._failed_until[registry] = time.monotonic() + self.FAILURE_COOLDOWN
+                return
+
+            self._failed_until.pop(registry, None)
+            previous = self._latencies.get(registry)
+            self._latencies[registry] = latency if previous is None else \
+                previous + self.LATENCY_SMOOTHING * (latency - previous)
+
+    @staticmethod
+    def _is_unhealthy(e):
+        # client errors like a repository missing on a mirror do not tell about its health
+        while e is not None:
+            response = getattr(e, "response", None)
+            if response is not None and getattr(response, "status_code", 500) < 500:
+                return False
+            e = e.__cause__
+        return True
+
+    def _client(self, registry, namespace, username, password):
+        if self._client_pool:
+            return self._client_pool.get(registry, namespace, username, password)
+        return OciClient(registry, namespace, username, password)
+
+
+class OciClient():
+    """
+    Issues reggie requests through a shared HTTP session and caches the bearer
+    tokens of the registry until they expire. Reggie itself opens a new session
+    for every request and negotiates a new token on every 401 response.
+    """
+
+    # registries that do not return an expiry issue tokens valid for 60 seconds
+    DEFAULT_TOKEN_EXPIRY = 60
+    TOKEN_EXPIRY_LEEWAY = 10
+
+    def __init__(self, registry, namespace, username=None, password=None, max_connections=10):
+        opts = [WithDefaultName(namespace)]
+        if username and password:
+            opts.append(WithUsernamePassword(
+                username=username, password=password))
+
+        self._client = NewClient(registry, *opts)
+        self._registry = registry
+        self._namespace = namespace
+
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_connections, pool_maxsize=max_connections)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+        self._tokens = dict()
+        self._lock = threading.Lock()
+
+    def with_namespace(self, namespace):
+        view = copy.copy(self)
+        view._namespace = namespace
+        return view
+
+    def NewRequest(self, method, path, *opts):
+        return self._client.NewRequest(method, path, WithName(self._namespace), *opts)
+
+    def Do(self, req):
+        token = self._token(self._namespace)
+        if token:
+            req.SetAuthToken(token)
+
+        response = self._send(req)
+        if response.status_code != 401:
+            return response
+
+        challenge = response.headers.get("Www-Authenticate")
+        if not challenge:
+            return response
+
+        response.close()
+
+        if challenge.lower().startswith("basic"):
+            req.SetBasicAuth(self._client.Config.Username or "",
+                             self._client.Config.Password or "")
+        else:
+            req.SetAuthToken(self._fetch_token(challenge))
+
+        return self._send(req)
+
+    def ping(self, timeout=None):
+        # any response of the api base endpoint, including 401, tells the registry is up
+        return self._session.get(self._registry + "/v2/", timeout=timeout)
+
+    def _send(self, req):
+        validateRequest(req.Request)
+        prepared = self._session.prepare_request(req.Request)
+        # Session.send does not merge the proxies and certificates configured
+        # through the environment (e.g. HTTPS_PROXY), only Session.request does
+        settings = self._session.merge_environment_settings(prepared.url, req.proxies, req.stream, None, None)
+        return self._session.send(prepared, **settings)
+
+    def _token(self, namespace):
+        with self._lock:
+            token, expires_at = self._tokens.get(namespace, (None, 0))
+            if time.time() < expires_at:
+                return token
+            return None
+
+    def _fetch_token(self, challenge):
+        h = parseAuthHeader(challenge)
+
+        params = dict(service=getattr(h, "Service", None),
+                      scope=getattr(h, "Scope", None))
+        auth = None
+        if self._client.Config.Username and self._client.Config.Password:
+            auth = (self._client.Config.Username,
+                    self._client.Config.Password)
+
+        response = self._session.get(getattr(h, "Realm", None), params={k: v for k, v in params.items() if v},
+                                     auth=auth, headers={"Accept": "application/json"})
+        response.raise_for_status()
+
+        info = response.json()
+        token = info.get("token") or info.get("access_token")
+        expires_in = info.get("expires_in") or OciClient.DEFAULT_TOKEN_EXPIRY
+
+        with self._lock:
+            self._tokens[self._namespace] = (
+                token, time.time() + expires_in - OciClient.TOKEN_EXPIRY_LEEWAY)
+
+        return token
+
+
+class OciBlobCache(DiskCache):
+    """
+    A content-addressed store for OCI manifests and blobs, which are persisted
+    by their digest in the shared disk cache.
+    """
+
+    def get_manifest(self, digest):
+        return self._get("manifests", digest)
+
+    def put_manifest(self, digest, content):
+        self._put("manifests", digest, [content]).close()
+
+    def is_verified(self, key):
+        return self._get("verifications", key) is not None
+
+    def put_verification(self, key):
+        self._put("verifications", key, [b""]).close()
+
+    def open_blob(self, digest):
+        """
+        Returns the stored blob opened for reading or None. The blob is verified
+        against its digest while it is read and removed from the cache if it
+        does not match, e.g. because it was modified on disk.
+        """
+        path = self._file_path("blobs", digest)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        self._touch(path)
+
+        def remove():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        return VerifiedBlob(f, digest, on_mismatch=remove)
+
+    def put_blob(self, digest, fileobj):
+        """
+        Stores the content of the given file object chunk-wise and verifies it
+        against the digest. Returns the stored blob opened for reading.
+        """
+        algorithm, _, encoded = digest.partition(":")
+        h = hashlib.new(algorithm) if algorithm in hashlib.algorithms_available else None
+
+        def chunks():
+            while True:
+                chunk = fileobj.read(OciLoader.CHUNK_SIZE)
+                if not chunk:
+                    break
+                if h:
+                    h.update(chunk)
+                yield chunk
+
+        def verify():
+            if h and h.hexdigest() != encoded:
+                raise RuntimeError(
+                    "content of blob does not match its digest %s" % digest)
+
+        return self._put("blobs", digest, chunks(), verify)
@@ -1,13 +1,15 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import tempfile
+import importlib.util
 import json
 import os
+import sys
 
+from concurrent.futures import ThreadPoolExecutor
 from traceback import format_exc
-from yaml import safe_load
 
+from ansible.errors import AnsibleError
 from ansible.module_utils.urls import open_url
 from ansible.plugins.action import ActionBase
 from ansible.module_utils.parsing.convert_bool import boolean
@@ -21,9 +23,35 @@ except ImportError:
     display = Display()
 
 
+def _load_plugin_utils(name):
+    # the helpers shared by the controller-side plugins of this role are loaded
+    # from their path, such that the role directory is not added to sys.path
+    module_name = "metal_stack_ansible_common_" + name
+    module = sys.modules.get(module_name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plugin_utils", name + ".py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module = sys.modules.setdefault(module_name, module)
+    return module
+
+
+release_vector_cache = _load_plugin_utils("release_vector_cache")
+release_vector_documents = _load_plugin_utils("release_vector_documents")
+
+HttpCache = release_vector_cache.HttpCache
+VariableMapping = release_vector_documents.VariableMapping
+dotted_path = release_vector_documents.dotted_path
+load_yaml = release_vector_documents.load_yaml
+replace_key_values = release_vector_documents.replace_key_values
+
+
 class ActionModule(ActionBase):
     ALREADY_RESOLVED_MARKER = "_yaml_files_already_resolved"
-    RELEASE_VECTOR_CACHE_FILE = "metal-stack-release-vector-cache.json"
+    RELEASE_VECTOR_ACTION = "metal_stack_release_vector"
+    # the number of files that are downloaded concurrently
+    MAX_WORKERS = 8
 
     def _ensure_invocation(self, result):
         # NOTE: adding invocation arguments here needs to be kept in sync with
@@ -52,14 +80,26 @@ class ActionModule(ActionBase):
         files = self._task.args.get('files', task_vars.get('setup_yaml'))
         smart = boolean(self._task.args.get(
             'smart', task_vars.get('setup_yaml_smart', True)), strict=False)
-
-        release_vector_cache_file_path = os.path.join(
-            tempfile.gettempdir(), ActionModule.RELEASE_VECTOR_CACHE_FILE)
-        if smart and os.path.isfile(release_vector_cache_file_path):
-            result["changed"] = False
-            with open(release_vector_cache_file_path, 'r') as vector:
-                result["ansible_facts"] = json.load(vector)
-            return result
+        http_cache = boolean(self._task.args.get(
+            'http_cache', task_vars.get('setup_yaml_http_cache', True)), strict=False)
+
+        self._http_cache = None
+        if http_cache:
+            # the cache is shared with the metal_stack_release_vector module, it
+            # holds the downloaded files as well as the parsed documents
+            self._http_cache = HttpCache(
+                self._templar.template(task_vars.get(
+                    'metal_stack_release_vector_oci_blob_cache_dir')) or HttpCache.default_path(),
+                max_size=int(self._templar.template(task_vars.get(
+                    'metal_stack_release_vector_oci_blob_cache_max_size_mb',
+                    HttpCache.DEFAULT_MAX_SIZE // (1024 * 1024)))) * 1024 * 1024)
+
+        if smart:
+            release_vector_facts = self._release_vector_cached_facts(task_vars)
+            if release_vector_facts is not None:
+                result["changed"] = False
+                result["ansible_facts"] = release_vector_facts
+                return result
 
         if not files:
             result["skipped"] = True
@@ -80,17 +120,30 @@ class ActionModule(ActionBase):
 
         result["changed"] = False
 
-        for f in files:
-            url = self._templar.template(f.get("url"))
-            recursive = f.get("recursive", True)
-            replace = f.get("replace", [])
-            var = self._templar.template(f.get("meta_var"))
-            mapping = f.get("mapping", task_vars.get(var, dict()).get("mapping"))
-            nested = f.get("nested", task_vars.get(var, dict()).get("nested", list())) if recursive else list()
+        # parsed documents by url and replacements, every document is downloaded once per run
+        self._documents = dict()
+        self._executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
 
-            result = self.resolve(url, replace, mapping, nested, task_vars, result)
-            if result.get("failed"):
-                return result
+        try:
+            resolutions = []
+            for f in files:
+                url = self._templar.template(f.get("url"))
+                recursive = f.get("recursive", True)
+                replace = f.get("replace", [])
+                var = self._templar.template(f.get("meta_var"))
+                mapping = f.get("mapping", task_vars.get(var, dict()).get("mapping"))
+                nested = f.get("nested", task_vars.get(var, dict()).get("nested", list())) if recursive else list()
+
+                if url and mapping and self.demand(mapping, nested, task_vars):
+                    self._fetch(url, replace)
+                resolutions.append((url, replace, mapping, nested))
+
+            for url, replace, mapping, nested in resolutions:
+                result = self.resolve(url, replace, mapping, nested, task_vars, result)
+                if result.get("failed"):
+                    return result
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
 
         return self._ensure_invocation(result)
 
@@ -107,9 +160,20 @@ class ActionModule(ActionBase):
         if result.get("failed"):
             return result
 
+        for r in replace:
+            if r.get("key") is None or r.get("old") is None or r.get("new") is None:
+                result["msg"] = "replace must contain and dict with the keys for 'key', 'old' and 'new'"
+                result["failed"] = True
+                return result
+
+        if not self.demand(mapping, nested, task_vars):
+            # nothing to contribute, so the file is not even downloaded
+            display.vvv("skipping %s, all variables it provides are already defined" % url)
+            result["ansible_facts"] = result.get("ansible_facts", {self.ALREADY_RESOLVED_MARKER: True})
+            return result
+
         try:
-            rsp = open_url(url)
-            f = safe_load(rsp.read())
+            f = self._fetch(url, replace).result()
         except Exception as e:
             result["failed"] = True
             result["msg"] = "error getting image vector from url: %s" % url
@@ -117,19 +181,11 @@ class ActionModule(ActionBase):
             result["traceback"] = format_exc()
             return result
 
-        for r in replace:
-            if r.get("key") is None or r.get("old") is None or r.get("new") is None:
-                result["msg"] = "replace must contain and dict with the keys for 'key', 'old' and 'new'"
-                result["failed"] = True
-                return result
-            ActionModule.replace_key_value(f, r.get("key"), r.get("old"), r.get("new"))
-
+        # the nested files are downloaded concurrently before they are resolved in order
+        children = []
         for n in nested:
             url_path = self._templar.template(n.get("url_path"))
-            recursive = n.get("recursive", True)
-            var = self._templar.template(n.get("meta_var"))
-            nested_mapping = n.get("mapping", task_vars.get(var, dict()).get("mapping"))
-            next_nested = n.get("nested", task_vars.get(var, dict()).get("nested", list())) if recursive else list()
+            nested_mapping, next_nested = self._nested_mapping(n, task_vars)
 
             result["failed"] = True
             if not url_path:
@@ -142,8 +198,12 @@ class ActionModule(ActionBase):
             if result.get("failed"):
                 return result
 
+            if not self.demand(nested_mapping, next_nested, task_vars):
+                display.vvv("skipping %s in %s, all variables it provides are already defined" % (url_path, url))
+                continue
+
             try:
-                u = self.resolve_path(f, url_path)
+                u = dotted_path(f, url_path)
             except KeyError as e:
                 result["failed"] = True
                 result["msg"] = "error resolving path in nested"
@@ -151,49 +211,88 @@ class ActionModule(ActionBase):
                 result["traceback"] = format_exc()
                 return result
 
+            self._fetch(u, replace)
+            children.append((u, nested_mapping, next_nested))
+
+        for u, nested_mapping, next_nested in children:
             result = self.resolve(u, replace, nested_mapping, next_nested, task_vars, result)
             if result.get("failed"):
                 return result
 
+        mapping = VariableMapping.compile(mapping)
+        values, missing = mapping.resolve(f)
+
         ansible_facts = dict()
         for k, path in mapping.items():
             if task_vars.get(k) is not None:
                 # skip when already defined
                 continue
 
-            try:
-                value = self.resolve_path(f, path)
-            except KeyError as e:
+            if k in missing:
                 display.warning(
                     """error reading variable from file, variable %s not found in path: %s
 
                     (is the mapping appropriate for %s?)""" % (
-                        to_native(e), path, url))
+                        to_native(missing[k]), path, url))
                 continue
 
-            ansible_facts[k] = value
+            ansible_facts[k] = values[k]
 
         result["ansible_facts"] = result.get("ansible_facts", {self.ALREADY_RESOLVED_MARKER: True})
         result["ansible_facts"].update(ansible_facts)
         return result
 
-    @staticmethod
-    def resolve_path(vector, path):
-        value = vector
-        for p in path.split("."):
-            value = value[p]
-        return value
-
-    @staticmethod
-    def replace_key_value(data, key, old, new):
-        if not isinstance(data, dict):
-            return
-
-        if key in data:
-            to_replace = data[key]
-            if isinstance(to_replace, str):
-                data[key] = to_replace.replace(old, new)
-
-        for k, v in data.items():
-            if isinstance(v, dict):
-                ActionModule.replace_key_value(v, key, old, new)
+    def _fetch(self, url, replace):
+        # returns the future of the parsed document with the replacements applied
+        key = (url, json.dumps(replace, sort_keys=True, default=str))
+
+        future = self._documents.get(key)
+        if future is None:
+            future = self._documents[key] = self._executor.submit(self._load, url, replace)
+
+        return future
+
+    def _load(self, url, replace):
+        if self._http_cache:
+            f = load_yaml(self._http_cache.open_url(url), self._http_cache)
+        else:
+            f = load_yaml(open_url(url).read())
+
+        replace_key_values(f, replace)
+
+        return f
+
+    def demand(self, mapping, nested, task_vars):
+        """
+        Returns whether a file or one of its nested files provides a variable
+        that is not defined yet.
+        """
+        if any(task_vars.get(k) is None for k in mapping or dict()):
+            return True
+
+        return any(self.demand(*self._nested_mapping(n, task_vars), task_vars) for n in nested)
+
+    def _nested_mapping(self, n, task_vars):
+        recursive = n.get("recursive", True)
+        var = self._templar.template(n.get("meta_var"))
+        nested_mapping = n.get("mapping", task_vars.get(var, dict()).get("mapping"))
+        next_nested = n.get("nested", task_vars.get(var, dict()).get("nested", list())) if recursive else list()
+        return nested_mapping, next_nested
+
+    def _release_vector_cached_facts(self, task_vars):
+        # the release vector cache is keyed by the release vector arguments,
+        # so the lookup is delegated to the metal_stack_release_vector action plugin
+        if not task_vars.get("metal_stack_release_vectors") or self._shared_loader_obj is None:
+            return None
+
+        release_vector_action = self._shared_loader_obj.action_loader.get(
+            self.RELEASE_VECTOR_ACTION, class_only=True)
+        if release_vector_action is None:
+            return None
+
+        try:
+            return release_vector_action.cached_facts(self._templar, task_vars)
+        except AnsibleError as e:
+            # e.g. the vectors reference variables that are not defined yet
+            display.warning("unable to read the release vector cache, resolving the files instead: %s" % to_native(e))
+            return None
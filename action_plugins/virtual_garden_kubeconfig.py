@@ -3,13 +3,16 @@
 
 from yaml import safe_load
 import base64
+import importlib.util
+import os
+import sys
 from datetime import datetime, timedelta, timezone
 
 from ansible.plugins.action import ActionBase
 from ansible.module_utils._text import to_native
 from ansible.module_utils.six import PY3
 
-from kubernetes import client, config, dynamic
+from kubernetes import client
 from kubernetes.client.rest import ApiException
 
 HAS_JWT = True
@@ -27,6 +30,23 @@ except ImportError:
     display = Display()
 
 
+def _load_module_utils(name):
+    # module_utils of a role are only provided to modules, so controller-side plugins
+    # load them from their path, such that the role directory is not added to sys.path
+    module_name = "metal_stack_ansible_common_" + name
+    module = sys.modules.get(module_name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "module_utils", name + ".py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module = sys.modules.setdefault(module_name, module)
+    return module
+
+
+k8s_client_pool = _load_module_utils("k8s_client_pool")
+
+
 def b64decode(source):
     content = base64.b64decode(source)
     if PY3:
@@ -61,17 +81,12 @@ class ActionModule(ActionBase):
                 return result
 
         try:
-            if kubeconfig:
-                if isinstance(kubeconfig, str) or kubeconfig is None:
-                    api_client = config.new_client_from_config(config_file=kubeconfig)
-                elif isinstance(kubeconfig, dict):
-                    api_client = config.new_client_from_config_dict(config_dict=kubeconfig)
-                else:
-                    result["failed"] = True
-                    result["msg"] = "error while reading kubeconfig parameter: a string or dict expected, but got %s instead" % type(kubeconfig)
-                    return result
-            else:
-                api_client = config.new_client_from_config()
+            # clients are shared across invocations, which keeps their connections alive
+            api_client = k8s_client_pool.api_client(kubeconfig or None)
+        except TypeError as e:
+            result["failed"] = True
+            result["msg"] = "error while reading kubeconfig parameter: " + to_native(e)
+            return result
         except Exception as e:
             result["failed"] = True
             result["msg"] = "unable to create kubernetes client: " + to_native(e)
@@ -96,7 +111,7 @@ class ActionModule(ActionBase):
 
             expires_at = claims['exp']
 
-        garden = dynamic.DynamicClient(client=api_client).resources.get(api_version='operator.gardener.cloud/v1alpha1', kind='Garden').get(name=garden_name)
+        garden = k8s_client_pool.dynamic_client_of(api_client).resources.get(api_version='operator.gardener.cloud/v1alpha1', kind='Garden').get(name=garden_name)
         server = 'api.' + garden.spec.virtualCluster.dns.domains[0].name
 
         if port is None:
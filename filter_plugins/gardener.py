@@ -3,21 +3,34 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import base64
+import importlib.util
+import os
+import sys
 import yaml
 import json
 
-from kubernetes import config, client
-
 from ansible.plugins.test.core import version_compare
 
 
-def shoot_admin_kubeconfig(kubeconfig, project_namespace, shoot_name, expiry_seconds=28800):
-    data = yaml.safe_load(kubeconfig)
+def _load_module_utils(name):
+    # module_utils of a role are only provided to modules, so controller-side plugins
+    # load them from their path, such that the role directory is not added to sys.path
+    module_name = "metal_stack_ansible_common_" + name
+    module = sys.modules.get(module_name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "module_utils", name + ".py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module = sys.modules.setdefault(module_name, module)
+    return module
+
 
-    configuration = client.Configuration()
-    config.load_kube_config_from_dict(data, client_configuration=configuration)
+k8s_client_pool = _load_module_utils("k8s_client_pool")
 
-    api = client.ApiClient(configuration=configuration)
+
+def shoot_admin_kubeconfig(kubeconfig, project_namespace, shoot_name, expiry_seconds=28800):
+    api = k8s_client_pool.api_client(yaml.safe_load(kubeconfig))
 
     kubeconfig_request = {
         'apiVersion': 'authentication.gardener.cloud/v1alpha1',
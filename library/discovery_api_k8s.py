@@ -4,14 +4,15 @@
 from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
-from kubernetes import config, dynamic
 from kubernetes.client.rest import ApiException
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.k8s_client_pool import dynamic_client as k8s_dynamic_client
 
 
 def run_module():
     module_args = dict(
         api_version=dict(type='str', required=False),
+        group=dict(type='str', required=False),
         kind=dict(type='str', required=False),
         kubeconfig=dict(type='raw', no_log=True, required=False),
     )
@@ -29,24 +30,20 @@ def run_module():
     if module.check_mode:
         module.exit_json(**result)
 
-    kubeconfig = module.params.get('kubeconfig')
-
-    if isinstance(kubeconfig, str) or kubeconfig is None:
-        api_client = config.new_client_from_config(config_file=kubeconfig)
-    elif isinstance(kubeconfig, dict):
-        api_client = config.new_client_from_config_dict(config_dict=kubeconfig)
-    else:
+    try:
+        dynamic_client = k8s_dynamic_client(module.params.get('kubeconfig'))
+    except TypeError as e:
         module.fail_json(
-            msg="Error while reading kubeconfig parameter - a string or dict expected, but got %s instead" % type(kubeconfig), **result)
-
-    dynamic_client = dynamic.DynamicClient(client=api_client)
+            msg="Error while reading kubeconfig parameter - %s" % e, **result)
 
     api_version = module.params.get('api_version', None)
+    group = module.params.get('group', None)
     kind = module.params.get('kind', None)
 
     try:
+        # only the resources of the given group and version are requested from the api server
         api_response = dynamic_client.resources.search(
-            api_version=api_version, kind=kind)
+            group=group, api_version=api_version, kind=kind)
     except ApiException as e:
         module.fail_json(
             msg="Exception when searching discovery api: %s\n" % e, **result)
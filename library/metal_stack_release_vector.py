@@ -34,6 +34,7 @@ options:
                 description:
                     - The URL where the release vector artifact resides.
                     - If the URL starts with the prefix "oci://", the release vector is downloaded as an OCI artifact.
+                    - If the URL starts with the prefix "oci-layout://", the release vector is read from a local OCI image layout directory or tarball, which is given in the form oci-layout://<path>#<reference>. Nested vectors and roles of such a release vector are read from the same layout.
                     - If not starting with oci:// prefix, the module downloads the URL using ansible.module_utils.urls.
                 required: true
                 type: str
@@ -59,6 +60,8 @@ options:
                     - The elements of this option contain the same options as the vectors option with the single difference of having a "url_path" instead of an "url" option.
                     - The "url_path" is a dotted path to a value in the release vector.
                     - Variable mappings of nested releases do not overwrite variables from the parent release vector mapping.
+                    - Nested release vectors can be nested again at any depth. A release vector that is nested in itself fails the module.
+                    - Release vectors that are referenced by several parents with the same options (e.g. a vector shared by partner vectors) are downloaded and resolved only once per module run.
                 required: false
                 type: list
                 elements: dict
@@ -68,9 +71,19 @@ options:
                     - By default it installs the roles from an "ansible-roles" dictionary defined on the root of the release vector.
                     - Alternatively, the path to the ansible roles dictionary can be overwritten using the ansible_roles_path option.
                     - This option can also be set through the metal_stack_release_vector_install_roles variable from somewhere in the task vars.
+                    - Installed roles carry a stamp file recording their version, source and digest. A role is only installed again when its stamp differs, roles without a stamp are left untouched with a warning unless reinstall_unstamped_roles is set.
+                    - Roles are extracted into a temporary directory next to the roles path and moved into place afterwards, such that interrupted installations do not leave partially installed roles.
                 required: false
                 default: true
                 type: bool
+            reinstall_unstamped_roles:
+                description:
+                    - If set to true, role directories without a stamp file are installed again once, which adopts roles installed by earlier versions of this module.
+                    - Roles without a stamp may also be maintained by hand, which is why this is not done by default.
+                    - This option can also be set through the metal_stack_release_vector_reinstall_unstamped_roles variable from somewhere in the task vars.
+                required: false
+                default: false
+                type: bool
             ansible_roles_path:
                 description:
                     - A dotted path to the "ansible-roles" dictionary in the release vector when using the install_roles option.
@@ -99,6 +112,7 @@ options:
                 description:
                     - Allows partial replacements of variable values that are returned as facts by this module.
                     - This allows for instance rewriting a registries different from the one's defined in the release vector.
+                    - Values of the given key are replaced everywhere in the release vector, including dictionaries inside of lists.
                     - This option can also be set through the metal_stack_release_vector_replacements variable from somewhere in the task vars.
                 required: false
                 type: list
@@ -156,9 +170,130 @@ options:
     cache:
         description:
             - Whether or not to utilize a cache file for early returning on repeated module executions.
+            - Cache entries are keyed by the given vectors and the variable mappings and replacements found in the task vars.
+            - The setup_yaml module picks up this cache for the vectors defined in the metal_stack_release_vectors variable when running in smart mode.
+            - Workers resolving the same vectors at the same time (e.g. with many forks) are serialized through a file lock, such that only the first worker resolves the vectors and the others pick up its result from the cache.
+        type: bool
+        required: false
+        default: true
+    cache_ttl:
+        description:
+            - The number of seconds after which a cache entry expires.
+            - If not set, cache entries do not expire.
+            - This option can also be set through the metal_stack_release_vector_cache_ttl variable from somewhere in the task vars.
+        type: int
+        required: false
+    cache_revalidate:
+        description:
+            - Whether or not to check if the digests of the cached OCI release vectors are still up-to-date before returning a cache entry.
+            - This is done with a cheap HEAD request for every OCI release vector.
+            - Cache entries are only discarded if a digest changed, if the registry is not reachable the cache entry is returned.
         type: bool
         required: false
         default: true
+    parallelism:
+        description:
+            - The number of workers used for downloading release vectors and their nested vectors as well as for installing ansible roles concurrently.
+            - With a value greater than 1, downloads are fanned out to a bounded worker pool while the processing order remains the same, such that the first defined value of a variable still wins.
+            - Installation errors of ansible roles are collected and reported together.
+            - This option can also be set through the metal_stack_release_vector_parallelism variable from somewhere in the task vars.
+        type: int
+        required: false
+        default: 1
+    oci_layout:
+        description:
+            - The path to an OCI image layout directory or tarball, from which all OCI release vectors and roles are read instead of their registries.
+            - Artifacts are looked up by their full reference (e.g. ghcr.io/metal-stack/releases:v0.1.0) in the "org.opencontainers.image.ref.name" annotation and read through memory-mapped files.
+            - Manifests and blobs read from a layout are verified against their digests and sizes.
+            - Cosign verifications take place when the layout is exported, the layout does not contain the signatures. Reading a vector or role with cosign options from a layout fails, so these options need to be removed where layouts are used.
+        type: str
+        required: false
+    oci_layout_export:
+        description:
+            - The path of an OCI image layout to export all resolved OCI release vectors, nested vectors and ansible roles into, such that they can be resolved without network access through the oci_layout option.
+            - If the path ends with ".tar", a tarball is written, otherwise a directory. Existing layout directories are extended.
+            - Release vectors downloaded from URLs and roles installed from git repositories can not be exported.
+            - With this option, the cache option has no effect.
+        type: str
+        required: false
+    oci_registry_mirrors:
+        description:
+            - Mirrors to pull OCI release vectors and roles through, like a Harbor or Zot pull-through cache, keyed by the host of the upstream registry (e.g. ghcr.io).
+            - A mirror is given by its URL (e.g. https://harbor.example.com/ghcr-proxy), a path in the URL prefixes the repositories of the upstream registry. Credentials of a mirror can be given with a dict containing the url, username and password keys.
+            - The mirrors are probed once per module run and tried in the order of their latency. The upstream registry is tried after all healthy mirrors, registries that failed are skipped for 30 seconds.
+            - Cosign still verifies artifacts against the upstream registry by the digest of the pulled manifest.
+            - This option can also be set through the metal_stack_release_vector_registry_mirrors variable from somewhere in the task vars.
+        type: dict
+        required: false
+    oci_registry_hedging:
+        description:
+            - Whether or not to send manifest requests to the next registry in line when a registry responds considerably slower than its usual latency. The first response is taken.
+            - This only has an effect in combination with oci_registry_mirrors.
+        type: bool
+        required: false
+        default: true
+    trace_file:
+        description:
+            - An optional path to write the recorded timings of this module run to in the Chrome trace event format.
+            - The file can be inspected with chrome://tracing or Perfetto in order to see which phases ran concurrently.
+        type: str
+        required: false
+    http_cache:
+        description:
+            - Whether or not to store release vectors downloaded from non-OCI URLs along with their ETag and Last-Modified headers in a local cache.
+            - Subsequent downloads are conditional requests, an unchanged release vector is taken from the cache.
+            - The downloaded files are stored in the "http" directory of the OCI cache and count towards oci_blob_cache_max_size_mb.
+        type: bool
+        required: false
+        default: true
+    git_mirror_cache:
+        description:
+            - Whether or not to keep a bare clone of the branches and tags of every git repository that ansible roles are installed from.
+            - Mirrors are fetched incrementally and role versions are exported from them using the git binary on the controller, such that a repository is only cloned once.
+            - Mirrors are stored in the "git" directory inside of $XDG_CACHE_HOME/metal-stack-release-vector or ~/.cache/metal-stack-release-vector.
+            - If git is not installed on the controller or a role version contains git submodules, the role is cloned through the ansible.builtin.git module.
+            - Exported roles do not contain the .git directory.
+        type: bool
+        required: false
+        default: false
+    role_defaults_cache:
+        description:
+            - Whether or not to store the default vars of roles included through the include_role_defaults option on disk.
+            - Entries are keyed by the role path and are valid as long as the files in the defaults and meta directories of the role and its dependencies are not modified.
+        type: bool
+        required: false
+        default: true
+    oci_blob_cache:
+        description:
+            - Whether or not to store downloaded OCI manifests and layers in a persistent, content-addressed cache.
+            - The manifest digest of a tag is revalidated with a cheap HEAD request, layers are only downloaded again when the digest changes.
+            - Parsed release vectors are kept in this cache as well, such that an unchanged release vector does not need to be parsed again.
+        type: bool
+        required: false
+        default: true
+    oci_blob_cache_dir:
+        description:
+            - The directory of the OCI cache.
+            - Defaults to "metal-stack-release-vector" inside of $XDG_CACHE_HOME or ~/.cache.
+            - This option can also be set through the metal_stack_release_vector_oci_blob_cache_dir variable from somewhere in the task vars, which is read by the setup_yaml module as well.
+        type: str
+        required: false
+    oci_blob_cache_max_size_mb:
+        description:
+            - The maximum size of the OCI cache in megabytes, least recently used entries are evicted when exceeded.
+            - This option can also be set through the metal_stack_release_vector_oci_blob_cache_max_size_mb variable from somewhere in the task vars, which is read by the setup_yaml module as well.
+        type: int
+        required: false
+        default: 1024
+    oci_cosign_verification_cache:
+        description:
+            - Whether or not to remember successful cosign verifications across runs in the OCI cache.
+            - A verification is stored as an empty marker in the "verifications" directory of the OCI cache, which is named by the hash of the verified manifest digest and the public key, certificate identity and OIDC issuer.
+            - Markers are trusted until they are evicted from the cache, so the cache directory must only be writable by the user running ansible.
+            - Without this option, verifications are only remembered for the current run.
+        type: bool
+        required: false
+        default: false
 author:
     - metal-stack
 notes:
@@ -166,6 +301,10 @@ notes:
     - Ansible roles that can be defined in the release vector as OCI artifacts and installed by this module are expected to be metal-stack ansible-role OCI artifacts including a layer typed "application/vnd.metal-stack.ansible-role.v1.tar+gzip".
     - This module depends on the [opencontainers]("https://github.com/vsoch/oci-python") library.
     - If cosign validation is desired, the module depends on cosign to be installed on the host system.
+    - OCI layers are verified against their digest while they are downloaded. Without the OCI cache, the layer of a release vector is only read up to the release vector and is not verified. Interrupted downloads are resumed with range requests, also from the next registry mirror, transient registry errors (connection errors and status codes 408, 429 and 5xx) are retried up to five times with a jittered exponential backoff.
+    - The module returns the wall-clock time and transferred bytes per phase (manifest, download, cosign, extract, parse, mapping, role_install, ...) and per vector or role under the timings key, which are also printed with -vvv.
+    - Variables that are already defined in the task vars are not overridden. Release vectors and nested vectors are only downloaded if they install ansible roles or provide a variable through their mapping that is not defined yet, such that pinning versions in the inventory saves the downloads. For this, mappings included through role defaults are only known once the roles are installed. When exporting an OCI layout, all vectors are downloaded regardless.
+    - Cosign verifies the downloaded manifest digest instead of the tag. Verifications run in the background while the layer is downloaded and successful verifications are remembered by digest and verification policy, see oci_cosign_verification_cache.
 '''
 
 EXAMPLES = '''
@@ -5,9 +5,10 @@ from __future__ import (absolute_import, division, print_function)
 __metaclass__ = type
 
 import json
-from kubernetes import client, config
+from kubernetes import client
 from kubernetes.client.rest import ApiException
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.k8s_client_pool import api_client as k8s_api_client
 
 
 def run_module():
@@ -31,15 +32,11 @@ def run_module():
     if module.check_mode:
         module.exit_json(**result)
 
-    kubeconfig = module.params.get('kubeconfig')
-
-    if isinstance(kubeconfig, str) or kubeconfig is None:
-        api_client = config.new_client_from_config(config_file=kubeconfig)
-    elif isinstance(kubeconfig, dict):
-        api_client = config.new_client_from_config_dict(config_dict=kubeconfig)
-    else:
+    try:
+        api_client = k8s_api_client(module.params.get('kubeconfig'))
+    except TypeError as e:
         module.fail_json(
-            msg="Error while reading kubeconfig parameter - a string or dict expected, but got %s instead" % type(kubeconfig), **result)
+            msg="Error while reading kubeconfig parameter - %s" % e, **result)
 
     api_instance = client.CoreV1Api(api_client)
 
@@ -19,6 +19,10 @@ version_added: "2.9"
 description:
     - This module maps contents of a remote YAML file to ansible_facts according to a given variable mapping. 
     - Within a YAML file, it is also possible to point to other YAML files, which will then be resolved recursively.
+    - Variables that are already defined are not overridden. Files (including their nested files) that only provide
+      variables which are already defined are not downloaded at all.
+    - Every file is downloaded and parsed only once per module run, even if it is referenced multiple times with the same
+      replacements. The nested files of a file are downloaded concurrently.
     - This module can pick up some variables "magically", which makes the module very versatile
       but also causes some conventions that need to be followed when using this module. 
     - Please check out the examples of how to use it.
@@ -41,10 +45,20 @@ options:
             - Can be used to disable recursive resolution of other files. This can be useful in certain situations.
         required: false
         default: true
+    http_cache:
+        description:
+            - Stores downloaded files along with their ETag and Last-Modified headers in a local cache.
+              Subsequent downloads are conditional requests, an unchanged file is taken from the cache.
+              Parsed documents are cached by their content digest, such that unchanged files do not need to be parsed again.
+              The cache is shared with the metal_stack_release_vector module, its location and size are taken from the variables
+              `metal_stack_release_vector_oci_blob_cache_dir` and `metal_stack_release_vector_oci_blob_cache_max_size_mb`.
+            - This parameter can be "magically" provided by defining the variable `setup_yaml_http_cache`
+        required: false
+        default: true
     replace:
         description:
             - A list of replacements that can be used for recursively replacing string values for given keys in
-              the remote file content.
+              the remote file content, including dictionaries inside of lists.
         required: false
 author:
     - metal-stack
@@ -25,6 +25,7 @@ options:
         description:
             - The kubeconfig used for finding the garden resource.
             - Will be looked up from environment in case not defined.
+            - Kubernetes clients are shared across invocations with the same kubeconfig content, such that connections to the api server are reused (e.g. in loops).
     port:
         description:
             - The port that the virtual garden is exposed on. the default is 443.
@@ -51,6 +52,7 @@ author:
 notes:
     - Relies on the kubernetes python client library.
     - The refresh_minutes parameter does only have effect when pyjwt is installed.
+    - API discovery documents are cached in the discovery cache of kubectl (C(~/.kube/cache/discovery) or C($KUBECACHEDIR/discovery)) for six hours.
 '''
 
 EXAMPLES = '''
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from collections import defaultdict
+
+from kubernetes import config, dynamic
+from kubernetes.config import kube_config
+from kubernetes.dynamic.discovery import DISCOVERY_PREFIX, LazyDiscoverer, ResourceGroup
+from kubernetes.dynamic.exceptions import ServiceUnavailableError
+from kubernetes.dynamic.resource import Resource, ResourceList
+
+# the number of kubeconfigs whose clients are kept at the same time
+MAX_CLIENTS = 16
+
+# seconds discovery documents are read from the disk cache, same as kubectl
+DISCOVERY_CACHE_TTL = 6 * 60 * 60
+
+# the aggregated discovery documents contain the resources of all groups,
+# api servers not serving them respond with the list of groups
+AGGREGATED_DISCOVERY_ACCEPT = ",".join([
+    "application/json;g=apidiscovery.k8s.io;v=v2;as=APIGroupDiscoveryList",
+    "application/json;g=apidiscovery.k8s.io;v=v2beta1;as=APIGroupDiscoveryList",
+    "application/json",
+])
+
+# kubectl replaces these characters of the server url for its cache directory
+_ILLEGAL_FILE_CHARACTERS = re.compile(r"[^(\w/.)]")
+
+_clients = dict()
+_lock = threading.Lock()
+
+
+def kubeconfig_fingerprint(kubeconfig=None):
+    """
+    Returns a digest identifying a kubeconfig, which is either given as a path,
+    as a dict or None for the default kubeconfig. Kubeconfig files are
+    identified by their content, such that modified files lead to new clients.
+    """
+    h = hashlib.sha256()
+
+    if kubeconfig is None or isinstance(kubeconfig, str):
+        paths = kubeconfig or kube_config.KUBE_CONFIG_DEFAULT_LOCATION
+        for path in paths.split(kube_config.ENV_KUBECONFIG_PATH_SEPARATOR):
+            path = os.path.abspath(os.path.expanduser(path))
+            h.update(b"file:" + path.encode("utf-8") + b"\0")
+            try:
+                with open(path, "rb") as f:
+                    h.update(f.read())
+            except OSError:
+                # the kubernetes client reports missing files on its own
+                pass
+    elif isinstance(kubeconfig, dict):
+        h.update(b"dict:" + json.dumps(kubeconfig, sort_keys=True, default=str).encode("utf-8"))
+    else:
+        raise TypeError("a string or dict expected, but got %s instead" % type(kubeconfig))
+
+    return h.hexdigest()
+
+
+def api_client(kubeconfig=None):
+    """
+    Returns the kubernetes api client for a kubeconfig given as a path, as a
+    dict or None for the default kubeconfig.
+
+    Clients are shared for the lifetime of the process, such that their
+    connection pools are kept alive across plugin invocations and connections
+    to the api server are not negotiated again.
+    """
+    return _entry(kubeconfig)["api_client"]
+
+
+def dynamic_client(kubeconfig=None):
+    """
+    Returns the dynamic client for a kubeconfig, which shares the connections
+    of the api client and discovers the api resources only once. Discovery
+    documents are cached on disk, see CachedDiscoverer.
+    """
+    return _dynamic_client(_entry(kubeconfig))
+
+
+def dynamic_client_of(api_client):
+    """
+    Returns the dynamic client sharing the pool entry of an api client, which
+    was returned by api_client before. The kubeconfig is not read again, such
+    that both clients always belong to the same kubeconfig.
+    """
+    with _lock:
+        entry = next((e for e in _clients.values() if e["api_client"] is api_client), None)
+
+    if entry is None:
+        # the entry was evicted in the meantime, the client is still usable though
+        entry = dict(api_client=api_client, lock=threading.Lock())
+
+    return _dynamic_client(entry)
+
+
+def _dynamic_client(entry):
+    with entry["lock"]:
+        if entry.get("dynamic_client") is None:
+            entry["dynamic_client"] = dynamic.DynamicClient(client=entry["api_client"], discoverer=CachedDiscoverer)
+        return entry["dynamic_client"]
+
+
+def discovery_cache_dir(host):
+    """
+    Returns the directory of the discovery cache for an api server url, which
+    is the same as the one of kubectl, such that both share their documents.
+    """
+    parent = os.environ.get("KUBECACHEDIR") or os.path.join(os.path.expanduser("~"), ".kube", "cache")
+    host = host.replace("https://", "", 1).replace("http://", "", 1)
+    return os.path.join(parent, "discovery", _ILLEGAL_FILE_CHARACTERS.sub("_", host))
+
+
+class CachedDiscoverer(LazyDiscoverer):
+    """
+    Discovers the api resources lazily like the default discoverer of the
+    dynamic client, but keeps the discovery documents in the disk cache of
+    kubectl (servergroups.json and <group>/<version>/serverresources.json
+    below ~/.kube/cache/discovery/<host>) for DISCOVERY_CACHE_TTL seconds.
+
+    Refreshes fetch the aggregated discovery documents, which contain the
+    resources of all groups with a single request per api prefix, and fall
+    back to requesting the resources of every group version when it is
+    searched for, if the api server does not serve them.
+    """
+
+    def __init__(self, client, cache_file=None):
+        # the cache file of the kubernetes client is never written, such that
+        # the discoverer always starts with an empty in-memory cache
+        self._cache_dir = discovery_cache_dir(client.configuration.host)
+        self._not_before = 0
+        LazyDiscoverer.__init__(self, client, os.path.join(self._cache_dir, ".osrcp.json"))
+
+    def invalidate_cache(self):
+        # searches invalidate the cache if nothing was found, which needs to
+        # go to the api server, e.g. for freshly installed custom resources
+        self._not_before = time.time()
+        LazyDiscoverer.invalidate_cache(self)
+
+    def _write_cache(self):
+        # the documents are written to the disk cache when they are fetched
+        pass
+
+    def _load_server_info(self):
+        # the server version is only requested when it is used
+        pass
+
+    @property
+    def version(self):
+        if not self._cache.get("version"):
+            LazyDiscoverer._load_server_info(self)
+        return self._cache["version"]
+
+    def parse_api_groups(self, request_resources=False, update=False):
+        if self._cache.get("resources") and not update:
+            return self._cache["resources"]
+
+        group_list = None if update else self._read("servergroups.json")
+        resource_lists = dict()
+        if group_list is None:
+            group_list, resource_lists = self._fetch_groups()
+
+        loaded = self._cache.get("resources", dict())
+        groups = self.default_groups()
+        for group in group_list.get("groups") or []:
+            prefix = "api" if group["name"] == "" else DISCOVERY_PREFIX
+            preferred = (group.get("preferredVersion") or dict()).get("version")
+
+            versions = dict()
+            for v in group.get("versions") or []:
+                version = v["version"]
+                resource_list = resource_lists.get((group["name"], version))
+                resource_group = loaded.get(prefix, dict()).get(group["name"], dict()).get(version)
+
+                if resource_list is not None:
+                    resources = self._resources(prefix, group["name"], version, version == preferred,
+                                                resource_list.get("resources") or [])
+                elif resource_group is not None:
+                    resources = resource_group.resources
+                elif request_resources:
+                    resources = self.get_resources_for_api_version(prefix, group["name"], version, version == preferred)
+                else:
+                    resources = dict()
+
+                versions[version] = ResourceGroup(version == preferred, resources=resources)
+            groups[prefix][group["name"]] = versions
+
+        self._cache["resources"] = loaded
+        loaded.update(groups)
+        return loaded
+
+    def get_resources_for_api_version(self, prefix, group, version, preferred):
+        name = os.path.join(group, version, "serverresources.json")
+
+        resource_list = self._read(name)
+        if resource_list is None:
+            try:
+                resource_list = self._get("/" + "/".join(filter(None, [prefix, group, version])))
+            except (ServiceUnavailableError, ValueError):
+                # unavailable aggregated api servers must not fail the discovery of others
+                resource_list = dict()
+            else:
+                self._write(name, resource_list)
+
+        return self._resources(prefix, group, version, preferred, resource_list.get("resources") or [])
+
+    def _fetch_groups(self):
+        """
+        Fetches the api groups and their versions. Where the api server serves
+        aggregated discovery documents, the resources of the group versions
+        are returned, too, mapped by group and version.
+        """
+        group_list = dict(kind="APIGroupList", apiVersion="v1", groups=[])
+        resource_lists = dict()
+
+        for prefix in ["api", DISCOVERY_PREFIX]:
+            document = self._get("/" + prefix, accept=AGGREGATED_DISCOVERY_ACCEPT)
+
+            if document.get("kind") == "APIGroupDiscoveryList":
+                for item in document.get("items") or []:
+                    group = self._convert_aggregated_group(item, resource_lists)
+                    if group is not None:
+                        group_list["groups"].append(group)
+            elif prefix == "api":
+                # the legacy group is served as a list of versions
+                versions = [dict(groupVersion=v, version=v) for v in document.get("versions") or []]
+                if versions:
+                    group_list["groups"].append(dict(name="", versions=versions, preferredVersion=versions[0]))
+            else:
+                group_list["groups"].extend(document.get("groups") or [])
+
+        self._write("servergroups.json", group_list)
+        for (group, version), resource_list in resource_lists.items():
+            self._write(os.path.join(group, version, "serverresources.json"), resource_list)
+
+        return group_list, resource_lists
+
+    @staticmethod
+    def _convert_aggregated_group(item, resource_lists):
+        # converts an APIGroupDiscovery into an APIGroup and the APIResourceLists
+        # of its versions, which are the documents of the kubectl cache
+        name = (item.get("metadata") or dict()).get("name") or ""
+
+        versions = []
+        for v in item.get("versions") or []:
+            group_version = "/".join(filter(None, [name, v["version"]]))
+            versions.append(dict(groupVersion=group_version, version=v["version"]))
+
+            if v.get("freshness", "Current") != "Current":
+                # resources of stale group versions are requested on their own
+                continue
+
+            resources = []
+            for r in v.get("resources") or []:
+                kind = (r.get("responseKind") or dict()).get("kind")
+                if not kind:
+                    continue
+
+                namespaced = r.get("scope") == "Namespaced"
+                resource = dict(name=r["resource"], singularName=r.get("singularResource", ""),
+                                namespaced=namespaced, kind=kind, verbs=r.get("verbs") or [])
+                for key in ["shortNames", "categories"]:
+                    if r.get(key):
+                        resource[key] = r[key]
+                resources.append(resource)
+
+                for s in r.get("subresources") or []:
+                    resources.append(dict(name="%s/%s" % (r["resource"], s["subresource"]), singularName="",
+                                          namespaced=namespaced, verbs=s.get("verbs") or [],
+                                          kind=(s.get("responseKind") or dict()).get("kind") or kind))
+
+            resource_lists[(name, v["version"])] = dict(kind="APIResourceList", apiVersion="v1",
+                                                        groupVersion=group_version, resources=resources)
+
+        if not versions:
+            return None
+
+        # the versions of aggregated discovery documents are ordered by preference
+        return dict(name=name, versions=versions, preferredVersion=versions[0])
+
+    def _resources(self, prefix, group, version, preferred, resources_raw):
+        # same as get_resources_for_api_version of the kubernetes client, which
+        # fetches the resources on its own
+        resources = defaultdict(list)
+        subresources = dict()
+
+        for subresource in resources_raw:
+            if "/" in subresource["name"]:
+                resource, name = subresource["name"].split("/", 1)
+                subresources.setdefault(resource, dict())[name] = dict(subresource)
+
+        for resource in resources_raw:
+            if "/" in resource["name"]:
+                continue
+
+            resource = {k: v for k, v in resource.items()
+                        if k not in ["prefix", "group", "api_version", "client", "preferred"]}
+            resources[resource["kind"]].append(Resource(
+                prefix=prefix,
+                group=group,
+                api_version=version,
+                client=self.client,
+                preferred=preferred,
+                subresources=subresources.get(resource["name"]),
+                **resource
+            ))
+            resource_list = ResourceList(self.client, group=group, api_version=version, base_kind=resource["kind"])
+            resources[resource_list.kind].append(resource_list)
+
+        return resources
+
+    def _get(self, path, accept=None):
+        params = dict(header_params=dict(Accept=accept)) if accept else dict()
+        document = self.client.request("GET", path, serializer=lambda _, d: d, **params)
+        if not isinstance(document, dict):
+            raise ValueError("invalid discovery document at %s" % path)
+        return document
+
+    def _read(self, name):
+        path = os.path.join(self._cache_dir, name)
+        try:
+            if os.stat(path).st_mtime < max(time.time() - DISCOVERY_CACHE_TTL, self._not_before):
+                return None
+            with open(path) as f:
+                document = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return document if isinstance(document, dict) else None
+
+    def _write(self, name, document):
+        path = os.path.join(self._cache_dir, name)
+        try:
+            os.makedirs(os.path.dirname(path), mode=0o750, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        except OSError:
+            # failing to write the cache is not worth failing the discovery
+            return
+
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(document, f)
+            os.chmod(tmp, 0o660)
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError):
+            os.unlink(tmp)
+
+
+def _entry(kubeconfig):
+    key = kubeconfig_fingerprint(kubeconfig)
+
+    with _lock:
+        entry = _clients.pop(key, None)
+        if entry is None:
+            if isinstance(kubeconfig, dict):
+                client = config.new_client_from_config_dict(config_dict=kubeconfig)
+            else:
+                client = config.new_client_from_config(config_file=kubeconfig)
+            entry = dict(api_client=client, lock=threading.Lock())
+
+        # the entries are kept in the order of their last use
+        _clients[key] = entry
+
+        # evicted clients may still be in use, so their connections are
+        # only closed once they are garbage collected
+        while len(_clients) > MAX_CLIENTS:
+            _clients.pop(next(iter(_clients)))
+
+        return entry
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import itertools
+import json
+import marshal
+import os
+import tempfile
+import threading
+
+from urllib.error import HTTPError
+
+from ansible.module_utils.urls import open_url
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+
+    display = Display()
+
+
+class DiskCache():
+    """
+    A size-bounded store of files by kind and digest below the cache directory
+    shared by the release vector plugins. The least recently used entries are
+    evicted as soon as the store exceeds its maximum size.
+
+    The size of the store is only determined by walking it once, afterwards it
+    is tracked on every put and only evictions walk the store again.
+    """
+
+    # all kinds are accounted for, regardless of the plugin that put them
+    KINDS = ("blobs", "http", "manifests", "parsed", "verifications")
+    # evictions free the store below this fraction of its maximum size, such
+    # that the following puts do not evict again right away
+    EVICTION_WATERMARK = 0.9
+    # the default of the oci_blob_cache_max_size_mb option of metal_stack_release_vector
+    DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def default_path():
+        cache_home = os.environ.get(
+            "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+        return os.path.join(cache_home, "metal-stack-release-vector")
+
+    def get_parsed(self, digest):
+        data = self._get("parsed", digest)
+        if data is None:
+            return None
+        try:
+            return marshal.loads(data)
+        except Exception:
+            return None
+
+    def put_parsed(self, digest, content):
+        try:
+            data = marshal.dumps(content)
+        except ValueError:
+            # documents with types that cannot be marshalled are not cached
+            return
+        self._put("parsed", digest, [data]).close()
+
+    def _file_path(self, kind, digest, suffix=""):
+        algorithm, _, encoded = digest.partition(":")
+        if not algorithm.isalnum() or not encoded.isalnum():
+            raise ValueError("invalid digest: %s" % digest)
+        return os.path.join(self._path, kind, algorithm, encoded + suffix)
+
+    def _get(self, kind, digest, suffix=""):
+        path = self._file_path(kind, digest, suffix)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            return None
+        self._touch(path)
+        return content
+
+    def _put(self, kind, digest, chunks, verify=None, suffix=""):
+        path = self._file_path(kind, digest, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            if verify:
+                verify()
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        # opened before the eviction, which may remove the file again in case it exceeds the cache size
+        f = open(path, 'rb')
+        self._grow(os.fstat(f.fileno()).st_size - replaced)
+        return f
+
+    @staticmethod
+    def _touch(path):
+        # the modification time is used for determining the least recently used entries
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _grow(self, size):
+        with self._lock:
+            if self._size is None:
+                # the first walk already includes the entry that was put
+                self._size = sum(entry_size for _, entry_size, _ in self._entries())
+            else:
+                self._size += size
+
+            if self._size > self._max_size:
+                self._evict()
+
+    def _evict(self):
+        # entries put by other processes are only noticed here, so the size is
+        # determined again
+        entries = self._entries()
+        size = sum(entry_size for _, entry_size, _ in entries)
+
+        for _, entry_size, path in sorted(entries):
+            if size <= self._max_size * DiskCache.EVICTION_WATERMARK:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+        self._size = size
+
+    def _entries(self):
+        entries = []
+        for root, _, files in itertools.chain(*[os.walk(os.path.join(self._path, kind)) for kind in self.KINDS]):
+            for name in files:
+                if name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+
+class HttpCache(DiskCache):
+    """
+    Stores downloaded documents along with their ETag and Last-Modified headers,
+    such that subsequent downloads are conditional requests and an unchanged
+    document is not transferred again.
+
+    Entries are keyed by the digest of their url, the document is stored as is
+    next to a small file with its headers and the digest of the document. They
+    are evicted along with the other entries of the shared disk cache, which is
+    shared by the setup_yaml and metal_stack_release_vector plugins.
+    """
+
+    def open_url(self, url):
+        key = "sha256:" + hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+        entry, body = self._read(key)
+
+        headers = dict()
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry.get("etag")
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry.get("last_modified")
+
+        try:
+            if headers:
+                rsp = open_url(url, headers=headers)
+            else:
+                rsp = open_url(url)
+        except HTTPError as e:
+            if e.code == 304 and entry:
+                display.vvv("- %s was not modified, using cached content" % url)
+                return body
+            raise
+
+        body = rsp.read()
+
+        etag = rsp.headers.get("ETag")
+        last_modified = rsp.headers.get("Last-Modified")
+        if not isinstance(etag, str):
+            etag = None
+        if not isinstance(last_modified, str):
+            last_modified = None
+
+        if etag or last_modified:
+            self._put("http", key, [body]).close()
+            self._put("http", key, [json.dumps(dict(
+                url=url,
+                etag=etag,
+                last_modified=last_modified,
+                digest="sha256:" + hashlib.sha256(body).hexdigest(),
+            )).encode('utf-8')], suffix=".json").close()
+
+        return body
+
+    def _read(self, key):
+        # an entry is only used if its document is still present and matches the
+        # headers, which is not the case if it was evicted or written concurrently
+        try:
+            entry = json.loads(self._get("http", key, suffix=".json") or b"null")
+        except ValueError:
+            return None, None
+        if not isinstance(entry, dict):
+            return None, None
+
+        body = self._get("http", key)
+        if body is None or entry.get("digest") != "sha256:" + hashlib.sha256(body).hexdigest():
+            return None, None
+
+        return entry, body
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import hashlib
+
+from yaml import load as yaml_load
+
+try:
+    # the libyaml bindings parse large documents way faster than the pure-python loader
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+try:
+    from __main__ import display
+except ImportError:
+    from ansible.utils.display import Display
+
+    display = Display()
+
+
+def load_yaml(raw, cache=None):
+    """
+    Parses a yaml document. If a DiskCache is given, parsed documents are
+    cached by the digest of their content, which allows skipping the yaml
+    parsing for unchanged documents.
+    """
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8')
+
+    digest = "sha256:" + hashlib.sha256(raw).hexdigest()
+
+    if cache:
+        content = cache.get_parsed(digest)
+        if content is not None:
+            return content
+
+    content = yaml_load(raw, Loader=YamlLoader)
+
+    if cache:
+        cache.put_parsed(digest, content)
+
+    return content
+
+
+def dotted_path(vector, path):
+    """
+    Returns the value at a path of dot-separated keys, a KeyError is raised if
+    the path does not exist.
+    """
+    value = vector
+    for p in path.split("."):
+        value = value[p]
+    return value
+
+
+def replace_key_values(data, replacements):
+    """
+    Replaces substrings in the string values of the given keys anywhere in the
+    data, the replacements are dicts of key, old and new.
+    """
+    # applies all replacements in a single traversal of the data, multiple
+    # replacements of the same key are applied in the given order
+    by_key = dict()
+    for r in replacements:
+        by_key.setdefault(r.get("key"), list()).append((r.get("old"), r.get("new")))
+
+    if not by_key:
+        return
+
+    stack = [data]
+    while stack:
+        node = stack.pop()
+
+        if isinstance(node, dict):
+            for k, v in node.items():
+                if isinstance(v, str) and k in by_key:
+                    replaced = v
+                    for old, new in by_key[k]:
+                        replaced = replaced.replace(old, new)
+                    if replaced != v:
+                        node[k] = replaced
+                        display.vvv("- Replaced value %s with %s" % (v, replaced))
+                elif isinstance(v, (dict, list)):
+                    stack.append(v)
+        elif isinstance(node, list):
+            stack.extend(v for v in node if isinstance(v, (dict, list)))
+
+
+class VariableMapping():
+    """
+    A variable mapping compiled into a trie of path segments, such that the
+    values of all variables are looked up in a single traversal of a release
+    vector or yaml file, even if their paths share long prefixes.
+
+    The most recently used compiled mappings are kept for the lifetime of the
+    process and shared across nested files and hosts.
+    """
+    COMPILE_CACHE_SIZE = 256
+
+    def __init__(self, mapping):
+        self._mapping = dict(mapping)
+        # a node consists of its children by path segment and the variables
+        # pointing to the node
+        self._root = (dict(), list())
+
+        for name, path in self._mapping.items():
+            node = self._root
+            for p in path.split("."):
+                node = node[0].setdefault(p, (dict(), list()))
+            node[1].append(name)
+
+    @classmethod
+    def compile(cls, mapping):
+        if isinstance(mapping, VariableMapping):
+            return mapping
+
+        try:
+            return cls._compile(tuple(mapping.items()))
+        except TypeError:
+            # paths that are not hashable fail on compilation anyway
+            return cls(mapping)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=COMPILE_CACHE_SIZE)
+    def _compile(items):
+        return VariableMapping(dict(items))
+
+    def items(self):
+        return self._mapping.items()
+
+    def resolve(self, vector):
+        """
+        Returns the values of the variables found in the vector and the
+        KeyError for every variable whose path does not exist.
+        """
+        values = dict()
+        missing = dict()
+
+        stack = [(self._root, vector)]
+        while stack:
+            (children, names), value = stack.pop()
+
+            for name in names:
+                values[name] = value
+
+            for p, child in children.items():
+                try:
+                    stack.append((child, value[p]))
+                except KeyError as e:
+                    for name in self._names(child):
+                        missing[name] = e
+
+        return values, missing
+
+    @staticmethod
+    def _names(node):
+        stack = [node]
+        while stack:
+            children, names = stack.pop()
+            yield from names
+            stack.extend(children.values())
@@ -1,14 +1,35 @@
+import os
+import fcntl
 import sys
+import json
+import shutil
+import threading
+import time
+import hashlib
+import tempfile
+import tarfile
 import unittest
+from io import BytesIO
+from concurrent.futures import Future
 from unittest.mock import MagicMock, patch
 
 from test import ACTION_PLUGINS_PATH
+from test.registry import FakeRegistry, RELEASE_VECTOR_MEDIA_TYPE, ANSIBLE_ROLE_MEDIA_TYPE
 from mock import patch, MagicMock, call
 from ansible.playbook.task import Task
 from ansible.template import Templar
+try:
+    from ansible.template import trust_as_template
+except ImportError:
+    # templates are only marked as trusted since ansible-core 2.19
+    def trust_as_template(value):
+        return value
+from ansible.errors import AnsibleError
+from urllib.error import HTTPError
 
 sys.path.insert(0, ACTION_PLUGINS_PATH)
 from setup_yaml import ActionModule
+from metal_stack_release_vector import ActionModule as ReleaseVectorActionModule, RemoteResolver, OciBlobCache, OciLoader, CosignVerifier, VariableMapping, GitMirrorCache, RoleDefaultsCache, BlobDownload, load_yaml, replace_key_values, release_vector_cache, release_vector_documents
 
 
 SAMPLE_VECTOR_01 = """
@@ -47,6 +68,26 @@ docker-images:
 """
 
 
+RELEASE_VECTOR_01 = """
+docker-images:
+  metal-api:
+    tag: v0.7.8
+  masterdata-api:
+    tag: v0.7.1
+vectors:
+  nested:
+    url: https://example.com/nested.yaml
+"""
+
+RELEASE_VECTOR_02 = """
+docker-images:
+  metal-api:
+    tag: v0.0.2
+  metal-console:
+    tag: v0.4.2
+"""
+
+
 def open_url_mock(return_value, return_code=200):
     m = MagicMock()
     m.getcode.return_value = return_code
@@ -68,10 +109,15 @@ class SetupYAMLTest(unittest.TestCase):
 
         self.maxDiff = None
 
+        self.cache_home = tempfile.TemporaryDirectory()
+        self.env = patch.dict(os.environ, {"XDG_CACHE_HOME": self.cache_home.name})
+        self.env.start()
+
     def tearDown(self):
-        pass
+        self.env.stop()
+        self.cache_home.cleanup()
 
-    @patch("setup_yaml.open_url")
+    @patch.object(release_vector_cache, "open_url")
     def test_resolves(self, mock):
         mock.return_value = open_url_mock(SAMPLE_VECTOR_01)
 
@@ -99,7 +145,7 @@ class SetupYAMLTest(unittest.TestCase):
         self.assertIn("ansible_facts", actual)
         self.assertEqual(expected, actual["ansible_facts"])
 
-    @patch("setup_yaml.open_url")
+    @patch.object(release_vector_cache, "open_url")
     def test_nested_resolve(self, mock):
         mock.side_effect = [
             open_url_mock(SAMPLE_VECTOR_02),
@@ -139,7 +185,7 @@ class SetupYAMLTest(unittest.TestCase):
         self.assertIn("ansible_facts", actual)
         self.assertEqual(expected, actual["ansible_facts"])
 
-    @patch("setup_yaml.open_url")
+    @patch.object(release_vector_cache, "open_url")
     def test_doubly_nested_resolve(self, mock):
         mock.side_effect = [
             open_url_mock(SAMPLE_VECTOR_03),
@@ -193,7 +239,7 @@ class SetupYAMLTest(unittest.TestCase):
         self.assertIn("ansible_facts", actual)
         self.assertEqual(expected, actual["ansible_facts"])
 
-    @patch("setup_yaml.open_url")
+    @patch.object(release_vector_cache, "open_url")
     def test_nested_resolve_through_magic_vars(self, mock):
         mock.side_effect = [
             open_url_mock(SAMPLE_VECTOR_02),
@@ -244,7 +290,7 @@ class SetupYAMLTest(unittest.TestCase):
         self.assertIn("ansible_facts", actual)
         self.assertEqual(expected, actual["ansible_facts"])
 
-    @patch("setup_yaml.open_url")
+    @patch.object(release_vector_cache, "open_url")
     def test_nested_resolve_no_recursive(self, mock):
         mock.side_effect = [
             open_url_mock(SAMPLE_VECTOR_02),
@@ -283,7 +329,7 @@ class SetupYAMLTest(unittest.TestCase):
         self.assertIn("ansible_facts", actual)
         self.assertEqual(expected, actual["ansible_facts"])
 
-    @patch("setup_yaml.open_url")
+    @patch.object(release_vector_cache, "open_url")
     def test_resolves_not_overriding_existing_vars(self, mock):
         mock.return_value = open_url_mock(SAMPLE_VECTOR_01)
 
@@ -295,7 +341,8 @@ class SetupYAMLTest(unittest.TestCase):
             files=[
                 dict(
                     url="https://raw.githubusercontent.com/metal-stack/releases/master/release.yaml",
-                    mapping=dict(metal_api_image_tag="docker-images.metal-stack.control-plane.metal-api.tag"),
+                    mapping=dict(metal_api_image_tag="docker-images.metal-stack.control-plane.metal-api.tag",
+                                 metal_api_image_name="docker-images.metal-stack.control-plane.metal-api.name"),
                 ),
             ],
         )
@@ -308,13 +355,119 @@ class SetupYAMLTest(unittest.TestCase):
         mock.assert_called_with('https://raw.githubusercontent.com/metal-stack/releases/master/release.yaml')
 
         expected = dict({
+            'metal_api_image_name': 'metalstack/metal-api',
             plugin.ALREADY_RESOLVED_MARKER: True,
         })
 
         self.assertIn("ansible_facts", actual)
         self.assertEqual(expected, actual["ansible_facts"])
 
-    @patch("setup_yaml.open_url")
+    @patch.object(release_vector_cache, "open_url")
+    def test_skips_files_providing_only_existing_vars(self, mock):
+        mock.return_value = open_url_mock(SAMPLE_VECTOR_02)
+
+        task_vars = dict(
+            metal_api_image_tag='v0.0.1',
+        )
+
+        self.task.args = dict(
+            files=[
+                dict(
+                    url="https://raw.githubusercontent.com/metal-stack/releases/master/nested.yaml",
+                    mapping=dict(masterdata_api_image_tag="docker-images.metal-stack.control-plane.masterdata-api.tag"),
+                    nested=[
+                        dict(url_path="vectors.metal-stack.url",
+                             mapping=dict(metal_api_image_tag="docker-images.metal-stack.control-plane.metal-api.tag")),
+                    ],
+                ),
+            ],
+        )
+
+        plugin = ActionModule(self.task, self.connection, self.play_context, loader=None, templar=self.templar, shared_loader_obj=None)
+
+        actual = plugin.run(task_vars=task_vars)
+
+        mock.assert_called_once_with('https://raw.githubusercontent.com/metal-stack/releases/master/nested.yaml')
+        self.assertEqual(dict({
+            'masterdata_api_image_tag': 'v0.7.1',
+            plugin.ALREADY_RESOLVED_MARKER: True,
+        }), actual["ansible_facts"])
+
+        mock.reset_mock()
+        actual = plugin.run(task_vars=dict(task_vars, masterdata_api_image_tag='v0.0.1'))
+
+        mock.assert_not_called()
+        self.assertEqual({plugin.ALREADY_RESOLVED_MARKER: True}, actual["ansible_facts"])
+
+    @patch.object(release_vector_cache, "open_url")
+    def test_documents_are_fetched_once_per_run(self, mock):
+        documents = {
+            "https://example.com/parent.yaml": SAMPLE_VECTOR_02,
+            "https://example.com/siblings.yaml": SAMPLE_VECTOR_02.replace("vectors:\n", """vectors:
+  metal-stack-again:
+    url: https://raw.githubusercontent.com/metal-stack/releases/master/release.yaml
+  console:
+    url: https://raw.githubusercontent.com/metal-stack/releases/master/nested.yaml
+"""),
+            "https://raw.githubusercontent.com/metal-stack/releases/master/release.yaml": SAMPLE_VECTOR_01,
+            "https://raw.githubusercontent.com/metal-stack/releases/master/nested.yaml": SAMPLE_VECTOR_03,
+        }
+        # the sibling files of siblings.yaml are only able to pass the barrier when fetched concurrently
+        barrier = threading.Barrier(2, timeout=5)
+
+        def open_url(url):
+            if url.startswith("https://raw.githubusercontent.com"):
+                barrier.wait()
+            return open_url_mock(documents[url])
+
+        mock.side_effect = open_url
+
+        metal_api = dict(metal_api_image_tag="docker-images.metal-stack.control-plane.metal-api.tag")
+        self.task.args = dict(
+            files=[
+                dict(
+                    url="https://example.com/siblings.yaml",
+                    mapping=dict(masterdata_api_image_tag="docker-images.metal-stack.control-plane.masterdata-api.tag"),
+                    nested=[
+                        dict(url_path="vectors.metal-stack.url", mapping=metal_api),
+                        dict(url_path="vectors.metal-stack-again.url", mapping=metal_api),
+                        dict(url_path="vectors.console.url", recursive=False,
+                             mapping=dict(metal_console_image_tag="docker-images.metal-stack.control-plane.metal-console.tag")),
+                    ],
+                ),
+                dict(
+                    url="https://example.com/parent.yaml",
+                    mapping=metal_api,
+                    nested=[
+                        dict(url_path="vectors.metal-stack.url", mapping=metal_api),
+                    ],
+                ),
+            ],
+        )
+
+        plugin = ActionModule(self.task, self.connection, self.play_context, loader=None, templar=self.templar, shared_loader_obj=None)
+
+        actual = plugin.run(task_vars=None)
+
+        self.assertNotIn("failed", actual, actual.get("error"))
+        mock.assert_has_calls([
+            call("https://example.com/siblings.yaml"),
+            call("https://example.com/parent.yaml"),
+        ], any_order=True)
+        mock.assert_has_calls([
+            call('https://raw.githubusercontent.com/metal-stack/releases/master/release.yaml'),
+            call('https://raw.githubusercontent.com/metal-stack/releases/master/nested.yaml'),
+        ], any_order=True)
+        self.assertEqual(4, mock.call_count)
+
+        self.assertEqual(dict({
+            'masterdata_api_image_tag': 'v0.7.1',
+            'metal_api_image_tag': 'v0.7.8',
+            'metal_console_image_tag': 'v0.4.2',
+            plugin.ALREADY_RESOLVED_MARKER: True,
+        }), actual["ansible_facts"])
+
+    @patch.object(release_vector_cache, "open_url")
     def test_resolves_with_replace(self, mock):
         mock.return_value = open_url_mock(SAMPLE_VECTOR_01)
 
@@ -342,3 +495,1196 @@ class SetupYAMLTest(unittest.TestCase):
 
         self.assertIn("ansible_facts", actual)
         self.assertEqual(expected, actual["ansible_facts"])
+
+    @patch.object(release_vector_cache, "open_url")
+    def test_resolves_unmodified_from_http_cache(self, mock):
+        url = "https://raw.githubusercontent.com/metal-stack/releases/master/release.yaml"
+
+        first = open_url_mock(SAMPLE_VECTOR_01.encode('utf-8'))
+        first.headers = {"ETag": '"v1"'}
+        mock.side_effect = [first, HTTPError(url, 304, "Not Modified", {}, None)]
+
+        self.task.args = dict(
+            files=[
+                dict(
+                    url=url,
+                    mapping=dict(metal_api_image_tag="docker-images.metal-stack.control-plane.metal-api.tag"),
+                ),
+            ],
+        )
+
+        expected = dict({
+            'metal_api_image_tag': 'v0.7.8',
+            ActionModule.ALREADY_RESOLVED_MARKER: True,
+        })
+
+        for _ in range(2):
+            plugin = ActionModule(self.task, self.connection, self.play_context, loader=None, templar=self.templar, shared_loader_obj=None)
+            actual = plugin.run(task_vars=None)
+
+            self.assertEqual(expected, actual["ansible_facts"])
+
+        mock.assert_has_calls([
+            call(url),
+            call(url, headers={"If-None-Match": '"v1"'}),
+        ])
+
+    @patch.object(release_vector_cache, "open_url")
+    def test_parsed_documents_are_shared_with_release_vector_cache(self, mock):
+        mock.return_value = open_url_mock(SAMPLE_VECTOR_01.encode('utf-8'))
+
+        self.task.args = dict(
+            files=[
+                dict(
+                    url="https://raw.githubusercontent.com/metal-stack/releases/master/release.yaml",
+                    mapping=dict(metal_api_image_tag="docker-images.metal-stack.control-plane.metal-api.tag"),
+                ),
+            ],
+        )
+
+        digest = "sha256:" + hashlib.sha256(SAMPLE_VECTOR_01.encode('utf-8')).hexdigest()
+        cache_dir = os.path.join(self.cache_home.name, "release-vector-cache")
+
+        for task_vars, path in [(None, OciBlobCache.default_path()),
+                                (dict(metal_stack_release_vector_oci_blob_cache_dir=cache_dir), cache_dir)]:
+            plugin = ActionModule(self.task, self.connection, self.play_context, loader=None, templar=self.templar, shared_loader_obj=None)
+            plugin.run(task_vars=task_vars)
+
+            cache = OciBlobCache(path, max_size=OciBlobCache.DEFAULT_MAX_SIZE)
+            self.assertEqual(load_yaml(SAMPLE_VECTOR_01), cache.get_parsed(digest))
+
+    @patch.object(release_vector_cache, "open_url")
+    def test_returns_facts_from_release_vector_cache(self, mock):
+        mock.side_effect = lambda url, **_: open_url_mock(RELEASE_VECTOR_01.encode('utf-8'))
+
+        task_vars = dict(
+            release_url="https://example.com/release.yaml",
+            metal_stack_release_vectors=[dict(
+                url=trust_as_template("{{ release_url }}"),
+                variable_mapping_path="mapping",
+                install_roles=False,
+            )],
+            mapping=dict(metal_api_image_tag="docker-images.metal-api.tag"),
+        )
+        templar = Templar(loader=None, variables=task_vars)
+
+        shared_loader_obj = MagicMock()
+        shared_loader_obj.action_loader.get.return_value = ReleaseVectorActionModule
+
+        with tempfile.TemporaryDirectory() as tmp, patch("metal_stack_release_vector.tempfile.gettempdir", return_value=tmp):
+            task = MagicMock(Task)
+            task.action = 'metal_stack_release_vector'
+            task.async_val = False
+            task.args = dict()
+
+            plugin = ReleaseVectorActionModule(task, self.connection, self.play_context, loader=None, templar=templar, shared_loader_obj=None)
+            actual = plugin.run(task_vars=task_vars)
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+            self.assertEqual(1, mock.call_count)
+
+            self.task.args = dict(
+                files=[
+                    dict(
+                        url="https://example.com/other.yaml",
+                        mapping=dict(metal_api_image_tag="docker-images.metal-api.tag"),
+                    ),
+                ],
+            )
+
+            plugin = ActionModule(self.task, self.connection, self.play_context, loader=None, templar=templar, shared_loader_obj=shared_loader_obj)
+            # newer versions of ansible ignore the shared loader object that is passed
+            plugin._shared_loader_obj = shared_loader_obj
+            actual = plugin.run(task_vars=task_vars)
+
+        self.assertEqual(dict(metal_api_image_tag="v0.7.8"), actual["ansible_facts"])
+        self.assertEqual(1, mock.call_count)
+        shared_loader_obj.action_loader.get.assert_called_once_with("metal_stack_release_vector", class_only=True)
+
+
+class MetalStackReleaseVectorTest(unittest.TestCase):
+    task = MagicMock(Task)
+    play_context = MagicMock()
+    play_context.check_mode = False
+    connection = MagicMock()
+    templar = Templar(loader=None)
+
+    VECTORS = {
+        "https://example.com/release.yaml": RELEASE_VECTOR_01,
+        "https://example.com/nested.yaml": RELEASE_VECTOR_02,
+        "https://example.com/other.yaml": RELEASE_VECTOR_02,
+        "https://example.com/partner-a.yaml": "vectors:\n  shared:\n    url: https://example.com/shared.yaml\n",
+        "https://example.com/partner-b.yaml": "vectors:\n  shared:\n    url: https://example.com/shared.yaml\n",
+        "https://example.com/shared.yaml": RELEASE_VECTOR_01,
+        "https://example.com/cycle.yaml": "vectors:\n  self:\n    url: https://example.com/cycle.yaml\n",
+    }
+
+    def setUp(self):
+        self.task.action = 'metal_stack_release_vector'
+        self.task.async_val = False
+
+        self.maxDiff = None
+
+        self.cache_home = tempfile.TemporaryDirectory()
+        self.env = patch.dict(os.environ, {"XDG_CACHE_HOME": self.cache_home.name})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.cache_home.cleanup()
+
+    def _open_url(self, url):
+        return open_url_mock(self.VECTORS[url])
+
+    def _run(self, parallelism, task_vars, cache=False, expected_calls=3, vectors=None):
+        self.task.args = dict(
+            cache=cache,
+            parallelism=parallelism,
+            vectors=vectors or [
+                dict(
+                    url="https://example.com/release.yaml",
+                    variable_mapping_path="mapping",
+                    install_roles=False,
+                    nested=[
+                        dict(url_path="vectors.nested.url",
+                             variable_mapping_path="mapping",
+                             install_roles=False),
+                    ],
+                ),
+                dict(
+                    url="https://example.com/other.yaml",
+                    variable_mapping_path="mapping",
+                    install_roles=False,
+                ),
+            ],
+        )
+
+        plugin = ReleaseVectorActionModule(self.task, self.connection, self.play_context, loader=None, templar=self.templar, shared_loader_obj=None)
+
+        with patch.object(release_vector_cache, "open_url", side_effect=self._open_url) as mock:
+            actual = plugin.run(task_vars=task_vars)
+            self.assertEqual(expected_calls, mock.call_count)
+
+        return actual
+
+    def test_parallel_resolve_keeps_merge_order(self):
+        task_vars = dict(
+            masterdata_api_image_tag="v0.0.1",
+            mapping=dict(
+                metal_api_image_tag="docker-images.metal-api.tag",
+                masterdata_api_image_tag="docker-images.masterdata-api.tag",
+                metal_console_image_tag="docker-images.metal-console.tag",
+            ),
+        )
+
+        expected = dict(
+            metal_api_image_tag="v0.7.8",
+            metal_console_image_tag="v0.4.2",
+        )
+
+        for parallelism in [1, 4]:
+            actual = self._run(parallelism, task_vars)
+
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+            self.assertEqual(expected, actual["ansible_facts"])
+
+    def test_cache_is_keyed_by_arguments(self):
+        task_vars = dict(
+            mapping=dict(
+                metal_api_image_tag="docker-images.metal-api.tag",
+            ),
+        )
+
+        with tempfile.TemporaryDirectory() as tmp, patch("metal_stack_release_vector.tempfile.gettempdir", return_value=tmp):
+            actual = self._run(1, task_vars, cache=True)
+            self.assertEqual(dict(metal_api_image_tag="v0.7.8"), actual["ansible_facts"])
+
+            actual = self._run(1, task_vars, cache=True, expected_calls=0)
+            self.assertEqual(dict(metal_api_image_tag="v0.7.8"), actual["ansible_facts"])
+
+            # overrides are applied on cached results, too
+            actual = self._run(1, dict(task_vars, metal_api_image_tag="v0.0.1"), cache=True, expected_calls=0)
+            self.assertEqual(dict(), actual["ansible_facts"])
+
+            # a different mapping leads to a different cache entry
+            task_vars["mapping"]["metal_console_image_tag"] = "docker-images.metal-console.tag"
+            actual = self._run(1, task_vars, cache=True)
+            self.assertEqual(dict(metal_api_image_tag="v0.7.8", metal_console_image_tag="v0.4.2"), actual["ansible_facts"])
+
+    def test_vectors_with_overridden_variables_are_not_fetched(self):
+        vectors = [
+            dict(
+                url="https://example.com/release.yaml",
+                variable_mapping_path="mapping",
+                install_roles=False,
+                nested=[
+                    dict(url_path="vectors.nested.url",
+                         variable_mapping_path="nested_mapping",
+                         install_roles=False),
+                ],
+            ),
+        ]
+        task_vars = dict(
+            metal_console_image_tag="v0.0.1",
+            mapping=dict(masterdata_api_image_tag="docker-images.masterdata-api.tag"),
+            nested_mapping=dict(metal_console_image_tag="docker-images.metal-console.tag"),
+        )
+
+        for parallelism in [1, 4]:
+            actual = self._run(parallelism, task_vars, vectors=vectors, expected_calls=1)
+            self.assertEqual(dict(masterdata_api_image_tag="v0.7.1"), actual["ansible_facts"])
+
+            actual = self._run(parallelism, dict(task_vars, masterdata_api_image_tag="v0.0.1"), vectors=vectors, expected_calls=0)
+            self.assertEqual(dict(), actual["ansible_facts"])
+
+        with tempfile.TemporaryDirectory() as tmp, patch("metal_stack_release_vector.tempfile.gettempdir", return_value=tmp):
+            self._run(1, task_vars, cache=True, vectors=vectors, expected_calls=1)
+            self._run(1, task_vars, cache=True, vectors=vectors, expected_calls=0)
+
+            # the cache entry lacks the variables of the skipped vector
+            actual = self._run(1, dict(task_vars, metal_console_image_tag=None), cache=True, vectors=vectors, expected_calls=2)
+            self.assertEqual(dict(masterdata_api_image_tag="v0.7.1", metal_console_image_tag="v0.4.2"), actual["ansible_facts"])
+
+    def test_shared_nested_vectors_are_resolved_once(self):
+        nested = [
+            dict(url_path="vectors.shared.url", variable_mapping_path="mapping", install_roles=False, nested=[
+                dict(url_path="vectors.nested.url", variable_mapping_path="mapping", install_roles=False),
+            ]),
+        ]
+        vectors = [
+            dict(url="https://example.com/partner-a.yaml", install_roles=False, nested=nested),
+            dict(url="https://example.com/partner-b.yaml", install_roles=False, nested=nested),
+        ]
+        task_vars = dict(
+            mapping=dict(
+                masterdata_api_image_tag="docker-images.masterdata-api.tag",
+                metal_console_image_tag="docker-images.metal-console.tag",
+            ),
+        )
+
+        for parallelism in [1, 4]:
+            actual = self._run(parallelism, task_vars, vectors=vectors, expected_calls=4)
+
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+            self.assertEqual(dict(masterdata_api_image_tag="v0.7.1", metal_console_image_tag="v0.4.2"),
+                             actual["ansible_facts"])
+
+    def test_nesting_cycles_fail(self):
+        vectors = [
+            dict(url="https://example.com/cycle.yaml", variable_mapping_path="mapping", install_roles=False, nested=[
+                dict(url_path="vectors.self.url", variable_mapping_path="mapping", install_roles=False, nested=[
+                    dict(url_path="vectors.self.url", variable_mapping_path="mapping", install_roles=False),
+                ]),
+            ]),
+        ]
+        task_vars = dict(mapping=dict(metal_api_image_tag="docker-images.metal-api.tag"))
+
+        actual = self._run(1, task_vars, vectors=vectors, expected_calls=1)
+
+        self.assertTrue(actual.get("failed"))
+        self.assertIn("is nested in itself", actual["error"])
+
+    def test_concurrent_runs_resolve_once(self):
+        self.task.args = dict(
+            cache=True,
+            vectors=[dict(url="https://example.com/nested.yaml", variable_mapping_path="mapping", install_roles=False)],
+        )
+        task_vars = dict(mapping=dict(metal_api_image_tag="docker-images.metal-api.tag"))
+
+        def slow_open_url(url):
+            time.sleep(0.2)
+            return self._open_url(url)
+
+        results = []
+
+        def run():
+            plugin = ReleaseVectorActionModule(self.task, self.connection, self.play_context, loader=None, templar=self.templar, shared_loader_obj=None)
+            results.append(plugin.run(task_vars=task_vars))
+
+        with tempfile.TemporaryDirectory() as tmp, patch("metal_stack_release_vector.tempfile.gettempdir", return_value=tmp), \
+                patch.object(release_vector_cache, "open_url", side_effect=slow_open_url) as mock:
+            threads = [threading.Thread(target=run) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            self.assertEqual(1, mock.call_count)
+
+        self.assertEqual([dict(metal_api_image_tag="v0.0.2")] * 4, [r["ansible_facts"] for r in results])
+
+    def test_role_install_failures_are_collected(self):
+        resolver = RemoteResolver(module=MagicMock(), task_vars=dict(), task_args=dict(url="https://example.com/release.yaml"))
+
+        with self.assertRaises(AnsibleError) as ctx:
+            resolver._install_ansible_roles(role_dict={
+                "role-a": dict(oci="localhost:5000/role-a"),
+                "role-b": dict(oci="localhost:5000/role-b"),
+            })
+
+        self.assertIn("no version specified for role role-a", str(ctx.exception))
+        self.assertIn("no version specified for role role-b", str(ctx.exception))
+
+    def test_roles_are_reinstalled_when_their_stamp_differs(self):
+        loads = []
+
+        def load(loader):
+            loads.append(loader._url)
+            version = loader._url.rsplit(":", maxsplit=1)[1]
+            os.makedirs(os.path.join(loader._dest, "role-a"))
+            with open(os.path.join(loader._dest, "role-a", version), "w"):
+                pass
+            loader.digest = "sha256:" + version
+
+        with tempfile.TemporaryDirectory() as roles_path, \
+                patch("metal_stack_release_vector.C.DEFAULT_ROLES_PATH", [roles_path]), \
+                patch("metal_stack_release_vector.OciLoader.load", autospec=True, side_effect=load), \
+                patch("metal_stack_release_vector.OciLoader.current_digest", autospec=True, side_effect=lambda l: "sha256:v1"):
+            def install(version):
+                resolver = RemoteResolver(module=MagicMock(), task_vars=dict(), task_args=dict(url="https://example.com/release.yaml"))
+                resolver._install_ansible_roles(role_dict={"role-a": dict(oci="localhost:5000/role-a", version=version)})
+
+            install("v1")
+            install("v1")
+            self.assertEqual(["localhost:5000/role-a:v1"], loads)
+
+            install("v2")
+            self.assertEqual(["localhost:5000/role-a:v1", "localhost:5000/role-a:v2"], loads)
+            self.assertEqual(sorted(["v2", RemoteResolver.ROLE_STAMP_FILE]), sorted(os.listdir(os.path.join(roles_path, "role-a"))))
+
+            # a moved tag is detected by its digest
+            install("v2")
+            self.assertEqual(3, len(loads))
+
+            # no leftovers of the staging directories
+            self.assertEqual([".role-a.lock", "role-a"], sorted(os.listdir(roles_path)))
+
+    def test_roles_pinned_to_their_digest_are_not_revalidated(self):
+        def load(loader):
+            os.makedirs(os.path.join(loader._dest, "role-a"))
+            loader.digest = "sha256:" + "a" * 64
+
+        with tempfile.TemporaryDirectory() as roles_path, \
+                patch("metal_stack_release_vector.C.DEFAULT_ROLES_PATH", [roles_path]), \
+                patch("metal_stack_release_vector.OciLoader.load", autospec=True, side_effect=load) as loads, \
+                patch("metal_stack_release_vector.OciLoader.current_digest", autospec=True) as current_digest:
+            for _ in range(2):
+                resolver = RemoteResolver(module=MagicMock(), task_vars=dict(), task_args=dict(url="https://example.com/release.yaml"))
+                resolver._install_ansible_roles(role_dict={"role-a": dict(oci="localhost:5000/role-a", version="sha256:" + "a" * 64)})
+
+            self.assertEqual(1, loads.call_count)
+            current_digest.assert_not_called()
+
+    def test_role_paths_are_locked_across_processes(self):
+        with tempfile.TemporaryDirectory() as roles_path, \
+                patch("metal_stack_release_vector.C.DEFAULT_ROLES_PATH", [roles_path]), \
+                patch.object(RemoteResolver, "ROLE_LOCK_TIMEOUT", 0.2), \
+                patch("metal_stack_release_vector.OciLoader.load") as load, \
+                open(os.path.join(roles_path, ".role-a.lock"), "a") as f:
+            # another process installing the role holds the lock
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+            resolver = RemoteResolver(module=MagicMock(), task_vars=dict(), task_args=dict(url="https://example.com/release.yaml"))
+            with self.assertRaises(AnsibleError) as ctx:
+                resolver._install_ansible_roles(role_dict={"role-a": dict(oci="localhost:5000/role-a", version="v1")})
+
+            self.assertIn("timed out waiting for another worker installing into", str(ctx.exception))
+            load.assert_not_called()
+
+    def test_roles_without_stamp_are_kept(self):
+        with tempfile.TemporaryDirectory() as roles_path, \
+                patch("metal_stack_release_vector.C.DEFAULT_ROLES_PATH", [roles_path]), \
+                patch("metal_stack_release_vector.display") as display, \
+                patch("metal_stack_release_vector.OciLoader.load") as load:
+            os.makedirs(os.path.join(roles_path, "role-a"))
+
+            resolver = RemoteResolver(module=MagicMock(), task_vars=dict(), task_args=dict(url="https://example.com/release.yaml"))
+            resolver._install_ansible_roles(role_dict={"role-a": dict(oci="localhost:5000/role-a", version="v1")})
+
+            load.assert_not_called()
+            self.assertIn("is not updated to v1", display.warning.call_args[0][0])
+
+    def test_git_roles_with_submodules_are_cloned(self):
+        def clone(repository, version, dest):
+            os.makedirs(dest)
+            return "0" * 40
+
+        with tempfile.TemporaryDirectory() as roles_path, \
+                patch("metal_stack_release_vector.C.DEFAULT_ROLES_PATH", [roles_path]), \
+                patch.object(GitMirrorCache, "available", return_value=True), \
+                patch.object(GitMirrorCache, "export", return_value=None) as export, \
+                patch.object(RemoteResolver, "_clone_role", side_effect=clone) as clone_role:
+            resolver = RemoteResolver(module=MagicMock(), task_vars=dict(), task_args=dict(url="https://example.com/release.yaml"))
+            resolver._install_ansible_roles(role_dict={"role-a": dict(repository="https://example.com/role-a.git", version="v1")},
+                                            git_mirror_cache=GitMirrorCache(roles_path))
+
+            export.assert_called_once()
+            clone_role.assert_called_once()
+            self.assertEqual("0" * 40, RemoteResolver._read_role_stamp(os.path.join(roles_path, "role-a"))["digest"])
+
+    def test_roles_without_stamp_are_adopted(self):
+        def load(loader):
+            os.makedirs(os.path.join(loader._dest, "role-a"))
+            loader.digest = "sha256:v1"
+
+        with tempfile.TemporaryDirectory() as roles_path, \
+                patch("metal_stack_release_vector.C.DEFAULT_ROLES_PATH", [roles_path]), \
+                patch("metal_stack_release_vector.OciLoader.load", autospec=True, side_effect=load) as loads, \
+                patch("metal_stack_release_vector.OciLoader.current_digest", autospec=True, return_value="sha256:v1"):
+            os.makedirs(os.path.join(roles_path, "role-a"))
+
+            for _ in range(2):
+                resolver = RemoteResolver(module=MagicMock(), task_vars=dict(metal_stack_release_vector_reinstall_unstamped_roles=True),
+                                          task_args=dict(url="https://example.com/release.yaml"))
+                resolver._install_ansible_roles(role_dict={"role-a": dict(oci="localhost:5000/role-a", version="v1")})
+
+            # the adopted role carries a stamp, so it is installed only once
+            self.assertEqual(1, loads.call_count)
+            self.assertEqual("v1", RemoteResolver._read_role_stamp(os.path.join(roles_path, "role-a"))["version"])
+
+
+class FakeRegistryTest(unittest.TestCase):
+    task = MagicMock(Task)
+    play_context = MagicMock()
+    play_context.check_mode = False
+    connection = MagicMock()
+    templar = Templar(loader=None)
+
+    def setUp(self):
+        self.task.action = 'metal_stack_release_vector'
+        self.task.async_val = False
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = patch.dict(os.environ, {"XDG_CACHE_HOME": os.path.join(self.tmp.name, "cache")})
+        self.env.start()
+        self.roles_path = patch("metal_stack_release_vector.C.DEFAULT_ROLES_PATH", [os.path.join(self.tmp.name, "roles")])
+        self.roles_path.start()
+
+        self.registry = FakeRegistry(auth=True)
+        self.registry.start()
+
+    def tearDown(self):
+        self.registry.stop()
+        self.roles_path.stop()
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def test_resolves_oci_vectors_with_roles(self):
+        self.registry.add_artifact("roles/role-a", "v1", ANSIBLE_ROLE_MEDIA_TYPE, {
+            "role-a/defaults/main.yaml": b"a: 1",
+        })
+        nested_url = self.registry.add_file("/nested.yaml", RELEASE_VECTOR_02.encode("utf-8"))
+        self.registry.add_artifact("vectors/release", "v1", RELEASE_VECTOR_MEDIA_TYPE, {
+            "release.yaml": (RELEASE_VECTOR_01.replace("https://example.com/nested.yaml", nested_url) +
+                             "ansible-roles:\n  role-a:\n    oci: %s/roles/role-a\n    version: v1\n" % self.registry.host).encode("utf-8"),
+        })
+
+        trace_file = os.path.join(self.tmp.name, "trace.json")
+
+        self.task.args = dict(
+            cache=False,
+            parallelism=4,
+            trace_file=trace_file,
+            vectors=[dict(
+                url="oci://%s/vectors/release:v1" % self.registry.host,
+                oci_registry_scheme="http",
+                variable_mapping_path="mapping",
+                nested=[dict(url_path="vectors.nested.url", variable_mapping_path="mapping", install_roles=False)],
+            )],
+        )
+        task_vars = dict(mapping=dict(
+            metal_api_image_tag="docker-images.metal-api.tag",
+            metal_console_image_tag="docker-images.metal-console.tag",
+        ))
+
+        for _ in range(2):
+            self.registry.reset_counters()
+
+            plugin = ReleaseVectorActionModule(self.task, self.connection, self.play_context, loader=None, templar=self.templar, shared_loader_obj=None)
+            actual = plugin.run(task_vars=task_vars)
+
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+            self.assertEqual(dict(metal_api_image_tag="v0.7.8", metal_console_image_tag="v0.4.2"), actual["ansible_facts"])
+            self.assertTrue(os.path.isfile(os.path.join(self.tmp.name, "roles", "role-a", "defaults", "main.yaml")))
+
+            self.assertIn("mapping", actual["timings"]["phases"])
+            self.assertIn("role-a", actual["timings"]["items"])
+
+            with open(trace_file) as f:
+                self.assertIn("role_install", [e["name"] for e in json.load(f)["traceEvents"]])
+
+        # the second run only revalidates the manifests of the vector and the role
+        self.assertEqual(0, self.registry.count("GET", "blobs"))
+        self.assertEqual(2, self.registry.count("HEAD", "manifests"))
+        self.assertEqual(1, self.registry.count("GET", "files"))
+
+    def test_exports_and_resolves_oci_layouts(self):
+        self.registry.add_artifact("roles/role-a", "v1", ANSIBLE_ROLE_MEDIA_TYPE, {
+            "role-a/defaults/main.yaml": b"a: 1",
+        })
+        self.registry.add_artifact("vectors/nested", "v1", RELEASE_VECTOR_MEDIA_TYPE, {
+            "release.yaml": RELEASE_VECTOR_02.encode("utf-8"),
+        })
+        self.registry.add_artifact("vectors/release", "v1", RELEASE_VECTOR_MEDIA_TYPE, {
+            "release.yaml": (RELEASE_VECTOR_01.replace("https://example.com/nested.yaml", "oci://%s/vectors/nested:v1" % self.registry.host) +
+                             "ansible-roles:\n  role-a:\n    oci: %s/roles/role-a\n    version: v1\n" % self.registry.host).encode("utf-8"),
+        })
+
+        ref = "%s/vectors/release:v1" % self.registry.host
+        task_vars = dict(mapping=dict(
+            metal_api_image_tag="docker-images.metal-api.tag",
+            metal_console_image_tag="docker-images.metal-console.tag",
+        ))
+
+        def run(url, **kwargs):
+            self.task.args = dict(
+                cache=False,
+                vectors=[dict(
+                    url=url,
+                    oci_registry_scheme="http",
+                    variable_mapping_path="mapping",
+                    nested=[dict(url_path="vectors.nested.url", variable_mapping_path="mapping", install_roles=False,
+                                 oci_registry_scheme="http")],
+                )],
+                **kwargs,
+            )
+
+            plugin = ReleaseVectorActionModule(self.task, self.connection, self.play_context, loader=None, templar=self.templar, shared_loader_obj=None)
+            actual = plugin.run(task_vars=task_vars)
+
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+            self.assertEqual(dict(metal_api_image_tag="v0.7.8", metal_console_image_tag="v0.4.2"), actual["ansible_facts"])
+
+        for layout in ["layout", "layout.tar"]:
+            layout = os.path.join(self.tmp.name, layout)
+
+            # roles that are already installed are exported, too
+            run("oci://" + ref, oci_layout_export=layout)
+            run("oci://" + ref, oci_layout_export=layout)
+
+            shutil.rmtree(os.path.join(self.tmp.name, "roles"))
+            self.registry.reset_counters()
+
+            run("oci-layout://%s#%s" % (layout, ref))
+
+            self.assertEqual(0, self.registry.count())
+            self.assertTrue(os.path.isfile(os.path.join(self.tmp.name, "roles", "role-a", "defaults", "main.yaml")))
+
+    def test_layout_blobs_are_verified(self):
+        layout = os.path.join(self.tmp.name, "layout")
+        url = "oci-layout://%s#%s/vectors/release:v1" % (layout, self.registry.host)
+
+        actual = self._resolve_release_vector(oci_layout_export=layout)
+        self.assertNotIn("failed", actual, actual.get("traceback"))
+
+        # a policy can not be enforced, as the layout does not contain signatures
+        actual = self._resolve_release_vector(vector=dict(url=url, oci_cosign_verify_key="key"))
+
+        self.assertTrue(actual.get("failed"))
+        self.assertIn("can not be verified with cosign", actual["error"])
+
+        for digest, content in self.registry.blobs.items():
+            if content != b"{}":
+                path = os.path.join(layout, "blobs", *digest.split(":"))
+                with open(path, "wb") as f:
+                    f.write(content[:-1] + bytes([content[-1] ^ 1]))
+
+        actual = self._resolve_release_vector(vector=dict(url=url))
+
+        self.assertTrue(actual.get("failed"))
+        self.assertIn("does not match its digest", actual["error"])
+
+    def test_exported_layouts_contain_vectors_with_overridden_variables(self):
+        self.registry.add_artifact("vectors/nested", "v1", RELEASE_VECTOR_MEDIA_TYPE, {
+            "release.yaml": RELEASE_VECTOR_02.encode("utf-8"),
+        })
+        self.registry.add_artifact("vectors/release", "v1", RELEASE_VECTOR_MEDIA_TYPE, {
+            "release.yaml": RELEASE_VECTOR_01.replace("https://example.com/nested.yaml", "oci://%s/vectors/nested:v1" % self.registry.host).encode("utf-8"),
+        })
+
+        ref = "%s/vectors/release:v1" % self.registry.host
+        layout = os.path.join(self.tmp.name, "layout")
+
+        def run(url, task_vars, **kwargs):
+            self.task.args = dict(
+                cache=False,
+                vectors=[dict(
+                    url=url,
+                    oci_registry_scheme="http",
+                    variable_mapping_path="mapping",
+                    install_roles=False,
+                    nested=[dict(url_path="vectors.nested.url", variable_mapping_path="nested_mapping", install_roles=False,
+                                 oci_registry_scheme="http")],
+                )],
+                **kwargs,
+            )
+
+            plugin = ReleaseVectorActionModule(self.task, self.connection, self.play_context, loader=None, templar=self.templar, shared_loader_obj=None)
+            return plugin.run(task_vars=dict(task_vars, mapping=dict(metal_api_image_tag="docker-images.metal-api.tag"),
+                                             nested_mapping=dict(metal_console_image_tag="docker-images.metal-console.tag")))
+
+        actual = run("oci://" + ref, dict(metal_console_image_tag="pinned"), oci_layout_export=layout)
+        self.assertNotIn("failed", actual, actual.get("traceback"))
+
+        self.registry.reset_counters()
+
+        # a site without the override resolves the nested vector from the layout
+        actual = run("oci-layout://%s#%s" % (layout, ref), dict())
+
+        self.assertNotIn("failed", actual, actual.get("traceback"))
+        self.assertEqual(dict(metal_api_image_tag="v0.7.8", metal_console_image_tag="v0.4.2"), actual["ansible_facts"])
+        self.assertEqual(0, self.registry.count())
+
+    @patch("metal_stack_release_vector.process.get_bin_path", return_value="/usr/bin/cosign")
+    @patch("metal_stack_release_vector.subprocess.run")
+    def test_verifications_are_persisted_on_request(self, run, _):
+        for _ in range(2):
+            actual = self._resolve_release_vector(vector=dict(oci_cosign_verify_key="key"))
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+        self.assertEqual(2, run.call_count)
+
+        for _ in range(2):
+            actual = self._resolve_release_vector(oci_cosign_verification_cache=True, vector=dict(oci_cosign_verify_key="key"))
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+        self.assertEqual(3, run.call_count)
+
+    def _resolve_release_vector(self, vector=None, **kwargs):
+        if ("vectors/release", "v1") not in self.registry.manifests:
+            self.registry.add_artifact("vectors/release", "v1", RELEASE_VECTOR_MEDIA_TYPE, {
+                "release.yaml": RELEASE_VECTOR_02.encode("utf-8"),
+            })
+
+        self.task.args = dict(dict(
+            cache=False,
+            vectors=[dict(dict(
+                url="oci://%s/vectors/release:v1" % self.registry.host,
+                oci_registry_scheme="http",
+                variable_mapping_path="mapping",
+                install_roles=False,
+            ), **(vector or dict()))],
+        ), **kwargs)
+
+        plugin = ReleaseVectorActionModule(self.task, self.connection, self.play_context, loader=None, templar=self.templar, shared_loader_obj=None)
+        with patch.object(BlobDownload, "BACKOFF", 0):
+            return plugin.run(task_vars=dict(mapping=dict(metal_api_image_tag="docker-images.metal-api.tag")))
+
+    def test_downloads_are_retried_and_resumed(self):
+        for oci_blob_cache in [True, False]:
+            self.registry.inject_fault("manifests", "error")
+            self.registry.inject_fault("blobs", "error")
+            self.registry.inject_fault("blobs", "truncate")
+            self.registry.reset_counters()
+
+            actual = self._resolve_release_vector(oci_blob_cache=oci_blob_cache, oci_blob_cache_dir=os.path.join(self.tmp.name, "empty-%s" % oci_blob_cache))
+
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+            self.assertEqual(dict(metal_api_image_tag="v0.0.2"), actual["ansible_facts"])
+            self.assertEqual(3, self.registry.count("GET", "blobs"))
+
+    def test_downloads_are_verified(self):
+        self._resolve_release_vector()
+
+        for digest, content in self.registry.blobs.items():
+            if content != b"{}":
+                self.registry.blobs[digest] = content[:-1] + bytes([content[-1] ^ 1])
+
+        # layers are verified when they are stored in the cache
+        actual = self._resolve_release_vector(oci_blob_cache_dir=os.path.join(self.tmp.name, "empty"))
+
+        self.assertTrue(actual.get("failed"))
+        self.assertIn("does not match its digest", actual["error"])
+
+    @patch("metal_stack_release_vector.tempfile.gettempdir")
+    def test_cache_entries_are_kept_if_the_registry_is_unreachable(self, gettempdir):
+        gettempdir.return_value = self.tmp.name
+        self._resolve_release_vector(cache=True)
+
+        self.registry.inject_fault("manifests", "error", times=10)
+        self.registry.reset_counters()
+
+        actual = self._resolve_release_vector(cache=True)
+
+        self.assertNotIn("failed", actual, actual.get("traceback"))
+        self.assertEqual(dict(metal_api_image_tag="v0.0.2"), actual["ansible_facts"])
+        self.assertLessEqual(1, self.registry.count("HEAD", "manifests"))
+        self.assertEqual(0, self.registry.count("GET", "blobs"))
+
+        # a changed digest invalidates the entry
+        self.registry.faults.clear()
+        self.registry.add_artifact("vectors/release", "v1", RELEASE_VECTOR_MEDIA_TYPE, {
+            "release.yaml": RELEASE_VECTOR_01.encode("utf-8"),
+        })
+
+        actual = self._resolve_release_vector(cache=True)
+
+        self.assertNotIn("failed", actual, actual.get("traceback"))
+        self.assertEqual(dict(metal_api_image_tag="v0.7.8"), actual["ansible_facts"])
+
+    def test_pulls_through_registry_mirrors(self):
+        verified = Future()
+        verified.set_result(None)
+
+        with FakeRegistry() as mirror, \
+                patch.object(CosignVerifier, "verify", return_value=verified) as verify:
+            digest = mirror.add_artifact("proxy/vectors/release", "v1", RELEASE_VECTOR_MEDIA_TYPE, {
+                "release.yaml": RELEASE_VECTOR_02.encode("utf-8"),
+            })
+            mirrors = {self.registry.host: ["http://%s/proxy" % mirror.host]}
+
+            # without hedging, a mirror answering slowly on a loaded machine does not reach the upstream registry
+            actual = self._resolve_release_vector(oci_blob_cache=False, oci_registry_mirrors=mirrors, oci_registry_hedging=False,
+                                                  vector=dict(oci_cosign_verify_key="key"))
+
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+            self.assertEqual(dict(metal_api_image_tag="v0.0.2"), actual["ansible_facts"])
+            self.assertEqual(0, self.registry.count(kind="manifests") + self.registry.count(kind="blobs"))
+            self.assertEqual(1, mirror.count("GET", "blobs"))
+            # the signature is verified against the upstream registry
+            verify.assert_called_with("%s/vectors/release@%s" % (self.registry.host, digest),
+                                      key="key", identity=None, issuer=None)
+
+            # a slow mirror is hedged with the upstream registry
+            mirror.inject_fault("manifests", "delay")
+            mirror.reset_counters()
+
+            actual = self._resolve_release_vector(oci_blob_cache=False, oci_registry_mirrors=mirrors)
+
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+            self.assertEqual(1, self.registry.count("GET", "manifests"))
+            self.assertEqual(1, self.registry.count("GET", "blobs"))
+            self.assertEqual(0, mirror.count("GET", "blobs"))
+
+            # unavailable mirrors and mirrors without the artifact fall back to the upstream registry
+            self.registry.reset_counters()
+            mirrors = {self.registry.host: ["http://127.0.0.1:1", "http://%s/missing" % mirror.host]}
+
+            actual = self._resolve_release_vector(oci_blob_cache=False, oci_registry_mirrors=mirrors)
+
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+            self.assertEqual(1, self.registry.count("GET", "blobs"))
+
+    def test_interrupted_downloads_are_resumed_from_the_next_registry(self):
+        with FakeRegistry() as mirror:
+            mirror.add_artifact("proxy/vectors/release", "v1", RELEASE_VECTOR_MEDIA_TYPE, {
+                "release.yaml": RELEASE_VECTOR_02.encode("utf-8"),
+            })
+            mirror.inject_fault("blobs", "truncate")
+            mirrors = {self.registry.host: ["http://%s/proxy" % mirror.host]}
+
+            actual = self._resolve_release_vector(oci_registry_mirrors=mirrors, oci_registry_hedging=False)
+
+            self.assertNotIn("failed", actual, actual.get("traceback"))
+            self.assertEqual(dict(metal_api_image_tag="v0.0.2"), actual["ansible_facts"])
+            self.assertEqual(1, mirror.count("GET", "blobs"))
+            self.assertEqual(1, self.registry.count("GET", "blobs"))
+
+    def test_requests_honor_proxy_environment(self):
+        env = {"HTTP_PROXY": self.registry.url, "http_proxy": self.registry.url, "NO_PROXY": "", "no_proxy": ""}
+
+        with patch.dict(os.environ, env):
+            actual = self._resolve_release_vector(oci_blob_cache=False)
+
+        self.assertNotIn("failed", actual, actual.get("traceback"))
+        self.assertEqual(dict(metal_api_image_tag="v0.0.2"), actual["ansible_facts"])
+        # every request of the manifest, the blobs and the token went through the proxy
+        proxied = self.registry.count(kind="proxied")
+        self.assertLessEqual(3, proxied)
+        self.assertEqual(self.registry.count() - proxied, proxied)
+
+    def test_invalid_registry_mirrors_fail(self):
+        actual = self._resolve_release_vector(oci_registry_mirrors={self.registry.host: ["ftp://mirror"]})
+
+        self.assertTrue(actual.get("failed"))
+        self.assertEqual("invalid registry mirrors", actual["msg"])
+
+
+class ReplaceKeyValuesTest(unittest.TestCase):
+    def test_replaces_in_dicts_and_lists(self):
+        data = dict(
+            images=[dict(name="metalstack/a"), [dict(name="metalstack/b")]],
+            nested=dict(name="metalstack/c", tag="metalstack/c"),
+        )
+
+        replace_key_values(data, [
+            dict(key="name", old="metalstack/", new="mirror/metalstack/"),
+            dict(key="name", old="mirror/", new="registry.io/"),
+        ])
+
+        self.assertEqual(dict(
+            images=[dict(name="registry.io/metalstack/a"), [dict(name="registry.io/metalstack/b")]],
+            nested=dict(name="registry.io/metalstack/c", tag="metalstack/c"),
+        ), data)
+
+
+class VariableMappingTest(unittest.TestCase):
+    def test_resolves_shared_prefixes_in_one_pass(self):
+        vector = {"a": {"b": {"c": 1, "d": 2}, "e": [3]}}
+        mapping = VariableMapping.compile(dict(c="a.b.c", d="a.b.d", b="a.b", e="a.e", x="a.x.y", y="z"))
+
+        values, missing = mapping.resolve(vector)
+
+        self.assertEqual(dict(c=1, d=2, b={"c": 1, "d": 2}, e=[3]), values)
+        self.assertEqual({"x", "y"}, set(missing))
+        self.assertEqual(("x",), missing["x"].args)
+
+    def test_compiled_mappings_are_reused(self):
+        mapping = dict(c="a.b.c")
+
+        self.assertIs(VariableMapping.compile(mapping), VariableMapping.compile(dict(mapping)))
+
+    def test_compiled_mappings_are_bounded(self):
+        for i in range(VariableMapping.COMPILE_CACHE_SIZE + 1):
+            VariableMapping.compile(dict(c="a.b.%d" % i))
+
+        self.assertEqual(VariableMapping.COMPILE_CACHE_SIZE, VariableMapping._compile.cache_info().currsize)
+
+
+class OciBlobCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def digest(content):
+        return "sha256:" + hashlib.sha256(content).hexdigest()
+
+    @staticmethod
+    def read(f):
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def test_put_and_get(self):
+        cache = OciBlobCache(path=self.tmp.name, max_size=1024)
+
+        self.assertIsNone(cache.open_blob(self.digest(b"layer")))
+
+        cache.put_blob(self.digest(b"layer"), BytesIO(b"layer")).close()
+        cache.put_manifest("sha256:abc", b"{}")
+
+        self.assertEqual(b"layer", self.read(cache.open_blob(self.digest(b"layer"))))
+        self.assertEqual(b"{}", cache.get_manifest("sha256:abc"))
+
+    def test_parsed_documents(self):
+        cache = OciBlobCache(path=self.tmp.name, max_size=1024 * 1024)
+
+        self.assertEqual(dict(a=[1, 2]), load_yaml("a: [1, 2]", cache))
+
+        with patch.object(release_vector_documents, "yaml_load") as mock:
+            self.assertEqual(dict(a=[1, 2]), load_yaml(b"a: [1, 2]", cache))
+            mock.assert_not_called()
+
+    def test_rejects_digest_mismatch(self):
+        cache = OciBlobCache(path=self.tmp.name, max_size=1024)
+
+        with self.assertRaises(RuntimeError):
+            cache.put_blob(self.digest(b"layer"), BytesIO(b"corrupted"))
+
+        self.assertIsNone(cache.open_blob(self.digest(b"layer")))
+
+    def test_removes_modified_blobs_on_read(self):
+        cache = OciBlobCache(path=self.tmp.name, max_size=1024)
+        cache.put_blob(self.digest(b"layer"), BytesIO(b"layer")).close()
+
+        with open(cache._file_path("blobs", self.digest(b"layer")), "wb") as f:
+            f.write(b"modified")
+
+        with self.assertRaises(RuntimeError):
+            self.read(cache.open_blob(self.digest(b"layer")))
+
+        self.assertIsNone(cache.open_blob(self.digest(b"layer")))
+
+    def test_evicts_least_recently_used(self):
+        cache = OciBlobCache(path=self.tmp.name, max_size=10)
+
+        first, second, third = b"a" * 4, b"b" * 4, b"c" * 4
+
+        cache.put_blob(self.digest(first), BytesIO(first)).close()
+        cache.put_blob(self.digest(second), BytesIO(second)).close()
+
+        os.utime(cache._file_path("blobs", self.digest(first)), (0, 0))
+        os.utime(cache._file_path("blobs", self.digest(second)), (1, 1))
+        self.read(cache.open_blob(self.digest(first)))
+
+        cache.put_blob(self.digest(third), BytesIO(third)).close()
+
+        self.assertEqual(first, self.read(cache.open_blob(self.digest(first))))
+        self.assertIsNone(cache.open_blob(self.digest(second)))
+        self.assertEqual(third, self.read(cache.open_blob(self.digest(third))))
+
+    def test_walks_the_cache_only_for_evictions(self):
+        cache = OciBlobCache(path=self.tmp.name, max_size=10)
+
+        with patch.object(cache, "_entries", wraps=cache._entries) as entries:
+            for content in [b"a" * 3, b"b" * 3, b"c" * 3]:
+                cache.put_blob(self.digest(content), BytesIO(content)).close()
+            self.assertEqual(1, entries.call_count)
+
+            os.utime(cache._file_path("blobs", self.digest(b"a" * 3)), (0, 0))
+            cache.put_blob(self.digest(b"d" * 3), BytesIO(b"d" * 3)).close()
+            self.assertEqual(2, entries.call_count)
+
+        self.assertEqual(9, cache._size)
+        self.assertIsNone(cache.open_blob(self.digest(b"a" * 3)))
+
+
+class HttpCacheTest(unittest.TestCase):
+    URL = "https://example.com/release.yaml"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def response(body, etag):
+        rsp = open_url_mock(body)
+        rsp.headers = {"ETag": etag}
+        return rsp
+
+    @patch.object(release_vector_cache, "open_url")
+    def test_stores_documents_next_to_their_headers(self, mock):
+        cache = release_vector_cache.HttpCache(path=self.tmp.name, max_size=1024)
+        mock.side_effect = [self.response(b"a: 1", '"v1"'), HTTPError(self.URL, 304, "Not Modified", {}, None)]
+
+        self.assertEqual(b"a: 1", cache.open_url(self.URL))
+        self.assertEqual(b"a: 1", cache.open_url(self.URL))
+
+        key = "sha256:" + hashlib.sha256(self.URL.encode('utf-8')).hexdigest()
+        with open(cache._file_path("http", key), "rb") as f:
+            self.assertEqual(b"a: 1", f.read())
+        with open(cache._file_path("http", key, suffix=".json")) as f:
+            self.assertEqual('"v1"', json.load(f)["etag"])
+
+    @patch.object(release_vector_cache, "open_url")
+    def test_evicted_documents_are_downloaded_again(self, mock):
+        cache = release_vector_cache.HttpCache(path=self.tmp.name, max_size=1024)
+        mock.side_effect = [self.response(b"a" * 512, '"v1"'), self.response(b"b" * 512, '"v2"'), self.response(b"a" * 512, '"v1"')]
+
+        cache.open_url(self.URL)
+        os.utime(cache._file_path("http", "sha256:" + hashlib.sha256(self.URL.encode('utf-8')).hexdigest()), (0, 0))
+        cache.open_url("https://example.com/other.yaml")
+
+        # the document was evicted, so its headers are not sent anymore
+        self.assertEqual(b"a" * 512, cache.open_url(self.URL))
+        mock.assert_called_with(self.URL)
+        self.assertLessEqual(cache._size, 1024)
+
+
+class OciLoaderTest(unittest.TestCase):
+    @staticmethod
+    def tar_gzip(files):
+        buf = BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, BytesIO(content))
+        buf.seek(0)
+        return buf
+
+    def test_extract_tar_gzip_file(self):
+        blob = self.tar_gzip({"README.md": b"readme", "release.yaml": b"a: 1"})
+
+        self.assertEqual("a: 1", OciLoader._extract_tar_gzip_file(blob, member="release.yaml"))
+
+    def test_extract_tar_gzip_file_missing_member(self):
+        blob = self.tar_gzip({"README.md": b"readme"})
+
+        with self.assertRaises(KeyError):
+            OciLoader._extract_tar_gzip_file(blob, member="release.yaml")
+
+    def test_extract_tar_gzip_with_prefix_filter(self):
+        blob = self.tar_gzip({"ansible-test/tasks/main.yaml": b"---"})
+
+        with tempfile.TemporaryDirectory() as dest:
+            OciLoader._extract_tar_gzip(blob, dest=dest, filter=OciLoader.prefix_filter("ansible-test", "alias-role"))
+
+            self.assertTrue(os.path.isfile(os.path.join(dest, "alias-role", "tasks", "main.yaml")))
+
+
+class GitMirrorCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = os.path.join(self.tmp.name, "repo")
+        self.cache = GitMirrorCache(os.path.join(self.tmp.name, "cache"))
+
+        if not self.cache.available():
+            self.skipTest("git is not installed")
+
+        self.cache._git("init", "--quiet", self.repo)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _commit(self, tag, content):
+        with open(os.path.join(self.repo, "defaults.yaml"), "w") as f:
+            f.write(content)
+        self.cache._git("-C", self.repo, "add", "defaults.yaml")
+        self.cache._git("-C", self.repo, "-c", "user.name=test", "-c", "user.email=test@example.com",
+                        "commit", "--quiet", "-m", tag)
+        self.cache._git("-C", self.repo, "tag", tag)
+
+    def test_exports_versions_from_mirror(self):
+        self._commit("v1", "a: 1")
+
+        dest = os.path.join(self.tmp.name, "v1")
+        commit = self.cache.export(self.repo, "v1", dest)
+
+        self.assertEqual(40, len(commit))
+        with open(os.path.join(dest, "defaults.yaml")) as f:
+            self.assertEqual("a: 1", f.read())
+
+        # new versions are fetched into the existing mirror
+        self._commit("v2", "a: 2")
+
+        dest = os.path.join(self.tmp.name, "v2")
+        with patch.object(self.cache, "_clone") as clone:
+            self.cache.export(self.repo, "v2", dest)
+            clone.assert_not_called()
+
+        with open(os.path.join(dest, "defaults.yaml")) as f:
+            self.assertEqual("a: 2", f.read())
+
+        # known commits are exported without fetching
+        dest = os.path.join(self.tmp.name, "commit")
+        with patch.object(self.cache, "_git", wraps=self.cache._git) as git:
+            self.assertEqual(commit, self.cache.export(self.repo, commit, dest))
+            self.assertNotIn("fetch", [c.args[2] for c in git.call_args_list])
+
+    def test_mirrors_are_locked_across_processes(self):
+        self._commit("v1", "a: 1")
+        mirror = os.path.join(self.cache._path, hashlib.sha256(self.repo.encode('utf-8')).hexdigest() + ".git")
+        os.makedirs(self.cache._path)
+
+        with open(mirror + ".lock", "a") as f, patch.object(GitMirrorCache, "LOCK_TIMEOUT", 0.2), \
+                patch("metal_stack_release_vector.display"):
+            # another process using the mirror holds the lock
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+            self.assertIsNone(self.cache.export(self.repo, "v1", os.path.join(self.tmp.name, "v1")))
+            self.assertFalse(os.path.exists(mirror))
+
+    def test_mirrors_cloned_in_the_meantime_are_used(self):
+        self._commit("v1", "a: 1")
+        mirror = os.path.join(self.cache._path, "mirror.git")
+
+        self.cache._clone(self.repo, mirror)
+        self.cache._clone(self.repo, mirror)
+
+        self.assertTrue(self.cache._is_commit(mirror, self.cache._git("-C", self.repo, "rev-parse", "HEAD").decode('utf-8').strip()))
+        self.assertEqual(["mirror.git"], os.listdir(self.cache._path))
+
+    def test_unknown_version(self):
+        self._commit("v1", "a: 1")
+
+        with self.assertRaises(RuntimeError):
+            self.cache.export(self.repo, "v3", os.path.join(self.tmp.name, "v3"))
+
+    def test_mirrors_only_branches_and_tags(self):
+        self._commit("v1", "a: 1")
+        self.cache._git("-C", self.repo, "update-ref", "refs/pull/1/head", "HEAD")
+
+        self.cache.export(self.repo, "v1", os.path.join(self.tmp.name, "v1"))
+        self._commit("v2", "a: 2")
+        self.cache.export(self.repo, "v2", os.path.join(self.tmp.name, "v2"))
+
+        mirror, = [m for m in os.listdir(os.path.join(self.tmp.name, "cache")) if m.endswith(".git")]
+        refs = self.cache._git("--git-dir", os.path.join(self.tmp.name, "cache", mirror),
+                               "for-each-ref", "--format=%(refname)").decode("utf-8").split()
+        self.assertIn("refs/tags/v2", refs)
+        self.assertNotIn("refs/pull/1/head", refs)
+
+    def test_versions_with_submodules_are_not_exported(self):
+        with open(os.path.join(self.repo, ".gitmodules"), "w") as f:
+            f.write('[submodule "sub"]\n\tpath = sub\n\turl = https://example.com/sub.git\n')
+        self.cache._git("-C", self.repo, "add", ".gitmodules")
+        self._commit("v1", "a: 1")
+
+        dest = os.path.join(self.tmp.name, "v1")
+        self.assertIsNone(self.cache.export(self.repo, "v1", dest))
+        self.assertFalse(os.path.exists(dest))
+
+
+class RoleDefaultsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = RoleDefaultsCache(os.path.join(self.tmp.name, "cache"))
+        self.role_path = os.path.join(self.tmp.name, "role")
+        self.dep_path = os.path.join(self.tmp.name, "dep")
+
+        for p in [self.role_path, self.dep_path]:
+            os.makedirs(os.path.join(p, "defaults"))
+            self._write(os.path.join(p, "defaults", "main.yaml"), "a: 1")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    @staticmethod
+    def _write(path, content):
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_entries_are_invalidated_on_modification(self):
+        self.assertIsNone(self.cache.get(self.role_path))
+
+        self.cache.put(self.role_path, dict(a=1), [self.role_path, self.dep_path])
+        self.assertEqual(dict(a=1), self.cache.get(self.role_path))
+
+        # a modification of a dependency invalidates the entry
+        self._write(os.path.join(self.dep_path, "defaults", "main.yaml"), "a: 22")
+        self.assertIsNone(self.cache.get(self.role_path))
+
+        self.cache.put(self.role_path, dict(a=22), [self.role_path, self.dep_path])
+        self.assertEqual(dict(a=22), self.cache.get(self.role_path))
+
+        # as well as added files
+        os.makedirs(os.path.join(self.role_path, "meta"))
+        self.assertIsNone(self.cache.get(self.role_path))
+
+
+class CosignVerifierTest(unittest.TestCase):
+    @patch("metal_stack_release_vector.process.get_bin_path", return_value="/usr/bin/cosign")
+    @patch("metal_stack_release_vector.subprocess.run")
+    def test_verifies_once_per_digest_and_policy(self, run, _):
+        verifier = CosignVerifier()
+        ref = "ghcr.io/metal-stack/releases@sha256:abc"
+
+        futures = [
+            verifier.verify(ref, key="key-a"),
+            verifier.verify(ref, key="key-a"),
+            verifier.verify(ref, key="key-b"),
+            verifier.verify(ref),
+        ]
+        for f in futures:
+            f.result()
+        verifier.shutdown()
+
+        self.assertEqual(2, run.call_count)
+        run.assert_any_call(args=["/usr/bin/cosign", "verify", "--key", "env://PUBKEY", ref],
+                            env=dict(PUBKEY="key-a"), check=True, capture_output=True)
+
+    @patch("metal_stack_release_vector.process.get_bin_path", return_value="/usr/bin/cosign")
+    @patch("metal_stack_release_vector.subprocess.run")
+    def test_remembers_verifications_in_blob_cache(self, run, _):
+        ref = "ghcr.io/metal-stack/releases@sha256:abc"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = OciBlobCache(path=tmp, max_size=1024)
+
+            for _ in range(2):
+                verifier = CosignVerifier(blob_cache=cache)
+                verifier.verify(ref, identity="identity", issuer="issuer").result()
+                verifier.shutdown()
+
+            self.assertEqual(1, run.call_count)
+
+            # the marker is specific to the verification policy
+            verifier = CosignVerifier(blob_cache=cache)
+            verifier.verify(ref, identity="other-identity", issuer="issuer").result()
+            verifier.shutdown()
+
+            self.assertEqual(2, run.call_count)
@@ -0,0 +1,165 @@
+import json
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# group -> version -> resource -> (kind, namespaced, subresources)
+RESOURCES = {
+    "": {
+        "v1": {
+            "namespaces": ("Namespace", False, []),
+            "pods": ("Pod", True, ["status"]),
+        },
+    },
+    "apps": {
+        "v1": {
+            "deployments": ("Deployment", True, ["status", "scale"]),
+        },
+    },
+    "operator.gardener.cloud": {
+        "v1alpha1": {
+            "gardens": ("Garden", False, ["status"]),
+        },
+    },
+}
+
+
+class FakeApiServer():
+    """
+    An in-process stand-in for the discovery endpoints of a kubernetes api
+    server. It serves the aggregated discovery documents if aggregated is
+    set and counts all requests by path.
+    """
+
+    def __init__(self, aggregated=True):
+        self.aggregated = aggregated
+        self.resources = json.loads(json.dumps(RESOURCES))
+        self.requests = dict()
+
+        self._lock = threading.Lock()
+        self._server = None
+
+    def __enter__(self):
+        apiserver = self
+
+        class Handler(_Handler):
+            pass
+
+        Handler.apiserver = apiserver
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *_):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    def count(self, path=None):
+        with self._lock:
+            return sum(n for p, n in self.requests.items() if path is None or p == path)
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = dict()
+
+    def _record(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def document(self, path, accept):
+        aggregated = self.aggregated and "as=APIGroupDiscoveryList" in accept
+
+        if path == "/version":
+            return dict(major="1", minor="30", gitVersion="v1.30.0")
+        if path == "/api" and aggregated:
+            return self._discovery_list(lambda group: group == "")
+        if path == "/api":
+            return dict(kind="APIVersions", versions=list(self.resources[""]))
+        if path == "/apis" and aggregated:
+            return self._discovery_list(lambda group: group != "")
+        if path == "/apis":
+            return dict(kind="APIGroupList", apiVersion="v1", groups=[
+                self._group(group) for group in self.resources if group != ""
+            ])
+
+        parts = path.strip("/").split("/")
+        if parts[0] == "api" and len(parts) == 2:
+            group, version = "", parts[1]
+        elif parts[0] == "apis" and len(parts) == 3:
+            group, version = parts[1], parts[2]
+        else:
+            return None
+
+        resources = self.resources.get(group, dict()).get(version)
+        if resources is None:
+            return None
+
+        resource_list = []
+        for name, (kind, namespaced, subresources) in resources.items():
+            resource_list.append(dict(name=name, singularName=kind.lower(), namespaced=namespaced,
+                                      kind=kind, verbs=["get", "list"]))
+            for subresource in subresources:
+                resource_list.append(dict(name="%s/%s" % (name, subresource), singularName="",
+                                          namespaced=namespaced, kind=kind, verbs=["get"]))
+
+        return dict(kind="APIResourceList", apiVersion="v1", groupVersion="/".join(filter(None, [group, version])),
+                    resources=resource_list)
+
+    def _group(self, group):
+        versions = [dict(groupVersion="/".join(filter(None, [group, v])), version=v) for v in self.resources[group]]
+        return dict(name=group, versions=versions, preferredVersion=versions[0])
+
+    def _discovery_list(self, included):
+        items = []
+        for group, versions in self.resources.items():
+            if not included(group):
+                continue
+
+            items.append(dict(metadata=dict(name=group), versions=[dict(
+                version=version,
+                freshness="Current",
+                resources=[dict(
+                    resource=name,
+                    responseKind=dict(group=group, version=version, kind=kind),
+                    scope="Namespaced" if namespaced else "Cluster",
+                    singularResource=kind.lower(),
+                    verbs=["get", "list"],
+                    subresources=[dict(
+                        subresource=subresource,
+                        responseKind=dict(group=group, version=version, kind=kind),
+                        verbs=["get"],
+                    ) for subresource in subresources],
+                ) for name, (kind, namespaced, subresources) in resources.items()],
+            ) for version, resources in versions.items()]))
+
+        return dict(kind="APIGroupDiscoveryList", apiVersion="apidiscovery.k8s.io/v2", items=items)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    apiserver = None
+
+    def log_message(self, *_):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?", maxsplit=1)[0]
+        self.apiserver._record(path)
+
+        document = self.apiserver.document(path, self.headers.get("Accept") or "")
+        if document is None:
+            status, content = 404, json.dumps(dict(kind="Status", code=404)).encode("utf-8")
+        else:
+            status, content = 200, json.dumps(document).encode("utf-8")
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
@@ -0,0 +1,268 @@
+"""
+Benchmarks the resolution of release vectors by the metal_stack_release_vector
+action plugin against an in-process fake registry.
+
+Every scenario is resolved cold (empty caches and roles path) and warm (caches
+and roles of the cold run in place, fact cache disabled). The results are
+written as JSON and can be compared against a baseline:
+
+    python -m test.benchmark --output bench.json
+    python -m test.benchmark --baseline bench.json --tolerance 1.5
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from unittest.mock import MagicMock, patch
+
+import yaml
+
+from ansible.playbook.task import Task
+from ansible.template import Templar
+
+from test import ACTION_PLUGINS_PATH
+from test.registry import FakeRegistry, RELEASE_VECTOR_MEDIA_TYPE, ANSIBLE_ROLE_MEDIA_TYPE
+
+sys.path.insert(0, ACTION_PLUGINS_PATH)
+import metal_stack_release_vector  # noqa: E402
+
+BASE_SCENARIO = dict(vectors=1, nested=0, roles=0, size=100, source="oci")
+
+SCENARIOS = dict(
+    vectors=[1, 4, 16],
+    nested=[0, 4, 16],
+    roles=[0, 4, 16],
+    size=[100, 1000, 10000],
+    source=["oci", "http"],
+)
+
+QUICK_SCENARIOS = dict(
+    vectors=[1, 4],
+    nested=[0, 4],
+    roles=[0, 4],
+    size=[100, 1000],
+    source=["oci", "http"],
+)
+
+
+def scenario_id(scenario):
+    return ",".join("%s=%s" % (k, scenario[k]) for k in sorted(scenario))
+
+
+def scenarios(grid):
+    # every dimension is scaled on its own, starting from the base scenario
+    seen = set()
+    for dimension, values in grid.items():
+        for value in values:
+            scenario = dict(BASE_SCENARIO, **{dimension: value})
+            if scenario_id(scenario) not in seen:
+                seen.add(scenario_id(scenario))
+                yield scenario
+
+
+def vector_content(registry, name, scenario, nested_urls=None):
+    content = {
+        "docker-images": {
+            "image-%d" % i: dict(name="metalstack/image-%d" % i, tag="v0.0.%d" % i) for i in range(scenario["size"])
+        },
+    }
+
+    if nested_urls:
+        content["vectors"] = {"nested-%d" % i: dict(url=url) for i, url in enumerate(nested_urls)}
+
+    roles = dict()
+    for i in range(scenario["roles"]):
+        role = "%s-role-%d" % (name, i)
+        registry.add_artifact("roles/" + role, "v1", ANSIBLE_ROLE_MEDIA_TYPE, {
+            role + "/defaults/main.yaml": b"mapping: {}\n",
+            role + "/tasks/main.yaml": b"[]\n",
+        })
+        roles[role] = dict(oci="%s/roles/%s" % (registry.host, role), version="v1")
+    content["ansible-roles"] = roles
+
+    return yaml.safe_dump(content).encode("utf-8")
+
+
+def publish(registry, name, content, source):
+    if source == "oci":
+        registry.add_artifact("vectors/" + name, "v1", RELEASE_VECTOR_MEDIA_TYPE, {"release.yaml": content})
+        return "oci://%s/vectors/%s:v1" % (registry.host, name)
+
+    return registry.add_file("/vectors/%s.yaml" % name, content)
+
+
+def setup_scenario(registry, scenario):
+    """
+    Publishes the release vectors of a scenario and returns the module
+    arguments and task vars resolving them.
+    """
+    vectors = []
+    for v in range(scenario["vectors"]):
+        name = "vector-%d" % v
+
+        nested_urls = []
+        for n in range(scenario["nested"]):
+            nested_name = "%s-nested-%d" % (name, n)
+            nested_urls.append(publish(registry, nested_name, vector_content(
+                registry, nested_name, dict(scenario, roles=0)), scenario["source"]))
+
+        url = publish(registry, name, vector_content(registry, name, scenario, nested_urls), scenario["source"])
+
+        vectors.append(dict(
+            url=url,
+            variable_mapping_path="mapping",
+            install_roles=scenario["roles"] > 0,
+            oci_registry_scheme="http",
+            nested=[dict(url_path="vectors.nested-%d.url" % n, variable_mapping_path="mapping",
+                         install_roles=False, oci_registry_scheme="http") for n in range(scenario["nested"])],
+        ))
+
+    task_vars = dict(
+        mapping={"image_%d_tag" % i: "docker-images.image-%d.tag" % i for i in range(scenario["size"])},
+    )
+
+    return vectors, task_vars
+
+
+def resolve(vectors, task_vars, parallelism, trace_memory=False):
+    task = MagicMock(Task)
+    task.action = "metal_stack_release_vector"
+    task.async_val = False
+    task.args = dict(cache=False, parallelism=parallelism, vectors=vectors)
+
+    play_context = MagicMock()
+    play_context.check_mode = False
+
+    plugin = metal_stack_release_vector.ActionModule(task, MagicMock(), play_context, loader=None,
+                                                     templar=Templar(loader=None), shared_loader_obj=None)
+
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    try:
+        result = plugin.run(task_vars=task_vars)
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    if result.get("failed"):
+        raise RuntimeError("resolution failed: %s\n%s" % (result.get("error"), result.get("traceback")))
+
+    return elapsed, peak
+
+
+def run_scenario(scenario, parallelism, repeat):
+    """
+    Returns the cold and warm measurements of a scenario.
+    """
+    measurements = dict(cold=dict(seconds=[]), warm=dict(seconds=[]))
+
+    with FakeRegistry() as registry:
+        vectors, task_vars = setup_scenario(registry, scenario)
+
+        # the last round traces the memory, which slows down the resolution considerably
+        for round in range(repeat + 1):
+            trace_memory = round == repeat
+
+            with tempfile.TemporaryDirectory() as tmp, \
+                    patch.dict(os.environ, {"XDG_CACHE_HOME": os.path.join(tmp, "cache")}), \
+                    patch.object(metal_stack_release_vector.C, "DEFAULT_ROLES_PATH", [os.path.join(tmp, "roles")]):
+                for phase in ["cold", "warm"]:
+                    registry.reset_counters()
+
+                    elapsed, peak = resolve(vectors, task_vars, parallelism, trace_memory=trace_memory)
+
+                    m = measurements[phase]
+                    if trace_memory:
+                        m["peak_memory_bytes"] = peak
+                    else:
+                        m["seconds"].append(elapsed)
+                        m["requests"] = {"%s %s" % k: v for k, v in sorted(registry.requests.items())}
+                        m["connections"] = registry.connections
+                        m["bytes_sent"] = registry.bytes_sent
+
+    for m in measurements.values():
+        m["min_seconds"] = min(m["seconds"])
+
+    return measurements
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the scenarios that got slower than the baseline by more than the
+    tolerance factor.
+    """
+    previous = {(r["id"], phase): m["min_seconds"]
+                for r in baseline["results"] for phase, m in r["phases"].items()}
+
+    regressions = []
+    for r in results["results"]:
+        for phase, m in r["phases"].items():
+            before = previous.get((r["id"], phase))
+            if before and m["min_seconds"] > before * tolerance:
+                regressions.append(dict(id=r["id"], phase=phase, before=before, after=m["min_seconds"]))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="file to write the results to, defaults to stdout")
+    parser.add_argument("--baseline", help="results of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="factor by which a scenario may be slower than in the baseline")
+    parser.add_argument("--parallelism", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed rounds per scenario")
+    parser.add_argument("--quick", action="store_true", help="run a reduced set of scenarios")
+    args = parser.parse_args(argv)
+
+    results = dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        parallelism=args.parallelism,
+        results=[],
+    )
+
+    # the progress output of the plugin would interfere with the results
+    with patch.object(metal_stack_release_vector, "display", MagicMock()):
+        for scenario in scenarios(QUICK_SCENARIOS if args.quick else SCENARIOS):
+            print("running %s" % scenario_id(scenario), file=sys.stderr)
+            results["results"].append(dict(
+                id=scenario_id(scenario),
+                scenario=scenario,
+                phases=run_scenario(scenario, args.parallelism, args.repeat),
+            ))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for r in regressions:
+            print("regression in %s (%s): %.3fs -> %.3fs" % (r["id"], r["phase"], r["before"], r["after"]),
+                  file=sys.stderr)
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import yaml
+
+from unittest.mock import patch
+
+from test import MODULE_UTILS_PATH
+from test.apiserver import FakeApiServer
+
+sys.path.insert(0, MODULE_UTILS_PATH)
+import k8s_client_pool  # noqa: E402
+
+
+def kubeconfig(server="https://127.0.0.1:6443", token="secret"):
+    return {
+        "apiVersion": "v1",
+        "kind": "Config",
+        "clusters": [{"name": "default-cluster", "cluster": {"server": server}}],
+        "contexts": [{"name": "default-context", "context": {"cluster": "default-cluster", "user": "default-user"}}],
+        "current-context": "default-context",
+        "users": [{"name": "default-user", "user": {"token": token}}],
+    }
+
+
+class K8sClientPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clients = patch.dict(k8s_client_pool._clients, clear=True)
+        self.clients.start()
+
+    def tearDown(self):
+        self.clients.stop()
+
+    def test_clients_are_shared_by_kubeconfig_content(self):
+        client = k8s_client_pool.api_client(kubeconfig())
+
+        self.assertIs(client, k8s_client_pool.api_client(kubeconfig()))
+        self.assertIsNot(client, k8s_client_pool.api_client(kubeconfig(token="other")))
+        self.assertEqual("https://127.0.0.1:6443", client.configuration.host)
+
+    def test_kubeconfig_files_are_identified_by_content(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "kubeconfig")
+            with open(path, "w") as f:
+                yaml.safe_dump(kubeconfig(), f)
+
+            client = k8s_client_pool.api_client(path)
+            self.assertIs(client, k8s_client_pool.api_client(path))
+
+            with open(path, "w") as f:
+                yaml.safe_dump(kubeconfig(server="https://127.0.0.2:6443"), f)
+
+            modified = k8s_client_pool.api_client(path)
+            self.assertIsNot(client, modified)
+            self.assertEqual("https://127.0.0.2:6443", modified.configuration.host)
+
+            with patch.object(k8s_client_pool.kube_config, "KUBE_CONFIG_DEFAULT_LOCATION", path):
+                self.assertIs(modified, k8s_client_pool.api_client(None))
+
+    def test_least_recently_used_clients_are_evicted(self):
+        with patch.object(k8s_client_pool, "MAX_CLIENTS", 2):
+            first = k8s_client_pool.api_client(kubeconfig(token="1"))
+            k8s_client_pool.api_client(kubeconfig(token="2"))
+            k8s_client_pool.api_client(kubeconfig(token="1"))
+            k8s_client_pool.api_client(kubeconfig(token="3"))
+
+            self.assertEqual(2, len(k8s_client_pool._clients))
+            self.assertIs(first, k8s_client_pool.api_client(kubeconfig(token="1")))
+
+    def test_unsupported_kubeconfig(self):
+        with self.assertRaises(TypeError):
+            k8s_client_pool.api_client(["kubeconfig"])
+
+
+class CachedDiscovererTest(unittest.TestCase):
+    def setUp(self):
+        self.clients = patch.dict(k8s_client_pool._clients, clear=True)
+        self.clients.start()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = patch.dict(os.environ, dict(KUBECACHEDIR=self.tmp.name))
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+        self.clients.stop()
+
+    def _search(self, server, **kwargs):
+        # a new process starts without pooled clients
+        k8s_client_pool._clients.clear()
+        client = k8s_client_pool.dynamic_client(kubeconfig(server=server.url))
+        return client.resources.search(**kwargs)
+
+    def test_discovery_cache_dir_is_shared_with_kubectl(self):
+        self.assertEqual(os.path.join(self.tmp.name, "discovery", "api.example.com_6443"),
+                         k8s_client_pool.discovery_cache_dir("https://api.example.com:6443"))
+
+    def test_aggregated_discovery_is_cached_on_disk(self):
+        with FakeApiServer() as server:
+            deployments = self._search(server, api_version="apps/v1", kind="Deployment")
+
+            self.assertEqual(1, len(deployments))
+            self.assertTrue(deployments[0].namespaced)
+            self.assertEqual(["scale", "status"], sorted(deployments[0].subresources))
+            self.assertEqual({"/api": 1, "/apis": 1}, server.requests)
+
+            cache_dir = k8s_client_pool.discovery_cache_dir(server.url)
+            with open(os.path.join(cache_dir, "servergroups.json")) as f:
+                groups = json.load(f)
+            self.assertEqual(["", "apps", "operator.gardener.cloud"], [g["name"] for g in groups["groups"]])
+            with open(os.path.join(cache_dir, "apps", "v1", "serverresources.json")) as f:
+                resources = json.load(f)
+            self.assertEqual(["deployments", "deployments/status", "deployments/scale"],
+                             [r["name"] for r in resources["resources"]])
+            self.assertTrue(os.path.isfile(os.path.join(cache_dir, "v1", "serverresources.json")))
+
+            server.reset_counters()
+            gardens = self._search(server, api_version="operator.gardener.cloud/v1alpha1", kind="Garden")
+            pods = self._search(server, kind="Pod")
+
+            self.assertEqual(1, len(gardens))
+            self.assertFalse(gardens[0].namespaced)
+            self.assertEqual(1, len(pods))
+            self.assertEqual(0, server.count())
+
+    def test_expired_documents_are_fetched_again(self):
+        with FakeApiServer() as server:
+            self._search(server, kind="Pod")
+
+            server.reset_counters()
+            with patch.object(k8s_client_pool, "DISCOVERY_CACHE_TTL", 0):
+                self._search(server, kind="Pod")
+            self.assertEqual({"/api": 1, "/apis": 1}, server.requests)
+
+    def test_unknown_resources_are_discovered_again(self):
+        with FakeApiServer() as server:
+            self._search(server, kind="Pod")
+
+            server.resources["example.com"] = dict(v1=dict(widgets=["Widget", True, []]))
+            server.reset_counters()
+            widgets = self._search(server, kind="Widget")
+
+            self.assertEqual(1, len(widgets))
+            self.assertEqual({"/api": 1, "/apis": 1}, server.requests)
+
+    def test_dynamic_client_shares_the_entry_of_the_api_client(self):
+        with FakeApiServer() as server:
+            api_client = k8s_client_pool.api_client(kubeconfig(server=server.url))
+            dynamic_client = k8s_client_pool.dynamic_client_of(api_client)
+
+            self.assertIs(api_client, dynamic_client.client)
+            self.assertIs(dynamic_client, k8s_client_pool.dynamic_client(kubeconfig(server=server.url)))
+
+            # evicted clients still get a dynamic client of their own connections
+            k8s_client_pool._clients.clear()
+            self.assertIs(api_client, k8s_client_pool.dynamic_client_of(api_client).client)
+
+    def test_group_versions_are_walked_without_aggregated_discovery(self):
+        with FakeApiServer(aggregated=False) as server:
+            deployments = self._search(server, group="apps", kind="Deployment")
+
+            self.assertEqual(1, len(deployments))
+            self.assertEqual({"/api": 1, "/apis": 1, "/apis/apps/v1": 1}, server.requests)
+
+            server.reset_counters()
+            self.assertEqual(1, len(self._search(server, api_version="apps/v1", kind="Deployment")))
+            self.assertEqual(1, len(self._search(server, kind="Garden")))
+            self.assertEqual({"/api/v1": 1, "/apis/operator.gardener.cloud/v1alpha1": 1}, server.requests)
+
+            cache_dir = k8s_client_pool.discovery_cache_dir(server.url)
+            with open(os.path.join(cache_dir, "servergroups.json")) as f:
+                groups = json.load(f)
+            self.assertEqual(["", "apps", "operator.gardener.cloud"], [g["name"] for g in groups["groups"]])
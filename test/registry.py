@@ -0,0 +1,284 @@
+import gzip
+import hashlib
+import io
+import json
+import tarfile
+import threading
+import time
+
+from email.utils import formatdate
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+RELEASE_VECTOR_MEDIA_TYPE = "application/vnd.metal-stack.release-vector.v1.tar+gzip"
+ANSIBLE_ROLE_MEDIA_TYPE = "application/vnd.metal-stack.ansible-role.v1.tar+gzip"
+MANIFEST_MEDIA_TYPE = "application/vnd.oci.image.manifest.v1+json"
+
+
+def tar_gzip(files):
+    """
+    Returns a gzipped tarball containing the given files (name -> bytes).
+    """
+    buf = io.BytesIO()
+    # a fixed mtime keeps the digests of equal content stable
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode="w") as tar:
+            for name, content in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+class FakeRegistry():
+    """
+    An in-process stand-in for an OCI registry and a plain HTTP file server.
+
+    It implements the subset of the OCI distribution API used by the
+    metal_stack_release_vector action plugin (manifests by tag or digest,
+    blobs and an optional bearer token flow) and serves plain files with
+    ETag and Last-Modified headers. Blobs can be requested with ranges. All
+    requests are counted and faults can be injected.
+    """
+
+    # seconds a response is held back by the "delay" fault
+    DELAY = 1
+
+    def __init__(self, auth=False):
+        self.auth = auth
+        self.blobs = dict()
+        self.manifests = dict()
+        self.files = dict()
+        self.requests = dict()
+        self.connections = 0
+        self.bytes_sent = 0
+        self.faults = list()
+
+        self._lock = threading.Lock()
+        self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def start(self):
+        registry = self
+
+        class Handler(_Handler):
+            pass
+
+        Handler.registry = registry
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def host(self):
+        return "127.0.0.1:%d" % self._server.server_address[1]
+
+    @property
+    def url(self):
+        return "http://" + self.host
+
+    def add_artifact(self, repository, tag, media_type, files):
+        """
+        Pushes an artifact with a single tar+gzip layer containing the given
+        files and returns its manifest digest.
+        """
+        layer = tar_gzip(files)
+        layer_digest = self._digest(layer)
+
+        config = b"{}"
+        config_digest = self._digest(config)
+
+        manifest = json.dumps(dict(
+            schemaVersion=2,
+            mediaType=MANIFEST_MEDIA_TYPE,
+            config=dict(mediaType="application/vnd.oci.empty.v1+json",
+                        digest=config_digest, size=len(config)),
+            layers=[dict(mediaType=media_type, digest=layer_digest, size=len(layer))],
+        )).encode("utf-8")
+        manifest_digest = self._digest(manifest)
+
+        with self._lock:
+            self.blobs[layer_digest] = layer
+            self.blobs[config_digest] = config
+            self.manifests[(repository, tag)] = manifest
+            self.manifests[(repository, manifest_digest)] = manifest
+
+        return manifest_digest
+
+    def add_file(self, path, content):
+        """
+        Serves the given content as a plain file and returns its URL.
+        """
+        with self._lock:
+            self.files[path] = (content, formatdate(usegmt=True))
+        return self.url + path
+
+    def inject_fault(self, kind, fault, times=1):
+        """
+        Lets the next requests of a kind fail. The fault "error" responds with
+        status code 503, "truncate" closes the connection after half of the
+        content was sent and "delay" responds only after DELAY seconds.
+        """
+        with self._lock:
+            self.faults.extend([(kind, fault)] * times)
+
+    def _take_fault(self, kind):
+        with self._lock:
+            for i, (k, fault) in enumerate(self.faults):
+                if k == kind:
+                    del self.faults[i]
+                    return fault
+            return None
+
+    def count(self, method=None, kind=None):
+        """
+        Returns the number of requests for a method and a kind of resource
+        (base, manifests, blobs, files, token or proxied).
+        """
+        with self._lock:
+            return sum(n for (m, k), n in self.requests.items()
+                       if (method is None or m == method) and (kind is None or k == kind))
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = dict()
+            self.connections = 0
+            self.bytes_sent = 0
+
+    @staticmethod
+    def _digest(content):
+        return "sha256:" + hashlib.sha256(content).hexdigest()
+
+    def _record(self, method, kind, sent=0):
+        with self._lock:
+            self.requests[(method, kind)] = self.requests.get((method, kind), 0) + 1
+            self.bytes_sent += sent
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    registry = None
+
+    def setup(self):
+        super().setup()
+        with self.registry._lock:
+            self.registry.connections += 1
+
+    def log_message(self, *_):
+        pass
+
+    def do_GET(self):
+        self._handle(body=True)
+
+    def do_HEAD(self):
+        self._handle(body=False)
+
+    def _handle(self, body):
+        if not self.path.startswith("/"):
+            # requests sent through a proxy carry the absolute url, so the
+            # registry serves as its own proxy
+            self.registry._record(self.command, "proxied")
+            self.path = "/" + self.path.split("/", maxsplit=3)[3]
+
+        path = self.path.split("?", maxsplit=1)[0]
+
+        if path == "/token":
+            self.registry._record(self.command, "token")
+            return self._respond(200, json.dumps(dict(token="secret", expires_in=300)).encode("utf-8"), body)
+
+        if not path.startswith("/v2/"):
+            return self._file(path, body)
+
+        if self.registry.auth and self.headers.get("Authorization") != "Bearer secret":
+            self.registry._record(self.command, "unauthorized")
+            return self._respond(401, b"", body, headers={
+                "Www-Authenticate": 'Bearer realm="%s/token",service="fake",scope="repository:x:pull"' % self.registry.url,
+            })
+
+        if path == "/v2/":
+            self.registry._record(self.command, "base")
+            return self._respond(200, b"{}", body)
+
+        parts = path.split("/")
+        kind, reference, repository = parts[-2], parts[-1], "/".join(parts[2:-2])
+
+        if kind == "manifests":
+            content = self.registry.manifests.get((repository, reference))
+            headers = {"Content-Type": MANIFEST_MEDIA_TYPE}
+            if content is not None:
+                headers["Docker-Content-Digest"] = self.registry._digest(content)
+        elif kind == "blobs":
+            content = self.registry.blobs.get(reference)
+            headers = {"Content-Type": "application/octet-stream"}
+        else:
+            content, headers = None, dict()
+
+        if content is None:
+            self.registry._record(self.command, kind)
+            return self._respond(404, b"", body)
+
+        status = 200
+        requested_range = self.headers.get("Range")
+        if kind == "blobs" and requested_range and requested_range.startswith("bytes="):
+            start = int(requested_range[len("bytes="):].split("-")[0])
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, len(content) - 1, len(content))
+            content = content[start:]
+            status = 206
+
+        fault = self.registry._take_fault(kind)
+        if fault == "delay":
+            time.sleep(self.registry.DELAY)
+        if fault == "error":
+            self.registry._record(self.command, kind)
+            return self._respond(503, b"", body)
+        if fault == "truncate" and body:
+            self.registry._record(self.command, kind, len(content) // 2)
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content[:len(content) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+
+        self.registry._record(self.command, kind, len(content) if body else 0)
+        return self._respond(status, content, body, headers=headers)
+
+    def _file(self, path, body):
+        entry = self.registry.files.get(path)
+        if entry is None:
+            self.registry._record(self.command, "files")
+            return self._respond(404, b"", body)
+
+        content, last_modified = entry
+        etag = '"%s"' % hashlib.sha256(content).hexdigest()
+
+        if self.headers.get("If-None-Match") == etag or \
+                (self.headers.get("If-None-Match") is None and self.headers.get("If-Modified-Since") == last_modified):
+            self.registry._record(self.command, "files")
+            return self._respond(304, b"", False, headers={"ETag": etag, "Last-Modified": last_modified})
+
+        self.registry._record(self.command, "files", len(content) if body else 0)
+        return self._respond(200, content, body, headers={"ETag": etag, "Last-Modified": last_modified})
+
+    def _respond(self, status, content, body, headers=None):
+        self.send_response(status)
+        for k, v in (headers or dict()).items():
+            self.send_header(k, v)
+        if status != 304:
+            self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if body and content:
+            self.wfile.write(content)